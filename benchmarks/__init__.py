@@ -0,0 +1,7 @@
+"""
+Package: benchmarks
+Performance benchmarks for the Supplier service
+
+Benchmarks drop and recreate the tables of the database in DATABASE_URI,
+so point them at a scratch database, never at production.
+"""
@@ -0,0 +1,56 @@
+"""
+Memory footprint and read latency of the in-process catalog
+
+Loads the catalog from a seeded database, measures the memory it holds with
+tracemalloc, and compares GET latency from memory against the ORM path.
+
+Run with:
+  python -m benchmarks.bench_catalog [suppliers] [products_per_supplier] [repeat]
+"""
+import gc
+import sys
+import tracemalloc
+from service import app
+from service.service import catalog
+from benchmarks.common import setup_database, seed_suppliers, measure, report
+
+
+def main(suppliers=10000, products_per_supplier=10, repeat=200):
+    """ Runs the catalog benchmark """
+    setup_database()
+    seed_suppliers(suppliers, products_per_supplier)
+    app.config['CATALOG_REFRESH_SECONDS'] = 3600
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    with app.test_request_context():
+        catalog.refresh(full=True)
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    held = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    products = suppliers * products_per_supplier
+    report("Catalog memory", [
+        ("suppliers", suppliers),
+        ("products", products),
+        ("total MB", held / 1024 / 1024),
+        ("bytes/product", held / max(products, 1)),
+        ("MB per 1M products", held / max(products, 1)),
+    ], ["measure", "value"])
+
+    client = app.test_client()
+    rows = []
+    for enabled in (False, True):
+        app.config['CATALOG_ENABLED'] = enabled
+        label = "catalog" if enabled else "orm"
+        for url in ('/api/suppliers/1', '/api/suppliers?category=apparel'):
+            count = repeat if 'category' not in url else max(repeat // 20, 3)
+            stats = measure(lambda: client.get(url), count)
+            rows.append((label, url, stats['mean'], stats['p50'], stats['p99']))
+    app.config['CATALOG_ENABLED'] = False
+    report("GET latency", rows, ["mode", "url", "mean ms", "p50 ms", "p99 ms"])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
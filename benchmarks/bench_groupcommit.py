@@ -0,0 +1,84 @@
+"""
+Throughput of Supplier creates with and without group commit
+
+Clients create Suppliers as fast as they can for a fixed time, once with
+every create committing its own transaction and once with
+GROUP_COMMIT_ENABLED, and reports the creates per second and the number
+of creates the committer put in each group.
+
+Clients are threads of one process, like the request threads of a
+threaded gunicorn worker. One client is what a sync worker looks like:
+it serves one request at a time, so every group holds a single insert and
+the mode only adds the hand-off to the committer thread.
+
+Clients have their own database connections, so keep them at or below
+the connection pool size (15 by default).
+
+Run with:
+  python -m benchmarks.bench_groupcommit [seconds] [max_clients]
+"""
+import sys
+import time
+import threading
+from service import app
+from service.groupcommit import committer
+from service.models import db, Supplier
+from benchmarks.common import setup_database, report
+
+
+def create():
+    """ Creates one Supplier """
+    supplier = Supplier(name="Supplier", category="other", address="1 Main St",
+                        email="sales@example.com", phone_number="555-0000", preferred=False)
+    supplier.create()
+
+
+def run(clients, seconds):
+    """ Creates Suppliers from many clients and returns creates/s """
+    counts = [0] * clients
+    start = threading.Barrier(clients + 1)
+    deadline = []
+
+    def client(index):
+        with app.app_context():
+            start.wait()
+            while time.perf_counter() < deadline[0]:
+                create()
+                counts[index] += 1
+                db.session.remove()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    deadline.append(time.perf_counter() + seconds)
+    start.wait()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds
+
+
+def main(seconds=3, max_clients=12):
+    """ Runs the group commit benchmark """
+    setup_database()
+    db.session.remove()
+    saved = app.config['GROUP_COMMIT_ENABLED']
+
+    rows = []
+    clients = 1
+    while clients <= max_clients:
+        for label, enabled in (("own commit", False), ("group commit", True)):
+            app.config['GROUP_COMMIT_ENABLED'] = enabled
+            batches, operations = committer.batches, committer.operations
+            rate = run(clients, seconds)
+            batches = committer.batches - batches
+            group = (committer.operations - operations) / batches if batches else 1.0
+            rows.append((label, clients, rate, float(group)))
+        clients *= 2
+    committer.stop()
+    app.config['GROUP_COMMIT_ENABLED'] = saved
+    report("Supplier creates ({} s per run)".format(seconds), rows,
+           ["method", "clients", "creates/s", "per group"])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,70 @@
+"""
+Request thread overhead of the logging pipeline
+
+Serves GET /api/suppliers/{id} through the WSGI stack with different logging
+setups writing to a log file, and optionally to a slow sink that stands in
+for a congested stdout pipe under gunicorn:
+
+legacy - every line written on the request thread, hot paths at INFO
+queued - lines handed to the background writer, hot paths at DEBUG
+sampled - queued JSON lines, keeping 1% of the INFO lines
+
+Run with:
+  python -m benchmarks.bench_logging [repeat] [sink_delay_us]
+"""
+import sys
+import time
+import logging
+import tempfile
+from service import app, log
+from benchmarks.common import setup_database, seed_suppliers, measure, report
+
+
+class SlowFileHandler(logging.FileHandler):
+    """ A file handler that takes extra time per line, like a full pipe """
+
+    def __init__(self, filename, delay):
+        super().__init__(filename)
+        self.delay = delay
+
+    def emit(self, record):
+        super().emit(record)
+        if self.delay:
+            time.sleep(self.delay)
+
+
+def main(repeat=2000, sink_delay_us=200):
+    """ Runs the logging benchmark """
+    setup_database()
+    seed_suppliers(100, 5)
+    client = app.test_client()
+    saved = app.logger.handlers, app.logger.level
+
+    modes = (
+        ('legacy', dict(LOG_QUEUE_ENABLED=False, LOG_FORMAT='text', LOG_SAMPLE_RATES={}),
+         logging.DEBUG),
+        ('queued', dict(LOG_QUEUE_ENABLED=True, LOG_FORMAT='text', LOG_SAMPLE_RATES={}),
+         logging.INFO),
+        ('sampled', dict(LOG_QUEUE_ENABLED=True, LOG_FORMAT='json',
+                         LOG_SAMPLE_RATES={'service': 0.01}), logging.INFO),
+    )
+    rows = []
+    for delay in (0, sink_delay_us / 1e6):
+        for label, config, level in modes:
+            app.config.update(config)
+            with tempfile.NamedTemporaryFile(suffix='.log') as logfile:
+                listener = log.configure_logging(app, [SlowFileHandler(logfile.name, delay)])
+                app.logger.setLevel(level)
+                stats = measure(lambda: client.get('/api/suppliers/1'), repeat)
+                if listener:
+                    listener.stop()
+                lines = sum(1 for _ in open(logfile.name))
+            rows.append((label, int(delay * 1e6), lines, stats['mean'], stats['p50'], stats['p99']))
+    app.logger.handlers, level = saved
+    app.logger.setLevel(level)
+    report("GET /api/suppliers/1 x {}".format(repeat), rows,
+           ["mode", "sink us", "lines", "mean ms", "p50 ms", "p99 ms"])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
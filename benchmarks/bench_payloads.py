@@ -0,0 +1,45 @@
+"""
+Payload size and latency of the Supplier list and read endpoints
+
+Measures bytes on the wire and end-to-end latency through the WSGI stack
+for every supported media type and content encoding.
+
+Run with:
+  python -m benchmarks.bench_payloads [suppliers] [products_per_supplier] [repeat]
+"""
+import sys
+from service import app
+from service.encoding import msgpack, pyarrow, brotli, MSGPACK_MEDIATYPE, ARROW_MEDIATYPE
+from benchmarks.common import setup_database, seed_suppliers, measure, report
+
+
+def main(suppliers=1000, products_per_supplier=5, repeat=20):
+    """ Runs the payload benchmark """
+    setup_database()
+    seed_suppliers(suppliers, products_per_supplier)
+    client = app.test_client()
+
+    mediatypes = {'json': 'application/json'}
+    if msgpack:
+        mediatypes['msgpack'] = MSGPACK_MEDIATYPE
+    if pyarrow:
+        mediatypes['arrow'] = ARROW_MEDIATYPE
+    encodings = ['identity', 'gzip'] + (['br'] if brotli else [])
+
+    for url in ('/api/suppliers', '/api/suppliers/1'):
+        rows = []
+        for label, mediatype in mediatypes.items():
+            for encoding in encodings:
+                headers = {'Accept': mediatype, 'Accept-Encoding': encoding}
+                size = len(client.get(url, headers=headers).data)
+                stats = measure(lambda: client.get(url, headers=headers), repeat)
+                rows.append((label, encoding, size,
+                             stats['mean'], stats['p50'], stats['p99']))
+        report(
+            "GET {} ({} suppliers x {} products)".format(url, suppliers, products_per_supplier),
+            rows, ["format", "encoding", "bytes", "mean ms", "p50 ms", "p99 ms"]
+        )
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
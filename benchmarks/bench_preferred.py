@@ -0,0 +1,90 @@
+"""
+Preferred Supplier listings on a large table
+
+Seeds the Supplier table with one preferred Supplier in ten, then times the
+preferred listings twice: with the flag stored the old way, as a string
+with no index, and after the migration has turned it into a boolean with
+the partial index ix_Supplier_preferred_active.
+
+Run with:
+  python -m benchmarks.bench_preferred [suppliers] [repeat]
+"""
+import sys
+import time
+from service import app
+from service.models import db, DEFAULT_TENANT
+from service.migrations import migrate
+from benchmarks.common import setup_database, seed_suppliers, measure, report
+
+QUERIES = {
+    'first page': 'SELECT id FROM "Supplier" WHERE tenant = :tenant AND deleted_at IS NULL '
+                  'AND {} ORDER BY id LIMIT 100',
+    'count': 'SELECT count(*) FROM "Supplier" WHERE tenant = :tenant AND deleted_at IS NULL '
+             'AND {}',
+}
+
+PREDICATES = {
+    'string': "preferred = 'true'",
+    'boolean': 'preferred',
+}
+
+
+def use_string_preferred():
+    """ Stores the flag as a string without an index, as it was before """
+    db.session.execute('DROP INDEX "ix_Supplier_preferred_active"')
+    db.session.execute(
+        'ALTER TABLE "Supplier" '
+        "ALTER COLUMN preferred DROP NOT NULL, "
+        "ALTER COLUMN preferred DROP DEFAULT, "
+        "ALTER COLUMN preferred TYPE varchar(32) "
+        "USING CASE WHEN preferred THEN 'true' ELSE 'false' END"
+    )
+    db.session.commit()
+
+
+def plan(sql):
+    """ Returns the top node of the plan PostgreSQL picks for a query """
+    rows = db.session.execute('EXPLAIN ' + sql, {'tenant': DEFAULT_TENANT}).fetchall()
+    scans = [row[0].strip(' ->') for row in rows if 'Scan' in row[0]]
+    return scans[0].split('  ')[0] if scans else rows[0][0].split('  ')[0]
+
+
+def time_queries(layout, repeat):
+    """ Times each query with the predicate of a layout """
+    db.session.execute('ANALYZE "Supplier"')
+    db.session.commit()
+    rows = []
+    for name, query in QUERIES.items():
+        sql = query.format(PREDICATES[layout])
+        stats = measure(
+            lambda: db.session.execute(sql, {'tenant': DEFAULT_TENANT}).fetchall(), repeat
+        )
+        rows.append((layout, name, stats['mean'], stats['p50'], stats['p99'], plan(sql)))
+    db.session.commit()
+    return rows
+
+
+def main(suppliers=1000000, repeat=50):
+    """ Runs the preferred listing benchmark """
+    setup_database()
+    seed_suppliers(suppliers)
+    use_string_preferred()
+    rows = time_queries('string', repeat)
+
+    start = time.perf_counter()
+    migrate()
+    migrated = time.perf_counter() - start
+    rows += time_queries('boolean', repeat)
+
+    client = app.test_client()
+    url = '/api/suppliers?preferred=true&limit=100'
+    stats = measure(lambda: client.get(url), repeat)
+    rows.append(('boolean', 'GET ' + url, stats['mean'], stats['p50'], stats['p99'], ''))
+
+    report("Preferred listings of {} suppliers".format(suppliers), rows,
+           ["layout", "query", "mean ms", "p50 ms", "p99 ms", "plan"])
+    report("Migration", [("seconds", migrated)], ["measure", "value"])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
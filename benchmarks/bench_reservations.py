@@ -0,0 +1,92 @@
+"""
+Reservation throughput on one hot Product
+
+Many clients reserve one unit of the same Product as fast as they can for a
+fixed time. Compares the conditional decrement used by Reservation.reserve
+against the read-modify-write it replaces (SELECT ... FOR UPDATE, then save),
+and measures multi-product orders that lock with SKIP LOCKED.
+
+Clients are threads with their own database connections, so keep them at
+or below the connection pool size (15 by default).
+
+Run with:
+  python -m benchmarks.bench_reservations [seconds] [max_clients]
+"""
+import sys
+import time
+import threading
+from service import app
+from service.models import db, Product, Reservation, ReservationError
+from benchmarks.common import setup_database, seed_suppliers, report
+
+HOT_STOCK = 10 ** 9
+
+
+def reserve_atomic(product_ids):
+    """ One conditional decrement, or SKIP LOCKED for several Products """
+    Reservation.reserve([{"product_id": i, "quantity": 1} for i in product_ids])
+
+
+def reserve_read_modify_write(product_ids):
+    """ The old way: lock and read each Product, then write it back """
+    for product_id in product_ids:
+        product = Product.query.with_for_update().get(product_id)
+        product.quantity -= 1
+        db.session.add(Reservation(product_id=product_id, quantity=1))
+    db.session.commit()
+
+
+def run(func, product_ids, clients, seconds):
+    """ Runs func from many clients and returns (reservations/s, conflicts) """
+    counts = [0] * clients
+    conflicts = [0] * clients
+    start = threading.Barrier(clients + 1)
+    deadline = []
+
+    def client(index):
+        with app.app_context():
+            start.wait()
+            while time.perf_counter() < deadline[0]:
+                try:
+                    func(product_ids)
+                    counts[index] += 1
+                except ReservationError:
+                    conflicts[index] += 1
+            db.session.remove()
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    deadline.append(time.perf_counter() + seconds)
+    start.wait()
+    for thread in threads:
+        thread.join()
+    return sum(counts) / seconds, sum(conflicts)
+
+
+def main(seconds=3, max_clients=12):
+    """ Runs the reservation benchmark """
+    setup_database()
+    seed_suppliers(1, 4)
+    db.session.query(Product).update({Product.quantity: HOT_STOCK})
+    db.session.commit()
+    db.session.remove()
+
+    rows = []
+    clients = 1
+    while clients <= max_clients:
+        for label, func, product_ids in (
+                ("read-modify-write", reserve_read_modify_write, [1]),
+                ("conditional", reserve_atomic, [1]),
+                ("skip locked x2", reserve_atomic, [1, 2]),
+                ("skip locked x4", reserve_atomic, [1, 2, 3, 4]),
+        ):
+            rate, conflicts = run(func, product_ids, clients, seconds)
+            rows.append((label, clients, rate, conflicts))
+        clients *= 2
+    report("Reservations of one hot Product ({} s per run)".format(seconds), rows,
+           ["method", "clients", "orders/s", "retries"])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
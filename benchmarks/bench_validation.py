@@ -0,0 +1,80 @@
+"""
+Cost of validating large Supplier payloads
+
+Compares the validators compiled from service/schema.py against a generic
+JSON Schema validator built from the same Swagger models, and the full
+deserialize into ORM objects before and after validation was added. Half
+of the documents are valid and half carry one error each.
+
+Run with:
+  python -m benchmarks.bench_validation [items] [repeat]
+"""
+import sys
+from jsonschema import Draft4Validator
+from flask_restplus import Api
+from service import app
+from service.models import Supplier
+from service.schema import api_models, validate_supplier, validate_many
+from benchmarks.common import measure, report
+
+
+def _payload(items):
+    """ Returns a list of Supplier documents """
+    payload = []
+    for i in range(items):
+        payload.append({
+            "name": "Supplier {}".format(i),
+            "category": "apparel" if i % 2 else "other",
+            "address": "{} Main St".format(i),
+            "email": "sales{}@example.com".format(i),
+            "phone_number": "555-{:04d}".format(i % 10000),
+            "preferred": i % 10 == 0,
+            "products": [{
+                "name": "Product {}".format(i),
+                "desc": "A very useful product",
+                "wholesale_price": 100 + i % 900,
+                "quantity": "many" if i % 2 else i % 500,
+            }],
+        })
+    return payload
+
+
+def _jsonschema_validator():
+    """ Builds a Draft 4 validator from the Swagger models """
+    models = api_models(Api())
+    schema = dict(models['Supplier'].__schema__)
+    schema['definitions'] = {'Product': models['Product'].__schema__}
+    return Draft4Validator({'type': 'array', 'items': schema, 'definitions': schema['definitions']})
+
+
+def _deserialize_all(payload):
+    """ Deserializes every document, collecting the failures """
+    failures = 0
+    for data in payload:
+        try:
+            Supplier().deserialize(data)
+        except Exception:  # pylint: disable=broad-except
+            failures += 1
+    return failures
+
+
+def main(items=100000, repeat=5):
+    """ Runs the validation benchmark """
+    payload = _payload(items)
+    validator = _jsonschema_validator()
+    with app.app_context():
+        assert len(validate_many(validate_supplier, payload)) == items // 2
+        assert len(list(validator.iter_errors(payload))) == items // 2
+        rows = []
+        for label, func in (
+                ("compiled", lambda: validate_many(validate_supplier, payload)),
+                ("jsonschema", lambda: list(validator.iter_errors(payload))),
+                ("deserialize", lambda: _deserialize_all(payload)),
+        ):
+            stats = measure(func, repeat)
+            rows.append((label, stats['mean'], stats['mean'] * 1000 / items))
+    report("Validate {} suppliers".format(items), rows, ["validator", "mean ms", "us/item"])
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
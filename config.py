@@ -17,3 +17,122 @@ SQLALCHEMY_TRACK_MODIFICATIONS = False
 
 # Secret for session management
 SECRET_KEY = os.getenv("SECRET_KEY", "s3cr3t-key-shhhh")
+
+# Response compression
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "true").lower() == "true"
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))  # bytes
+GZIP_LEVEL = int(os.getenv("GZIP_LEVEL", "6"))
+BROTLI_QUALITY = int(os.getenv("BROTLI_QUALITY", "5"))
+
+# Analytics snapshots
+SNAPSHOT_DIR = os.getenv("SNAPSHOT_DIR", os.path.join(os.getcwd(), "snapshots"))
+SNAPSHOT_BATCH_SIZE = int(os.getenv("SNAPSHOT_BATCH_SIZE", "10000"))  # rows per round trip
+SNAPSHOT_ROWS_PER_FILE = int(os.getenv("SNAPSHOT_ROWS_PER_FILE", "1000000"))
+SNAPSHOT_KEEP = int(os.getenv("SNAPSHOT_KEEP", "3"))
+
+# Horizontal sharding, off unless the shards are listed as {"<name>": "<database uri>"}
+SHARD_URIS = json.loads(os.getenv("SHARD_URIS", "{}"))
+SHARD_VNODES = int(os.getenv("SHARD_VNODES", "64"))  # points per shard on the hash ring
+SHARD_ID_BLOCK = int(os.getenv("SHARD_ID_BLOCK", "100"))  # ids reserved per round trip
+
+# Lookups of many Suppliers by id
+LOOKUP_MAX_IDS = int(os.getenv("LOOKUP_MAX_IDS", "1000"))  # ids per request
+
+# Background jobs run by "flask jobs work"
+JOB_CONCURRENCY = int(os.getenv("JOB_CONCURRENCY", "2"))  # jobs run at once per worker
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))  # idle wait between claims
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "300"))  # unseen time before a retry
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+JOB_RETRY_SECONDS = float(os.getenv("JOB_RETRY_SECONDS", "30"))  # doubled after each attempt
+JOB_IMPORT_BATCH = int(os.getenv("JOB_IMPORT_BATCH", "100"))  # suppliers per transaction
+
+# Purging soft deleted rows
+PURGE_AFTER_DAYS = int(os.getenv("PURGE_AFTER_DAYS", "30"))
+PURGE_BATCH_SIZE = int(os.getenv("PURGE_BATCH_SIZE", "1000"))  # rows per transaction
+
+# Product price comparison, kept in the BestOffer table by a trigger when enabled
+BEST_OFFERS_ENABLED = os.getenv("BEST_OFFERS_ENABLED", "false").lower() == "true"
+COMPARE_MAX_OFFERS = int(os.getenv("COMPARE_MAX_OFFERS", "100"))  # offers per request
+
+# Price history, partitioned by month
+PRICE_PARTITIONS_AHEAD = int(os.getenv("PRICE_PARTITIONS_AHEAD", "3"))  # months created in advance
+PRICE_DEFAULT_DAYS = int(os.getenv("PRICE_DEFAULT_DAYS", "30"))  # range when none is given
+
+# Delta sync of the Supplier list
+SYNC_OVERLAP_SECONDS = float(os.getenv("SYNC_OVERLAP_SECONDS", "5"))  # X-Server-Time steps back by this
+
+# In-process catalog for read-mostly deployments
+CATALOG_ENABLED = os.getenv("CATALOG_ENABLED", "false").lower() == "true"
+CATALOG_REFRESH_SECONDS = float(os.getenv("CATALOG_REFRESH_SECONDS", "5"))
+CATALOG_REFRESH_OVERLAP = float(os.getenv("CATALOG_REFRESH_OVERLAP", "5"))  # seconds
+CATALOG_LOAD_BATCH = int(os.getenv("CATALOG_LOAD_BATCH", "1000"))  # suppliers per query
+
+# Rate limiting per client and load shedding per worker
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "false").lower() == "true"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")  # memory or database
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "20"))  # tokens per second
+RATE_LIMIT_BURST = float(os.getenv("RATE_LIMIT_BURST", "100"))
+# comma separated X-Api-Key values clients are told apart by, other clients count by address
+RATE_LIMIT_API_KEYS = frozenset(filter(None, os.getenv("RATE_LIMIT_API_KEYS", "").split(",")))
+# proxies in front that append the client address to X-Forwarded-For, 1 behind the CF router
+PROXY_X_FOR = int(os.getenv("PROXY_X_FOR", "0"))
+# per client or tenant limits as JSON, e.g. {"key:<api key>": [rate, burst], "tenant:<name>": [...]}
+RATE_LIMIT_OVERRIDES = {
+    key: tuple(limits) for key, limits in json.loads(os.getenv("RATE_LIMIT_OVERRIDES", "{}")).items()
+}
+SHED_ENABLED = os.getenv("SHED_ENABLED", "true").lower() == "true"
+SHED_MAX_IN_FLIGHT = int(os.getenv("SHED_MAX_IN_FLIGHT", "32"))
+SHED_MAX_QUEUE_MS = float(os.getenv("SHED_MAX_QUEUE_MS", "5000"))
+SHED_RETRY_AFTER = int(os.getenv("SHED_RETRY_AFTER", "2"))  # seconds
+
+# Database circuit breaker and the stale responses served while it is open
+BREAKER_ENABLED = os.getenv("BREAKER_ENABLED", "true").lower() == "true"
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", "5"))  # consecutive connection failures
+BREAKER_RESET_SECONDS = float(os.getenv("BREAKER_RESET_SECONDS", "10"))
+BREAKER_CONNECT_TIMEOUT = int(os.getenv("BREAKER_CONNECT_TIMEOUT", "3"))  # seconds
+STALE_CACHE_MAX_BYTES = int(os.getenv("STALE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+STALE_MAX_AGE_SECONDS = float(os.getenv("STALE_MAX_AGE_SECONDS", "0"))  # 0 reads every request
+STALE_WHILE_REVALIDATE_SECONDS = float(os.getenv("STALE_WHILE_REVALIDATE_SECONDS", "0"))
+
+# Request deadlines, enforced on the database with statement timeouts and cancels
+DEADLINES_ENABLED = os.getenv("DEADLINES_ENABLED", "true").lower() == "true"
+DEADLINE_DEFAULT_MS = float(os.getenv("DEADLINE_DEFAULT_MS", "10000"))
+DEADLINE_HEADER = os.getenv("DEADLINE_HEADER", "X-Request-Timeout")  # milliseconds, can only shorten
+DEADLINE_CHECK_MS = float(os.getenv("DEADLINE_CHECK_MS", "100"))  # how often running queries are checked
+
+# Tenants and their budgets
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-Tenant")
+TENANT_MAX_IN_FLIGHT = int(os.getenv("TENANT_MAX_IN_FLIGHT", "16"))  # requests per worker
+TENANT_RATE_LIMIT_RATE = float(os.getenv("TENANT_RATE_LIMIT_RATE", "200"))  # tokens per second
+TENANT_RATE_LIMIT_BURST = float(os.getenv("TENANT_RATE_LIMIT_BURST", "1000"))
+
+# Group commit of concurrent creates
+GROUP_COMMIT_ENABLED = os.getenv("GROUP_COMMIT_ENABLED", "false").lower() == "true"
+GROUP_COMMIT_WINDOW_MS = float(os.getenv("GROUP_COMMIT_WINDOW_MS", "0"))  # extra wait for a group
+GROUP_COMMIT_MAX_BATCH = int(os.getenv("GROUP_COMMIT_MAX_BATCH", "64"))  # creates per transaction
+
+# Write-behind stock updates
+WRITE_BEHIND_FLUSH_SECONDS = float(os.getenv("WRITE_BEHIND_FLUSH_SECONDS", "0.5"))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", "1000"))  # Products
+WRITE_BEHIND_WAL_DIR = os.getenv("WRITE_BEHIND_WAL_DIR", "")  # no log file unless set
+WRITE_BEHIND_WAL_FSYNC = os.getenv("WRITE_BEHIND_WAL_FSYNC", "false").lower() == "true"
+
+# Logging pipeline
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text or json
+LOG_QUEUE_ENABLED = os.getenv("LOG_QUEUE_ENABLED", "true").lower() == "true"
+LOG_QUEUE_SIZE = int(os.getenv("LOG_QUEUE_SIZE", "10000"))  # records, dropped when full
+# fraction of records below WARNING to keep per logger as JSON, e.g. {"service.models": 0.01}
+LOG_SAMPLE_RATES = json.loads(os.getenv("LOG_SAMPLE_RATES", "{}"))
+
+# Request tracing
+TRACING_ENABLED = os.getenv("TRACING_ENABLED", "false").lower() == "true"
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0.01"))  # fraction of new traces
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "console")  # console or file
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join(os.getcwd(), "traces.jsonl"))
+
+# Profiling, off unless set when the service starts
+PROFILING_ENABLED = os.getenv("PROFILING_ENABLED", "false").lower() == "true"
+PROFILING_TOKEN = os.getenv("PROFILING_TOKEN", "")  # sent as X-Admin-Token
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(os.getcwd(), "profiles"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "30"))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv("PROFILE_SAMPLE_INTERVAL", "0.005"))  # seconds
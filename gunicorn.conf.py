@@ -0,0 +1,38 @@
+"""
+gunicorn Settings
+
+gunicorn reads this file from the working directory, and the Procfile
+names it with --config. With PRELOAD_APP, on by default, the app is
+imported once in the master and the workers are forked from it, sharing
+its memory; the hooks are in service/preload.py. Set PRELOAD_APP to false
+to have every worker import the app itself.
+"""
+import os
+import gc
+
+preload_app = os.getenv("PRELOAD_APP", "true").lower() == "true"
+
+if preload_app:
+    # no collections while the app is imported, they leave holes in the pages the workers share
+    gc.disable()
+
+
+def when_ready(server):
+    """ Warms the preloaded app before the first worker is forked """
+    if preload_app:
+        from service import preload
+        preload.warm()
+
+
+def pre_fork(server, worker):
+    """ Closes the connections of the master and freezes its objects """
+    if preload_app:
+        from service import preload
+        preload.before_fork()
+
+
+def post_fork(server, worker):
+    """ Starts the collector and the log listener of a new worker """
+    if preload_app:
+        from service import preload
+        preload.after_fork()
@@ -8,24 +8,46 @@ import os
 import sys
 import logging
 from flask import Flask
+from werkzeug.middleware.proxy_fix import ProxyFix
 
 # Create Flask application
 app = Flask(__name__)
 app.config.from_object('config')
 
+# Take the client address from X-Forwarded-For, as set by the proxies in front
+if app.config['PROXY_X_FOR']:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_X_FOR'])
+
+# Tag every request with an id before any other hook runs
+from service import log
+log.init_request_ids(app)
+
+# Give every request a deadline before it touches the database
+from service import deadlines
+deadlines.init_deadlines(app)
+
+# Pick the tenant before the rate limits are charged to it
+from service import tenancy
+tenancy.init_tenants(app)
+
+# Route requests for one Supplier to the shard holding it
+from service import sharding
+sharding.init_sharding(app)
+
 # Import the rutes After the Flask app is created
-from service import service, models
+from service import service, models, encoding, snapshot, profiling, purge, jobs, migrations, swagger
+
+# Profiling hooks cost nothing when they are not registered
+if app.config['PROFILING_ENABLED']:
+    profiling.init_profiling(app)
 
 # Set up logging for production
 if __name__ != '__main__':
     gunicorn_logger = logging.getLogger('gunicorn.error')
-    app.logger.handlers = gunicorn_logger.handlers
     app.logger.setLevel(gunicorn_logger.level)
     app.logger.propagate = False
-    # Make all log formats consistent
-    formatter = logging.Formatter("[%(asctime)s] [%(levelname)s] [%(module)s] %(message)s", "%Y-%m-%d %H:%M:%S %z")
-    for handler in app.logger.handlers:
-        handler.setFormatter(formatter)
+    # Make all log formats consistent and write them off the request threads
+    log.configure_logging(app, gunicorn_logger.handlers)
     app.logger.info('Logging handler established')
 
 app.logger.info(70 * "*")
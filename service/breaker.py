@@ -0,0 +1,344 @@
+"""
+Database Circuit Breaker and Stale Responses
+
+When the database goes away every request used to wait on a dead
+connection and then fail with 500. The circuit breaker of each worker
+counts consecutive connection failures and opens after BREAKER_FAILURES of
+them: for the next BREAKER_RESET_SECONDS no statement is sent and no
+connection is opened, so requests fail at once instead of piling up. Then
+a single request is let through to probe the database; when it succeeds
+the breaker closes, when it fails the breaker stays open for another
+BREAKER_RESET_SECONDS. New connections give up after
+BREAKER_CONNECT_TIMEOUT seconds. Only lost or refused connections count:
+errors in a query, cancelled statements and constraint violations do not.
+
+The GET endpoints for Suppliers keep the last good response of every
+request in memory, up to STALE_CACHE_MAX_BYTES, per tenant. While the
+breaker is open, or when reading the database fails, the last response is
+returned with its Age and a "111 Revalidation Failed" Warning header;
+requests never answered before get 503 with Retry-After.
+
+Cached responses are only used during an outage unless
+STALE_MAX_AGE_SECONDS is set: then a response younger than that is served
+from memory, and for STALE_WHILE_REVALIDATE_SECONDS more it is still
+served, with a "110 Response is Stale" Warning, while a background thread
+reads it again.
+"""
+import time
+import queue
+import logging
+import threading
+from collections import OrderedDict
+from functools import wraps
+from flask import request, g, Response
+from flask_sqlalchemy import get_state
+from flask_restplus.utils import unpack
+from sqlalchemy import event, exc
+from sqlalchemy.engine import Engine
+from werkzeug.wrappers import BaseResponse
+from service.models import current_tenant
+from service.deadlines import DeadlineExceeded
+from service.workers import WorkerThread
+from . import app
+
+logger = logging.getLogger(__name__)
+
+# SQLSTATEs of a database that is going away or refusing connections
+OUTAGE_CODES = {'57P01', '57P02', '57P03', '53300'}
+
+STALE = '110 - "Response is Stale"'
+REVALIDATION_FAILED = '111 - "Revalidation Failed"'
+
+
+class DatabaseUnavailable(Exception):
+    """ Used when the circuit breaker keeps requests away from the database """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+######################################################################
+#  C I R C U I T   B R E A K E R
+######################################################################
+class CircuitBreaker():
+    """ Stops using the database after consecutive connection failures """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.opened_at = None  # when the breaker last opened, None while closed
+        self._probe = None  # (thread id, started) of the request trying the database
+
+    @property
+    def closed(self):
+        """ Is the database in use """
+        return self.opened_at is None
+
+    def retry_after(self):
+        """ Returns the seconds until the database is tried again """
+        if self.opened_at is None:
+            return 0
+        return max(0, self.opened_at + app.config['BREAKER_RESET_SECONDS'] - time.monotonic())
+
+    def allow(self):
+        """ May this thread use the database now
+
+        Once the breaker has been open for BREAKER_RESET_SECONDS the first
+        thread to ask becomes the probe and the others keep waiting
+        """
+        if self.opened_at is None:
+            return True
+        now = time.monotonic()
+        reset = app.config['BREAKER_RESET_SECONDS']
+        with self._lock:
+            if self.opened_at is None:
+                return True
+            if now - self.opened_at < reset:
+                return False
+            thread = threading.get_ident()
+            if self._probe is None or self._probe[0] == thread or now - self._probe[1] >= reset:
+                self._probe = (thread, now)
+                return True
+            return False
+
+    def succeeded(self):
+        """ Records a statement that reached the database """
+        if not self.failures and self.opened_at is None:
+            return
+        with self._lock:
+            if self.opened_at is not None:
+                logger.warning("Database is back, closing the circuit breaker")
+            self.failures = 0
+            self.opened_at = None
+            self._probe = None
+
+    def failed(self):
+        """ Records a lost or refused connection """
+        with self._lock:
+            self.failures += 1
+            probing = self.opened_at is not None
+            if probing or self.failures >= app.config['BREAKER_FAILURES']:
+                if not probing:
+                    logger.error("Opening the circuit breaker after %s database failures", self.failures)
+                self.opened_at = time.monotonic()
+                self._probe = None
+
+    def reset(self):
+        """ Closes the breaker and forgets the failures """
+        with self._lock:
+            self.failures = 0
+            self.opened_at = None
+            self._probe = None
+
+    def check(self):
+        """ Raises DatabaseUnavailable unless this thread may use the database """
+        if app.config['BREAKER_ENABLED'] and not self.allow():
+            raise DatabaseUnavailable("The database is unavailable", self.retry_after())
+
+
+breaker = CircuitBreaker()
+
+
+def is_outage(context):
+    """ Is the error of a handle_error event a lost or refused connection """
+    if context.is_disconnect:
+        return True
+    code = getattr(context.original_exception, 'pgcode', None)
+    if code is None:
+        # connection failures come without a SQLSTATE
+        return isinstance(context.sqlalchemy_exception, (exc.OperationalError, exc.InterfaceError))
+    return code.startswith('08') or code in OUTAGE_CODES
+
+
+@event.listens_for(Engine, 'do_connect')
+def guard_connect(dialect, connection_record, cargs, cparams):
+    """ Opens no connection while the breaker is open, and none that hangs """
+    breaker.check()
+    if dialect.name == 'postgresql':
+        # libpq's option, other drivers refuse it
+        cparams.setdefault('connect_timeout', app.config['BREAKER_CONNECT_TIMEOUT'])
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def guard_statement(conn, cursor, statement, parameters, context, executemany):
+    """ Sends no statement while the breaker is open """
+    breaker.check()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def statement_succeeded(conn, cursor, statement, parameters, context, executemany):
+    """ Closes the breaker once a statement gets through """
+    breaker.succeeded()
+
+
+@event.listens_for(Engine, 'handle_error')
+def statement_failed(context):
+    """ Counts lost and refused connections """
+    if app.config['BREAKER_ENABLED'] and is_outage(context):
+        breaker.failed()
+
+
+######################################################################
+#  S T A L E   R E S P O N S E S
+######################################################################
+class CachedResponse():
+    """ The last good response to a request
+
+    Args:
+        response (Response): the response to keep
+        headers (dict): the headers of the request, to read it again with
+    """
+
+    __slots__ = ('body', 'status', 'headers', 'request_headers', 'stored_at')
+
+    def __init__(self, response, headers):
+        self.body = response.get_data()
+        self.status = response.status_code
+        self.headers = list(response.headers.items())
+        self.request_headers = headers
+        self.stored_at = time.monotonic()
+
+    def age(self):
+        """ Returns the seconds since the response was stored """
+        return time.monotonic() - self.stored_at
+
+    def respond(self, warning=None):
+        """ Returns the response again with its age and a warning """
+        headers = self.headers + [('Age', str(int(self.age())))]
+        if warning:
+            headers.append(('Warning', warning))
+        return Response(self.body, status=self.status, headers=headers)
+
+
+class StaleCache():
+    """
+    Last good responses of the endpoints it serves
+
+    Args:
+        api (Api): the Api that renders the responses
+    """
+
+    # errors that a stale response is better than
+    STALE_IF_ERROR = (exc.OperationalError, exc.InterfaceError, DatabaseUnavailable, DeadlineExceeded)
+
+    def __init__(self, api):
+        self.api = api
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()  # least recently used first
+        self._size = 0
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._revalidator = WorkerThread(self._loop, 'stale-revalidate', self._lock)
+
+    def get(self, key):
+        """ Returns the CachedResponse of a key or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, response, headers):
+        """ Keeps a response, dropping the least recently used ones beyond STALE_CACHE_MAX_BYTES """
+        entry = CachedResponse(response, headers)
+        limit = app.config['STALE_CACHE_MAX_BYTES']
+        if len(entry.body) > limit:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self._size -= len(old.body)
+            self._entries[key] = entry
+            self._size += len(entry.body)
+            while self._size > limit:
+                _, dropped = self._entries.popitem(last=False)
+                self._size -= len(dropped.body)
+
+    def evict(self, tenant, path):
+        """ Forgets the responses of a path for a tenant, whatever their query or Accept """
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == tenant and key[1].split('?')[0] == path]:
+                self._size -= len(self._entries.pop(key).body)
+
+    def clear(self):
+        """ Forgets every response """
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def _render(self, result):
+        """ Turns what a Resource method returned into a Response """
+        if isinstance(result, BaseResponse):
+            return result
+        data, code, headers = unpack(result)
+        return self.api.make_response(data, code, headers=headers)
+
+    def serve(self, func):
+        """ Answers a GET with the last good response when the database cannot """
+        @wraps(func)
+        def wrapper(resource, *args, **kwargs):
+            if not app.config['BREAKER_ENABLED']:
+                return func(resource, *args, **kwargs)
+            key = (current_tenant(), request.full_path, request.headers.get('Accept'))
+            entry = None if g.get('revalidating') else self.get(key)
+            if entry is not None:
+                age = entry.age()
+                max_age = app.config['STALE_MAX_AGE_SECONDS']
+                if age < max_age:
+                    return entry.respond()
+                if not breaker.allow():
+                    return entry.respond(REVALIDATION_FAILED)
+                if breaker.closed and age < max_age + app.config['STALE_WHILE_REVALIDATE_SECONDS']:
+                    self._revalidate(key, entry)
+                    return entry.respond(STALE)
+            else:
+                breaker.check()
+            try:
+                response = self._render(func(resource, *args, **kwargs))
+            except self.STALE_IF_ERROR as error:
+                if entry is None:
+                    raise
+                logger.warning("Serving a stale response: %s", error)
+                try:
+                    get_state(app).db.session.rollback()
+                except exc.SQLAlchemyError:
+                    pass  # the connection is gone, the pool replaces it
+                return entry.respond(REVALIDATION_FAILED)
+            if response.status_code == 200:
+                self.put(key, response, dict(request.headers))
+            return response
+        return wrapper
+
+    #------------------------------------------------------------------
+    # REVALIDATION
+    #------------------------------------------------------------------
+    def _revalidate(self, key, entry):
+        """ Queues a key to be read again in the background, once """
+        self._revalidator.start(self._reset)
+        with self._lock:
+            if key in self._queued:
+                return
+            self._queued.add(key)
+        self._queue.put((key, entry.request_headers))
+
+    def _reset(self):
+        """ Forgets the keys queued in the parent of this process """
+        self._queue = queue.Queue()
+        self._queued = set()
+
+    def _loop(self):
+        """ Reads queued requests again through the app, which stores the new responses """
+        while True:
+            key, headers = self._queue.get()
+            _, path, _ = key
+            try:
+                if breaker.closed:
+                    with app.test_request_context(path, headers=headers):
+                        g.revalidating = True
+                        app.full_dispatch_request()
+            except Exception:
+                logger.exception("Could not revalidate %s", path)
+            finally:
+                with self._lock:
+                    self._queued.discard(key)
@@ -0,0 +1,230 @@
+"""
+Request Deadlines
+
+Every request gets a deadline: the timeout of its endpoint in
+ENDPOINT_TIMEOUTS, DEADLINE_DEFAULT_MS for the others, or sooner when the
+client sends DEADLINE_HEADER (X-Request-Timeout) with the milliseconds it
+is willing to wait. A client can shorten its deadline but not extend it.
+
+The deadline bounds the database work of the request:
+
+- each transaction starts with SET LOCAL statement_timeout to the time
+  left, so PostgreSQL stops a runaway query even when the worker is stuck
+- no statement is sent once the deadline has passed
+- a watchdog thread checks the running queries every DEADLINE_CHECK_MS and
+  cancels the one of a request whose deadline passed or whose client hung
+  up. Disconnects are only seen under gunicorn, which hands the socket of
+  the client to the app.
+
+A request that runs out of time gets 504 Gateway Timeout. One whose client
+went away is logged and answered 503, which nobody reads. Work that runs
+outside of a request, like jobs and the write-behind thread, has no
+deadline.
+"""
+import time
+import select
+import socket
+import logging
+import threading
+from flask import request, g, abort, has_request_context
+from flask_sqlalchemy import get_state
+from flask_api import status
+from sqlalchemy import event, text
+from sqlalchemy.engine import Engine
+from service import sharding
+from service.workers import WorkerThread
+from . import app
+
+logger = logging.getLogger(__name__)
+
+# milliseconds allowed by (endpoint, method), DEADLINE_DEFAULT_MS for the rest
+ENDPOINT_TIMEOUTS = {
+    ('supplier_collection', 'GET'): 30000,
+    ('supplier_lookup', 'POST'): 10000,
+    ('supplier_resource', 'GET'): 2000,
+    ('product_comparison', 'GET'): 5000,
+    ('supplier_price_stats', 'GET'): 15000,
+    ('snapshot_table_resource', 'GET'): 60000,
+}
+
+# endpoints that never have a deadline
+EXEMPT_ENDPOINTS = {'static', 'doc', 'specs', 'restplus_doc.static'}
+
+QUERY_CANCELED = '57014'  # the SQLSTATE of a cancelled or timed out statement
+
+
+class DeadlineExceeded(Exception):
+    """ Used when a request runs out of time """
+    pass
+
+
+class ClientDisconnected(Exception):
+    """ Used when the client of a request hung up before it finished """
+    pass
+
+
+class Deadline():
+    """
+    When a request has to be done by
+
+    Args:
+        timeout_ms (float): the milliseconds the request may take from now
+        client (socket): the connection of the client, None when not known
+    """
+
+    def __init__(self, timeout_ms, client=None):
+        self.timeout_ms = timeout_ms
+        self.at = time.monotonic() + timeout_ms / 1000.0
+        self.client = client
+        self.reason = None  # why the request was stopped
+
+    def remaining_ms(self):
+        """ Returns the milliseconds left, negative once passed """
+        return (self.at - time.monotonic()) * 1000
+
+    def check(self):
+        """ Returns why the request must stop, or None while it may go on """
+        if self.reason is None:
+            if self.remaining_ms() <= 0:
+                self.reason = 'deadline'
+            elif _client_gone(self.client):
+                self.reason = 'disconnected'
+        return self.reason
+
+    def error(self):
+        """ Returns the exception to stop the request with """
+        if self.reason == 'disconnected':
+            return ClientDisconnected("The client disconnected before the request finished")
+        return DeadlineExceeded("The request did not finish within {:.0f} ms".format(self.timeout_ms))
+
+
+def current_deadline():
+    """ Returns the deadline of the running request, None outside of one """
+    if not has_request_context():
+        return None
+    return g.get('deadline')
+
+
+def _client_gone(client):
+    """ Has the client closed its end of the connection """
+    if client is None:
+        return False
+    try:
+        readable, _, _ = select.select([client], [], [], 0)
+        # readable with nothing to read means the client closed it
+        return bool(readable) and not client.recv(1, socket.MSG_PEEK)
+    except ValueError:
+        return False  # closed on our side, the request is over
+    except OSError:
+        return True
+
+
+######################################################################
+#  W A T C H D O G
+######################################################################
+_running = {}  # thread id -> (deadline, DBAPI connection) of the statements being run
+_running_lock = threading.Lock()
+
+
+def _watch():
+    """ Cancels the statements of requests that must stop """
+    while True:
+        time.sleep(app.config['DEADLINE_CHECK_MS'] / 1000.0)
+        # under the lock, so a statement that already finished is never cancelled
+        with _running_lock:
+            for deadline, connection in list(_running.values()):
+                if deadline.reason is not None or deadline.check() is None:
+                    continue
+                logger.warning("Cancelling a query, the request %s",
+                               'passed its deadline' if deadline.reason == 'deadline'
+                               else 'lost its client')
+                try:
+                    connection.cancel()
+                except Exception:
+                    logger.exception("Could not cancel a query")
+
+
+# the statements of the parent of a forked worker are not its to cancel
+_watchdog = WorkerThread(_watch, 'deadline-watchdog', _running_lock)
+
+
+######################################################################
+#  D A T A B A S E   H O O K S
+######################################################################
+@event.listens_for(sharding.ShardedSession, 'after_begin')
+def limit_transaction(session, transaction, connection):
+    """ Makes PostgreSQL stop the statements of a transaction at the deadline """
+    deadline = current_deadline()
+    if deadline is not None:
+        connection.execute(text('SET LOCAL statement_timeout = {:d}'.format(
+            max(1, int(deadline.remaining_ms()))
+        )))
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def watch_statement(conn, cursor, statement, parameters, context, executemany):
+    """ Refuses statements past the deadline and hands the others to the watchdog """
+    deadline = current_deadline()
+    if deadline is None:
+        return
+    if deadline.reason is not None or deadline.remaining_ms() <= 0:
+        deadline.reason = deadline.reason or 'deadline'
+        raise deadline.error()
+    _watchdog.start(_running.clear)
+    with _running_lock:
+        _running[threading.get_ident()] = (deadline, conn.connection.connection)
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def forget_statement(conn, cursor, statement, parameters, context, executemany):
+    """ Takes a finished statement away from the watchdog """
+    if current_deadline() is not None:
+        with _running_lock:
+            _running.pop(threading.get_ident(), None)
+
+
+@event.listens_for(Engine, 'handle_error')
+def explain_cancel(context):
+    """ Turns a cancelled statement into the reason the request was stopped """
+    deadline = current_deadline()
+    if deadline is None:
+        return None
+    with _running_lock:
+        _running.pop(threading.get_ident(), None)
+    if getattr(context.original_exception, 'pgcode', None) != QUERY_CANCELED:
+        return None
+    deadline.reason = deadline.reason or 'deadline'  # statement_timeout ran out
+    return deadline.error()
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def init_deadlines(app):
+    """ Gives every request a deadline before it does any work """
+
+    @app.before_request
+    def set_deadline():
+        g.deadline = None
+        if not app.config['DEADLINES_ENABLED'] or request.endpoint in EXEMPT_ENDPOINTS:
+            return
+        timeout = ENDPOINT_TIMEOUTS.get((request.endpoint, request.method),
+                                        app.config['DEADLINE_DEFAULT_MS'])
+        asked = request.headers.get(app.config['DEADLINE_HEADER'])
+        if asked is not None:
+            try:
+                asked = float(asked)
+            except ValueError:
+                asked = 0
+            if not asked > 0:
+                abort(status.HTTP_400_BAD_REQUEST,
+                      "{} must be a positive number of milliseconds".format(app.config['DEADLINE_HEADER']))
+            timeout = min(timeout, asked)
+        g.deadline = Deadline(timeout, request.environ.get('gunicorn.socket'))
+
+    @app.teardown_request
+    def end_stopped_transaction(exception=None):
+        deadline = g.get('deadline')
+        if deadline is not None and deadline.reason is not None:
+            # the cancelled transaction is unusable and may still hold locks
+            get_state(app).db.session.rollback()
@@ -0,0 +1,120 @@
+"""
+Response Encoding
+
+Content negotiation for compact binary formats and compression of large
+responses. The codecs are optional: a format or encoding is only offered
+when its package is installed.
+
+Media types:
+------------
+application/json - the default representation
+application/msgpack - MessagePack (needs msgpack)
+application/vnd.apache.arrow.stream - Arrow IPC stream, one row per Supplier (needs pyarrow)
+
+Encodings:
+----------
+br - Brotli (needs brotli)
+gzip - always available
+"""
+import gzip
+import logging
+from flask import request, make_response
+from service.service import api
+from service.snapshot import to_ipc_stream, ARROW_MEDIATYPE
+from . import app
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+try:
+    import pyarrow
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+MSGPACK_MEDIATYPE = 'application/msgpack'
+
+COMPRESSIBLE_MEDIATYPES = {
+    'application/json',
+    'application/javascript',
+    'text/html',
+    'text/css',
+    'text/csv',
+    'text/plain',
+    MSGPACK_MEDIATYPE,
+    ARROW_MEDIATYPE,
+}
+
+######################################################################
+#  R E P R E S E N T A T I O N S
+######################################################################
+def _make_binary_response(body, mediatype, code, headers):
+    """ Builds a response from an encoded body """
+    resp = make_response(body, code)
+    resp.headers.extend(headers or {})
+    resp.headers['Content-Type'] = mediatype
+    return resp
+
+if msgpack:
+    @api.representation(MSGPACK_MEDIATYPE)
+    def output_msgpack(data, code, headers=None):
+        """ Encodes a marshalled response as MessagePack """
+        return _make_binary_response(
+            msgpack.packb(data, use_bin_type=True), MSGPACK_MEDIATYPE, code, headers
+        )
+
+if pyarrow:
+    @api.representation(ARROW_MEDIATYPE)
+    def output_arrow(data, code, headers=None):
+        """ Encodes a marshalled response as a columnar Arrow IPC stream """
+        rows = data if isinstance(data, list) else [data]
+        table = pyarrow.Table.from_pylist([dict(row) for row in rows])
+        return _make_binary_response(to_ipc_stream(table), ARROW_MEDIATYPE, code, headers)
+
+######################################################################
+#  C O M P R E S S I O N
+######################################################################
+def _gzip(data):
+    return gzip.compress(data, compresslevel=app.config['GZIP_LEVEL'])
+
+def _brotli(data):
+    return brotli.compress(data, quality=app.config['BROTLI_QUALITY'])
+
+# in order of preference when the client weighs them equally
+CODECS = {'gzip': _gzip}
+if brotli:
+    CODECS = {'br': _brotli, 'gzip': _gzip}
+
+
+@app.after_request
+def compress_response(response):
+    """ Compresses large responses with the best encoding the client accepts """
+    if not app.config['COMPRESSION_ENABLED']:
+        return response
+    if (
+            response.direct_passthrough
+            or response.status_code < 200
+            or response.status_code in (204, 304)
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MEDIATYPES
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(list(CODECS))
+    if not encoding:
+        return response
+    data = response.get_data()
+    if len(data) < app.config['COMPRESSION_MIN_SIZE']:
+        return response
+    response.set_data(CODECS[encoding](data))
+    response.headers['Content-Encoding'] = encoding
+    logger.debug("Compressed %s bytes to %s with %s", len(data), response.content_length, encoding)
+    return response
@@ -0,0 +1,189 @@
+"""
+Group Commit
+
+Every POST /api/suppliers commits its own transaction, and every commit
+waits for the database to flush its log to disk. With GROUP_COMMIT_ENABLED
+creates are handed to a committer thread of the worker instead: the
+creates that queue up while it commits one group make up the next one, up
+to GROUP_COMMIT_MAX_BATCH of them, and are inserted in a single
+transaction. GROUP_COMMIT_WINDOW_MS makes it wait that much longer for
+more creates after the first one.
+
+When a create fails the transaction is rolled back and run again with
+each create under a savepoint of its own, so only the request of the
+failed create gets the error, the others commit together and each
+request gets its own id.
+
+Requests wait for the commit of their group, so a window adds to the
+latency of every create and only pays off when commits are slow. Only
+Supplier.create() is grouped, and only when the request has no other
+changes pending that its own commit would have included.
+
+Groups only form from the requests a worker serves at the same time. The
+Procfile runs sync gunicorn workers, which serve one request at a time, so
+there every group is a single insert and the mode only adds the hand-off
+to the committer thread; it pays off with threaded workers (--threads).
+benchmarks/bench_groupcommit.py measures both.
+"""
+import queue
+import logging
+import time
+import threading
+from flask_sqlalchemy import get_state
+from service import sharding
+from service.workers import WorkerThread
+from . import app
+
+logger = logging.getLogger(__name__)
+
+
+class _Operation():
+    """ A unit of work waiting for its batch to commit
+
+    Args:
+        work (function): called with the session of the committer
+        shard (string): the shard it runs on, None for the main database
+    """
+
+    def __init__(self, work, shard):
+        self.work = work
+        self.shard = shard
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter():
+    """
+    Commits the work of concurrent requests in shared transactions
+
+    The settings are read from the app config when the committer starts,
+    on the first work it receives in a process
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._committer = WorkerThread(self._loop, 'group-commit', self._lock)
+        self._session = None
+        self.batches = 0
+        self.operations = 0
+
+    def submit(self, work, shard=None):
+        """
+        Runs work in the next group transaction and waits for it to commit
+
+        Args:
+            work (function): adds rows to the session it is called with and
+                returns the result of the operation
+            shard (string): the shard the rows go to, None for the main database
+        Returns:
+            the result of work once committed, or raises the error it or
+            the commit raised
+        """
+        self.start()
+        operation = _Operation(work, shard)
+        self._queue.put(operation)
+        operation.done.wait()
+        if operation.error is not None:
+            raise operation.error
+        return operation.result
+
+    def _next_batch(self):
+        """ Waits for work and returns what arrives within the window, None once stopped """
+        operation = self._queue.get()
+        if operation is None:
+            return None
+        batch = [operation]
+        deadline = time.monotonic() + app.config['GROUP_COMMIT_WINDOW_MS'] / 1000.0
+        while len(batch) < app.config['GROUP_COMMIT_MAX_BATCH']:
+            remaining = deadline - time.monotonic()
+            try:
+                operation = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if operation is None:
+                self._queue.put(None)  # stop once this batch is committed
+                break
+            batch.append(operation)
+        return batch
+
+    def _commit(self, batch):
+        """ Commits a batch, one transaction per shard it touches """
+        shards = {}
+        for operation in batch:
+            shards.setdefault(operation.shard, []).append(operation)
+        for shard, operations in shards.items():
+            with sharding.shard_scope(shard):
+                try:
+                    self._run(operations)
+                except Exception as error:
+                    self._session.rollback()
+                    logger.exception("Could not commit a group of %s", len(operations))
+                    for operation in operations:
+                        operation.error = operation.error or error
+                finally:
+                    # the rows go back to the requests, which load them in their own sessions
+                    self._session.expunge_all()
+            for operation in operations:
+                operation.done.set()
+        self.batches += 1
+        self.operations += len(batch)
+        logger.debug("Committed %s operations in one group", len(batch))
+
+    def _run(self, operations):
+        """ Runs operations in one transaction, isolating the ones that fail """
+        try:
+            for operation in operations:
+                operation.result = operation.work(self._session)
+            self._session.commit()
+            return
+        except Exception as error:
+            self._session.rollback()
+            if len(operations) == 1:
+                operations[0].error = error
+                return
+        # run them again, each under a savepoint so a failure only undoes its own rows
+        for operation in operations:
+            try:
+                with self._session.begin_nested():
+                    operation.result = operation.work(self._session)
+            except Exception as error:
+                operation.error = error
+        self._session.commit()
+
+    ######################################################################
+    #  B A C K G R O U N D   T H R E A D
+    ######################################################################
+    def start(self):
+        """ Starts the committer thread of this process, once """
+        self._committer.start(self._reset)
+
+    def _reset(self):
+        """ Forgets the work queued in the parent of this process """
+        self._queue = queue.Queue()
+
+    def stop(self):
+        """ Commits the work already queued and stops the thread """
+        if not self._committer.running():
+            return
+        self._queue.put(None)
+        self._committer.join()
+
+    def _loop(self):
+        """ Commits batches until stopped """
+        with app.app_context():
+            # rows keep their values after the commit, the requests still read them
+            self._session = get_state(app).db.create_session({'expire_on_commit': False})()
+            try:
+                while True:
+                    batch = self._next_batch()
+                    if batch is None:
+                        break
+                    self._commit(batch)
+            finally:
+                self._session.close()
+
+
+# the committer of this worker
+committer = GroupCommitter()
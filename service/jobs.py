@@ -0,0 +1,260 @@
+"""
+Background Jobs
+
+Bulk imports, snapshots and purges take minutes, far longer than a
+request should hold a gunicorn worker. The endpoints that start them only
+queue a Job and answer 202 Accepted with its URL, and the job is run by a
+worker process:
+
+  flask jobs work --concurrency 4
+
+The queue is the Job table of the main database. Each worker runs at most
+JOB_CONCURRENCY jobs at once, claiming them with SELECT ... FOR UPDATE SKIP
+LOCKED so any number of workers share the queue. A claimed job is leased
+for JOB_LEASE_SECONDS and the lease is extended whenever it reports
+progress, so the job of a worker that died is claimed again. A job that
+raises is retried JOB_MAX_ATTEMPTS times, waiting JOB_RETRY_SECONDS and
+twice as long after each attempt, and a lease that runs out counts as an
+attempt too: a job whose worker died on its last one fails.
+
+Handlers are registered by kind and get the Job, whose params hold what
+the request asked for:
+
+    @jobs.handler('purge')
+    def purge_job(job):
+        ...
+        jobs.progress(job, done, total)
+        return result
+
+The tests run the queue in-process with Worker().run_pending().
+"""
+import json
+import signal
+import logging
+import threading
+import click
+from service.models import db, Job, Supplier, tenant_scope
+from service import sharding
+from . import app
+
+logger = logging.getLogger(__name__)
+
+HANDLERS = {}
+
+
+class JobError(Exception):
+    """ Used when a job cannot be queued """
+    pass
+
+
+def handler(kind):
+    """ Registers the function that runs the jobs of a kind """
+
+    def register(function):
+        HANDLERS[kind] = function
+        return function
+
+    return register
+
+
+def enqueue(kind, params=None):
+    """
+    Queues a job for the workers
+
+    Args:
+        kind (string): the kind of job, one with a registered handler
+        params (dict): the JSON parameters passed to the handler
+    Returns:
+        Job: the queued job
+    Raises:
+        JobError: when no handler runs jobs of this kind
+    """
+    if kind not in HANDLERS:
+        raise JobError("There is no job kind '{}'.".format(kind))
+    return Job.enqueue(kind, params, app.config['JOB_MAX_ATTEMPTS'])
+
+
+def progress(job, done, total=None):
+    """ Saves the work a job did so far together with its progress """
+    sharding.set_shard(None)
+    job.report(done, total, app.config['JOB_LEASE_SECONDS'])
+
+
+def run_job(job):
+    """ Runs a claimed job in the tenant it was queued for and records the outcome """
+    logger.info("Running job %s %s, attempt %s", job.id, job.kind, job.attempts)
+    try:
+        with tenant_scope(job.tenant):
+            result = HANDLERS[job.kind](job)
+    except Exception as error:
+        logger.exception("Job %s %s failed", job.id, job.kind)
+        db.session.rollback()
+        sharding.set_shard(None)
+        job.fail(str(error) or error.__class__.__name__, app.config['JOB_RETRY_SECONDS'])
+        return
+    sharding.set_shard(None)
+    job.finish(result)
+    logger.info("Job %s %s done", job.id, job.kind)
+
+
+######################################################################
+#  W O R K E R
+######################################################################
+class Worker():
+    """
+    Runs queued jobs on a pool of threads
+
+    Args:
+        concurrency (int): the most jobs run at once, JOB_CONCURRENCY by default
+        kinds (list): the kinds of job to run, all when None
+    """
+
+    def __init__(self, concurrency=None, kinds=None):
+        self.concurrency = concurrency or app.config['JOB_CONCURRENCY']
+        self.kinds = kinds
+        self._stopping = threading.Event()
+        self._threads = []
+
+    def run_once(self):
+        """ Claims and runs the next job that is due
+
+        Returns:
+            Job: the job that ran or None if none was due
+        """
+        job = Job.claim(app.config['JOB_LEASE_SECONDS'], self.kinds)
+        if job is None:
+            return None
+        run_job(job)
+        return job
+
+    def run_pending(self):
+        """ Runs the jobs that are due on this thread until none are left
+
+        Returns:
+            int: the number of jobs that ran
+        """
+        count = 0
+        while self.run_once() is not None:
+            count += 1
+        return count
+
+    def start(self):
+        """ Starts the threads that run jobs """
+        self._stopping.clear()
+        for index in range(self.concurrency):
+            thread = threading.Thread(
+                target=self._loop, name='job-worker-{}'.format(index), daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop_soon(self):
+        """ Asks the threads to stop after the jobs they are running """
+        self._stopping.set()
+
+    def wait(self):
+        """ Blocks until the worker is asked to stop """
+        while not self._stopping.wait(1):
+            pass
+
+    def stop(self, timeout=None):
+        """ Stops the threads, waiting for the jobs they are running """
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    def _loop(self):
+        """ Runs jobs until stopped, waiting JOB_POLL_SECONDS when none are due """
+        with app.app_context():
+            try:
+                while not self._stopping.is_set():
+                    try:
+                        job = self.run_once()
+                    except Exception:
+                        logger.exception("Could not claim a job")
+                        db.session.rollback()
+                        job = None
+                    if job is None:
+                        self._stopping.wait(app.config['JOB_POLL_SECONDS'])
+            finally:
+                db.session.remove()
+
+
+######################################################################
+#  H A N D L E R S
+######################################################################
+@handler('import_suppliers')
+def import_suppliers(job):
+    """ Creates the Suppliers of a bulk import, JOB_IMPORT_BATCH per transaction
+
+    Each batch is committed with the progress of the job, so a retry
+    starts after the last batch that was saved. With sharding a batch is
+    committed on each shard and in the main database one after the other,
+    so the ids of the Suppliers are picked and saved with the job before
+    the first batch, and a retry skips the ones a shard already holds
+    """
+    payloads = job.params['suppliers']
+    batch_size = app.config['JOB_IMPORT_BATCH']
+    if sharding.enabled() and 'supplier_ids' not in job.params:
+        ids = [sharding.next_id(Supplier.__tablename__) for _ in payloads]
+        job.params = dict(job.params, supplier_ids=ids)
+    ids = job.params.get('supplier_ids')
+    progress(job, job.done, len(payloads))
+    for start in range(job.done, len(payloads), batch_size):
+        batch = range(start, min(start + batch_size, len(payloads)))
+        saved = _saved_suppliers([ids[i] for i in batch]) if ids else set()
+        for i in batch:
+            if ids and ids[i] in saved:
+                continue
+            supplier = Supplier()
+            supplier.deserialize(payloads[i])
+            supplier.stage(ids[i] if ids else None)
+        progress(job, batch.stop, len(payloads))
+    return {'created': len(payloads)}
+
+
+def _saved_suppliers(supplier_ids):
+    """ Returns the ids of the Suppliers the shards already hold """
+    saved = set()
+    for group in sharding.by_shard(supplier_ids):
+        saved.update(row.id for row in db.session.query(Supplier.id).filter(Supplier.id.in_(group)))
+    return saved
+
+
+######################################################################
+#  C O M M A N D   L I N E
+######################################################################
+@app.cli.group('jobs')
+def jobs_command():
+    """ Runs and queues background jobs """
+
+
+@jobs_command.command('work')
+@click.option('--concurrency', type=int, default=None, help='Jobs run at once')
+@click.option('--kind', 'kinds', multiple=True, help='Only run jobs of this kind')
+def work_command(concurrency, kinds):
+    """ Runs queued jobs until stopped """
+    worker = Worker(concurrency, list(kinds) or None)
+    signal.signal(signal.SIGTERM, lambda signum, frame: worker.stop_soon())
+    worker.start()
+    click.echo("Running jobs on {} threads".format(worker.concurrency))
+    try:
+        worker.wait()
+    except KeyboardInterrupt:
+        pass
+    worker.stop()
+
+
+@jobs_command.command('enqueue')
+@click.argument('kind')
+@click.option('--params', default='{}', help='The job parameters as JSON')
+@click.option('--tenant', default=None, help='The tenant the job works for')
+def enqueue_command(kind, params, tenant):
+    """ Queues a job """
+    with tenant_scope(tenant):
+        try:
+            job = enqueue(kind, json.loads(params))
+        except (JobError, ValueError) as error:
+            raise click.ClickException(str(error))
+    click.echo("Job {} queued".format(job.id))
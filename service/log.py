@@ -0,0 +1,199 @@
+"""
+Structured, Sampled Logging
+
+Sets up the logging pipeline of the service:
+
+- every record is tagged with the id of the request that produced it, taken
+  from the X-Request-Id header or generated, and echoed on the response
+- records below WARNING can be sampled per logger with LOG_SAMPLE_RATES,
+  e.g. {"service.models": 0.01}; a request is either sampled or not for
+  every logger with the same rate, so sampled requests keep all their lines
+- records go onto a bounded in-memory queue and are formatted and written
+  by a background thread, so the request thread never waits on I/O; when
+  the queue is full records are dropped and counted instead of blocking
+- LOG_FORMAT selects plain text or one JSON object per line
+
+The hot paths of the models log at DEBUG, which costs next to nothing at
+the default INFO level.
+"""
+import json
+import queue
+import atexit
+import random
+import logging
+import zlib
+from uuid import uuid4
+from logging.handlers import QueueHandler, QueueListener
+from flask import request, g, has_request_context
+
+TEXT_FORMAT = "[%(asctime)s] [%(levelname)s] [%(module)s] [%(request_id)s] %(message)s"
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S %z"
+
+_pipeline = None  # (queue handler, listener) of the last configure_logging
+
+
+######################################################################
+#  F I L T E R S   A N D   F O R M A T T E R S
+######################################################################
+class RequestIdFilter(logging.Filter):
+    """ Tags records with the id of the current request, or '-' outside one """
+
+    def filter(self, record):
+        if not hasattr(record, 'request_id'):
+            record.request_id = g.get('request_id', '-') if has_request_context() else '-'
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Keeps a fraction of the records below WARNING of each logger
+
+    Args:
+        rates (dict): the fraction to keep by logger name; a rate applies to
+            the logger and all of its children unless they have their own
+    """
+
+    def __init__(self, rates):
+        super().__init__()
+        self.rates = dict(rates)
+        self._resolved = {}
+
+    def rate(self, name):
+        """ Returns the sample rate of a logger """
+        rate = self._resolved.get(name)
+        if rate is None:
+            prefix = name
+            while prefix and prefix not in self.rates:
+                prefix = prefix.rpartition('.')[0]
+            rate = self._resolved[name] = self.rates.get(prefix, 1.0)
+        return rate
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        rate = self.rate(record.name)
+        if rate >= 1.0:
+            return True
+        request_id = getattr(record, 'request_id', '-')
+        if request_id == '-':
+            return random.random() < rate
+        # decide once per request so sampled requests are complete
+        return zlib.crc32(request_id.encode('utf8')) % 10000 < rate * 10000
+
+
+class JsonFormatter(logging.Formatter):
+    """ Formats a record as one JSON object per line """
+
+    def format(self, record):
+        document = {
+            "ts": self.formatTime(record, DATE_FORMAT),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "request_id": getattr(record, 'request_id', '-'),
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            document["exc"] = self.formatException(record.exc_info)
+        return json.dumps(document, default=str)
+
+
+class DroppingQueueHandler(QueueHandler):
+    """ Queues records without ever blocking, dropping them when full """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # merge the arguments now, they may change once the request moves on;
+        # formatting is left to the listener thread
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+######################################################################
+#  S E T U P
+######################################################################
+def formatter_for(config):
+    """ Returns the formatter selected by LOG_FORMAT """
+    if config['LOG_FORMAT'] == 'json':
+        return JsonFormatter()
+    return logging.Formatter(TEXT_FORMAT, DATE_FORMAT)
+
+
+def configure_logging(app, handlers):
+    """
+    Routes the app logger through the sampling queue to the given handlers
+
+    Args:
+        app (Flask): the application whose logger is configured
+        handlers (list): the handlers that finally write the records
+    Returns:
+        QueueListener: the running listener, or None when LOG_QUEUE_ENABLED is off
+    """
+    global _pipeline
+    formatter = formatter_for(app.config)
+    for handler in handlers:
+        # the handlers may be shared with loggers outside the app, like gunicorn's
+        handler.setFormatter(formatter)
+        handler.addFilter(RequestIdFilter())
+
+    listener = _pipeline = None
+    if app.config['LOG_QUEUE_ENABLED']:
+        front = DroppingQueueHandler(queue.Queue(app.config['LOG_QUEUE_SIZE']))
+        # tag the request id on the request thread, the listener has no context
+        front.addFilter(RequestIdFilter())
+        listener = QueueListener(front.queue, *handlers, respect_handler_level=True)
+        listener.start()
+        atexit.register(_stop, listener)
+        _pipeline = (front, listener)
+        front_handlers = [front]
+    else:
+        front_handlers = list(handlers)
+
+    if app.config['LOG_SAMPLE_RATES']:
+        sampler = SamplingFilter(app.config['LOG_SAMPLE_RATES'])
+        for handler in front_handlers:
+            handler.addFilter(sampler)
+    app.logger.handlers = front_handlers
+    return listener
+
+
+def _stop(listener):
+    """ Flushes a listener at exit unless it was already stopped """
+    if listener._thread is not None:  # pylint: disable=protected-access
+        listener.stop()
+
+
+def restart_listener():
+    """ Starts the listener thread again in a forked worker, where the copy has none """
+    if _pipeline is None:
+        return
+    front, listener = _pipeline
+    # the thread of the parent may have held the queue's lock when it forked,
+    # and the records still queued are the parent's to write
+    front.queue = listener.queue = queue.Queue(front.queue.maxsize)
+    listener._thread = None  # pylint: disable=protected-access
+    listener.start()
+
+
+def init_request_ids(app):
+    """ Assigns every request an id and returns it on the response """
+
+    @app.before_request
+    def assign_request_id():
+        g.request_id = request.headers.get('X-Request-Id') or uuid4().hex
+
+    @app.after_request
+    def echo_request_id(response):
+        if 'request_id' in g:
+            response.headers['X-Request-Id'] = g.request_id
+        return response
@@ -0,0 +1,233 @@
+"""
+Schema Migrations
+
+db.create_all() creates missing tables but never changes the ones that
+already exist. Changes to tables that already hold rows are made by the
+steps below, on the main database and on every shard. Each step checks
+whether it is still needed, so running them again is harmless:
+
+  flask migrate
+
+The steps start from the schema of the first release, whose Supplier and
+Product tables had no tenant, timestamps or composite keys. The tables
+created since reference those keys, so db.create_all() runs the first step
+itself before it creates any table, and a database of any age can be
+opened by the app, flask migrate included.
+
+Steps lock the tables they change while they run, so run them before the
+new code is deployed and outside of busy hours. The first one copies the
+catalog into new tables, which takes as long as a dump and reload of it.
+The price history is partitioned by month and flask migrate also creates
+the partitions of the coming months, so schedule it once a month.
+"""
+import logging
+import click
+from sqlalchemy import inspect, event, Boolean
+from sqlalchemy.schema import AddConstraint
+from service.models import db, Supplier, Product, BestOffer, PriceHistory, DEFAULT_TENANT
+from service import sharding
+from . import app
+
+logger = logging.getLogger(__name__)
+
+STEPS = []
+
+
+def step(function):
+    """ Registers a migration step, steps run in the order they are registered """
+    STEPS.append(function)
+    return function
+
+
+@step
+def partition_by_tenant(connection):
+    """ Moves Suppliers and Products of the days before tenants into partitioned tables
+
+    The old tables are renamed out of the way, the new ones created and
+    the rows copied into the default tenant, with the columns added since
+    filled in. Tables that referenced the old ones get a tenant column and
+    the composite foreign keys.
+
+    Returns:
+        boolean: True if the tables were moved
+    """
+    if connection.dialect.name != 'postgresql':
+        return False
+    tables = (Supplier.__table__, Product.__table__)
+    kinds = dict(connection.execute(
+        "SELECT relname, relkind FROM pg_class WHERE relname IN ('Supplier', 'Product') "
+        "AND pg_table_is_visible(oid)"
+    ).fetchall())
+    if not kinds or all(kind == 'p' for kind in kinds.values()):
+        return False
+    inspector = inspect(connection)
+    existing = inspector.get_table_names()
+    # the keys, indexes and sequences of the old tables would take the names of the new ones
+    for name in existing:
+        for key in inspector.get_foreign_keys(name):
+            if name in kinds or key['referred_table'] in kinds:
+                connection.execute('ALTER TABLE "{}" DROP CONSTRAINT "{}"'.format(name, key['name']))
+    for table in tables:
+        old = table.name + '_before_tenants'
+        for index in inspector.get_indexes(table.name):
+            connection.execute('DROP INDEX "{}"'.format(index['name']))
+        connection.execute('ALTER TABLE "{}" DROP CONSTRAINT "{}"'.format(
+            table.name, inspector.get_pk_constraint(table.name)['name']))
+        connection.execute('ALTER TABLE "{}" RENAME TO "{}"'.format(table.name, old))
+        sequence = connection.execute(
+            "SELECT pg_get_serial_sequence('\"{}\"', 'id')".format(old)).scalar()
+        if sequence:
+            connection.execute('ALTER TABLE "{}" ALTER COLUMN id DROP DEFAULT'.format(old))
+            connection.execute('DROP SEQUENCE {}'.format(sequence))
+    for table in tables:
+        old = table.name + '_before_tenants'
+        columns = {column['name']: column for column in inspector.get_columns(old)}
+        table.create(connection)
+        names, values = [], []
+        for column in table.columns:
+            if column.name == 'tenant':
+                value = "'{}'".format(DEFAULT_TENANT)
+            elif column.name == 'updated_at' and column.name not in columns:
+                value = "timezone('utc', now())"
+            elif column.name == 'preferred' and not isinstance(columns['preferred']['type'], Boolean):
+                value = "coalesce(lower(preferred) IN ('true', 't', '1', 'yes'), false)"
+            elif column.name in columns:
+                value = '"{}"'.format(column.name)
+            else:
+                continue
+            names.append('"{}"'.format(column.name))
+            values.append(value)
+        connection.execute('INSERT INTO "{}" ({}) SELECT {} FROM "{}"'.format(
+            table.name, ', '.join(names), ', '.join(values), old))
+        connection.execute(
+            "SELECT setval(pg_get_serial_sequence('\"{0}\"', 'id'), coalesce(max(id), 0) + 1, false) "
+            'FROM "{0}"'.format(table.name))
+    for table in reversed(tables):
+        connection.execute('DROP TABLE "{}_before_tenants"'.format(table.name))
+    for table in db.metadata.sorted_tables:
+        if table in tables or table.name not in existing or 'tenant' not in table.c:
+            continue
+        if 'tenant' not in {column['name'] for column in inspector.get_columns(table.name)}:
+            connection.execute(
+                'ALTER TABLE "{}" ADD COLUMN tenant varchar(63) NOT NULL DEFAULT \'{}\''.format(
+                    table.name, DEFAULT_TENANT))
+            connection.execute('ALTER TABLE "{}" ALTER COLUMN tenant DROP DEFAULT'.format(table.name))
+        for key in table.foreign_key_constraints:
+            if key.referred_table in tables:
+                connection.execute(AddConstraint(key))
+    return True
+
+
+@event.listens_for(db.metadata, 'before_create')
+def tables_before_tenants(metadata, connection, **kw):
+    """ Moves the catalog of an older database before create_all adds the tables referencing it """
+    with connection.begin():
+        moved = partition_by_tenant(connection)
+    if moved:
+        logger.warning("Moved the Suppliers and Products into the tables partitioned by tenant")
+
+
+@step
+def preferred_to_boolean(connection):
+    """ Turns Supplier.preferred from a string into a boolean with a partial index
+
+    For databases that got tenants while preferred was still a string, the
+    ones of the first release are converted by partition_by_tenant
+
+    Returns:
+        boolean: True if the column was changed
+    """
+    columns = {column['name']: column for column in inspect(connection).get_columns('Supplier')}
+    if isinstance(columns['preferred']['type'], Boolean):
+        return False
+    connection.execute(
+        'ALTER TABLE "Supplier" '
+        "ALTER COLUMN preferred TYPE boolean "
+        "USING coalesce(lower(preferred) IN ('true', 't', '1', 'yes'), false), "
+        "ALTER COLUMN preferred SET DEFAULT false, "
+        "ALTER COLUMN preferred SET NOT NULL"
+    )
+    for index in Supplier.__table__.indexes:
+        if index.name == 'ix_Supplier_preferred_active':
+            index.create(connection)
+    return True
+
+
+@step
+def sort_indexes(connection):
+    """ Replaces the name and category indexes with the (tenant, <sort>, id) ones
+
+    Returns:
+        boolean: True if an index was created or dropped
+    """
+    existing = {row.indexname for row in connection.execute(
+        "SELECT indexname FROM pg_indexes WHERE tablename = 'Supplier'"
+    )}
+    changed = False
+    for name in ('ix_Supplier_name_active', 'ix_Supplier_category_active'):
+        if name in existing:
+            connection.execute('DROP INDEX "{}"'.format(name))
+            changed = True
+    for index in Supplier.__table__.indexes:
+        if index.name.endswith('_id_active') and index.name not in existing:
+            index.create(connection)
+            changed = True
+    return changed
+
+
+@step
+def best_offers(connection):
+    """ Installs or removes the trigger filling BestOffer as BEST_OFFERS_ENABLED asks
+
+    Returns:
+        boolean: True if the trigger was installed or removed
+    """
+    if BestOffer.installed(connection) == app.config['BEST_OFFERS_ENABLED']:
+        return False
+    if app.config['BEST_OFFERS_ENABLED']:
+        BestOffer.install(connection)
+    else:
+        BestOffer.uninstall(connection)
+    return True
+
+
+@step
+def price_partitions(connection):
+    """ Creates the PriceHistory partitions of the next PRICE_PARTITIONS_AHEAD months
+
+    Run flask migrate every month so prices never go to the default partition
+
+    Returns:
+        boolean: True if a partition was created
+    """
+    return bool(PriceHistory.add_partitions(connection, app.config['PRICE_PARTITIONS_AHEAD']))
+
+
+def migrate():
+    """
+    Runs every step that is still needed, each database in one transaction
+
+    Returns:
+        list: the names of the steps that changed something
+    """
+    applied = []
+    for engine in sharding.engines():
+        with engine.begin() as connection:
+            for function in STEPS:
+                if function(connection):
+                    logger.info("Migrated %s with %s", engine.url.database, function.__name__)
+                    applied.append(function.__name__)
+    return applied
+
+
+######################################################################
+#  C O M M A N D   L I N E
+######################################################################
+@app.cli.command('migrate')
+def migrate_command():
+    """ Brings the tables of existing databases up to date """
+    applied = migrate()
+    for name in applied:
+        click.echo("{} applied".format(name))
+    if not applied:
+        click.echo("Nothing to migrate")
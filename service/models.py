@@ -4,18 +4,70 @@ Models for Supplier
 All of the models are stored in this module
 """
 import logging
-from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.orm import relationship
+import threading
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from sqlalchemy import event, DDL
+from sqlalchemy.orm import relationship, selectinload
+from service.schema import validate_supplier, validate_product
+from service import sharding, groupcommit
+from . import app
 
 
-logger = logging.getLogger("flask.app")
+logger = logging.getLogger(__name__)
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = sharding.ShardedSQLAlchemy()
+
+# Suppliers and Products belong to the tenant that was current when created
+DEFAULT_TENANT = 'default'
+_tenant = threading.local()
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
-    pass
+
+    def __init__(self, *args, errors=None):
+        super().__init__(*args)
+        self.errors = errors or []
+
+
+class ReservationError(Exception):
+    """ Used when stock cannot be reserved or released """
+
+    def __init__(self, message, not_found=False):
+        super().__init__(message)
+        self.not_found = not_found
+
+
+def current_tenant():
+    """ Returns the tenant the running request or job works for """
+    return getattr(_tenant, 'name', None) or DEFAULT_TENANT
+
+
+def set_tenant(name):
+    """ Makes a tenant current on this thread, None for the default one """
+    _tenant.name = name
+
+
+@contextmanager
+def tenant_scope(name):
+    """ Makes a tenant current on this thread for a block """
+    previous = getattr(_tenant, 'name', None)
+    _tenant.name = name
+    try:
+        yield name
+    finally:
+        _tenant.name = previous
+
+
+def _partition_by_tenant(table):
+    """ Gives a table partitioned by tenant a default partition on PostgreSQL
+
+    Tenants share the default partition until they get their own
+    """
+    event.listen(table, 'after_create', DDL(
+        'CREATE TABLE "{0}_default" PARTITION OF "{0}" DEFAULT'.format(table.name)
+    ).execute_if(dialect='postgresql'))
 
 ######################################################################
 #  P E R S I S T E N T   B A S E   M O D E L
@@ -26,12 +78,47 @@ class PersistentBase():
     def create(self):
         """
         Creates a Supplier to the database
+
+        With GROUP_COMMIT_ENABLED the insert is committed together with the
+        creates of other requests, unless this request has changes pending
         """
         logger.info("Creating %s", self.name)
-        self.id = None  # id must be none to generate next primary key
-        db.session.add(self)
+        session = db.session
+        if app.config['GROUP_COMMIT_ENABLED'] and not (session.new or session.dirty or session.deleted):
+            self._create_in_group()
+            return
+        self.stage()
         db.session.commit()
 
+    def _create_in_group(self):
+        """ Inserts the row in the next group commit and adds it back to this session """
+        self.id = None
+        self._place()
+        tenant = current_tenant()
+
+        def insert(session):
+            with tenant_scope(tenant):
+                session.add(self)
+                session.flush()
+
+        groupcommit.committer.submit(insert, sharding.current_shard())
+        db.session.add(self)
+
+    def stage(self, new_id=None):
+        """ Adds a new row to the running transaction without committing it
+
+        Args:
+            new_id (int): the id to insert the row with, a new one when None
+        """
+        self.id = new_id  # id must be none to generate next primary key
+        self._place()
+        db.session.add(self)
+        db.session.flush()  # while the shard it was placed on is current
+
+    def _place(self):
+        """ Chooses where a new row goes before it is added """
+        pass
+
     def save(self):
         """
         Updates a Supplier to the database
@@ -40,11 +127,92 @@ class PersistentBase():
         db.session.commit()
 
     def delete(self):
-        """ Removes a Supplier from the data store """
+        """ Soft deletes a Supplier, purge() removes the row later """
         logger.info("Deleting %s", self.name)
-        db.session.delete(self)
+        now = datetime.utcnow()
+        self.deleted_at = now
+        self._delete_children(now)
+        # leave a tombstone behind so delta sync clients learn about the delete
+        db.session.add(Tombstone(
+            resource=self.__tablename__, resource_id=self.id, tenant=self.tenant
+        ))
         db.session.commit()
-    
+
+    def _delete_children(self, now):
+        """ Soft deletes the rows that belong to this one """
+        pass
+
+    @classmethod
+    def scoped(cls):
+        """ Returns a query of the rows of the current tenant """
+        return cls.query.filter(cls.tenant == current_tenant())
+
+    @classmethod
+    def active(cls):
+        """ Returns a query of the rows of the current tenant that are not soft deleted """
+        return cls.scoped().filter(cls.deleted_at.is_(None))
+
+    @classmethod
+    def purge(cls, older_than, batch_size=1000):
+        """ Removes rows soft deleted before a timestamp for good
+
+        Rows are deleted in batches of at most batch_size, each in its own
+        short transaction, so a large cleanup never holds many locks or
+        loads the rows into memory. Rows locked by a running request are
+        skipped and picked up by the next purge.
+
+        Args:
+            older_than (datetime): the naive UTC timestamp to compare against
+            batch_size (int): the most rows deleted per transaction
+        Returns:
+            int: the number of rows removed
+        """
+        table = cls.__table__
+        total = 0
+        while True:
+            ids = [row.id for row in db.session.execute(
+                db.select([table.c.id])
+                .where(table.c.deleted_at < older_than)
+                .order_by(table.c.id)
+                .limit(batch_size)
+                .with_for_update(skip_locked=True)
+            )]
+            if not ids:
+                db.session.commit()
+                return total
+            cls._purge_dependents(ids)
+            db.session.execute(table.delete().where(table.c.id.in_(ids)))
+            db.session.commit()
+            total += len(ids)
+            logger.info("Purged %s %s rows", total, cls.__tablename__)
+
+    @classmethod
+    def _purge_dependents(cls, ids):
+        """ Deletes the rows that reference the rows about to be purged """
+        pass
+
+
+    @classmethod
+    def _update_returning(cls, statement, *relationships):
+        """ Runs an UPDATE ... RETURNING, commits and returns the updated object
+
+        The object and the relationships loaded with it are detached before
+        the commit, so they can be serialized without reading the row again
+
+        Returns:
+            the updated object or None if no row matched
+        """
+        result = db.session.execute(statement)
+        found = next(db.session.query(cls).populate_existing().instances(result), None)
+        if found is not None:
+            for name in relationships:
+                # load them while the row is still in this transaction
+                for child in getattr(found, name):
+                    db.session.expunge(child)
+            db.session.expunge(found)
+        db.session.commit()
+        return found
+
     @classmethod
     def init_db(cls, app):
         """ Initializes the database session """
@@ -54,24 +222,72 @@ class PersistentBase():
         db.init_app(app)
         app.app_context().push()
         db.create_all()  # make our sqlalchemy tables
+        if sharding.enabled():
+            sharding.create_all()
 
     @classmethod
     def all(cls):
         """ Returns all of the Supplier in the database """
-        logger.info("Processing all Supplier")
-        return cls.query.all()
+        logger.debug("Processing all Supplier")
+        return cls.active().all()
 
     @classmethod
     def find(cls, by_id):
         """ Finds a Supplier by it's ID """
-        logger.info("Processing lookup for id %s ...", by_id)
-        return cls.query.get(by_id)
+        logger.debug("Processing lookup for id %s ...", by_id)
+        return cls.active().filter(cls.id == by_id).first()
 
     @classmethod
     def find_or_404(cls, by_id):
         """ Find a Supplier by it's id """
-        logger.info("Processing lookup or 404 for id %s ...", by_id)
-        return cls.query.get_or_404(by_id)
+        logger.debug("Processing lookup or 404 for id %s ...", by_id)
+        return cls.active().filter(cls.id == by_id).first_or_404()
+
+
+######################################################################
+#  T O M B S T O N E   M O D E L
+######################################################################
+
+class Tombstone(db.Model):
+    """
+    Class that records the deletion of a Supplier or Product
+
+    Tombstones let delta sync clients remove rows from their local copy
+    """
+
+    __tablename__ = 'Tombstone'
+    __table_args__ = (
+        db.Index('ix_Tombstone_resource_deleted_at', 'resource', 'deleted_at'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    tenant = db.Column(db.String(63), nullable=False, default=current_tenant)
+    resource = db.Column(db.String(63), nullable=False)
+    resource_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<tombstone %s id=[%s]>" % (self.resource, self.resource_id)
+
+    def serialize(self):
+        """ Serializes a Tombstone into a dictionary """
+        return {
+            "id": self.resource_id,
+            "updated_at": self.deleted_at.isoformat(),
+            "deleted": True,
+        }
+
+    @classmethod
+    def find_since(cls, resource, since):
+        """ Returns the Tombstones of a resource of the current tenant recorded after a timestamp
+
+        Args:
+            resource (string): the table name of the deleted resource
+            since (datetime): the naive UTC timestamp to compare against
+        """
+        logger.debug("Processing %s tombstones since %s ...", resource, since)
+        return cls.query.filter(
+            cls.tenant == current_tenant(), cls.resource == resource, cls.deleted_at > since
+        )
 
 
 ######################################################################
@@ -87,13 +303,26 @@ class Product(db.Model, PersistentBase):
 
     # Table Schema
     __tablename__ = 'Product'
-    id = db.Column(db.Integer, primary_key=True)
+    __table_args__ = (
+        db.ForeignKeyConstraint(['supplier_id', 'tenant'], ['Supplier.id', 'Supplier.tenant']),
+        db.Index('ix_Product_supplier_id_active', 'tenant', 'supplier_id',
+                 postgresql_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_Product_name_price_active', 'tenant', 'name', 'wholesale_price', 'id',
+                 postgresql_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_Product_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL')),
+        {'postgresql_partition_by': 'LIST (tenant)'},
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    tenant = db.Column(db.String(63), primary_key=True, default=current_tenant)
     name = db.Column(db.String(63))
     desc = db.Column(db.String(256))
     wholesale_price = db.Column(db.Integer)
     quantity = db.Column(db.Integer)
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
 
-    supplier_id = db.Column(db.Integer, db.ForeignKey('Supplier.id'), nullable = False)
+    supplier_id = db.Column(db.Integer, nullable = False)
+    deleted_at = db.Column(db.DateTime)
     
  
     def __repr__(self):
@@ -111,6 +340,7 @@ class Product(db.Model, PersistentBase):
             "desc": self.desc,
             "wholesale_price": self.wholesale_price,
             "quantity": self.quantity,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
         }
 
     def deserialize(self, data):
@@ -119,21 +349,514 @@ class Product(db.Model, PersistentBase):
         Args:
             data (dict): A dictionary containing the resource data
         """
-        try:
+        errors = validate_product(data)
+        if errors:
+            raise DataValidationError("Invalid Product: " + "; ".join(errors), errors=errors)
+        return self._assign(data)
+
+    def _assign(self, data):
+        """ Copies the fields of an already validated dictionary """
+        if data.get("supplier_id") is not None:
             self.supplier_id = data["supplier_id"]
-            self.name = data["name"]
-            self.desc = data["desc"]
-            self.wholesale_price = data["wholesale_price"]
-            self.quantity = data["quantity"]
-            
-        except KeyError as error:
-            raise DataValidationError("Invalid Product: missing " + error.args[0])
-        except TypeError as error:
-            raise DataValidationError(
-                "Invalid Product: body of request contained" "bad or no data"
-            )
+        self.name = data["name"]
+        self.desc = data["desc"]
+        self.wholesale_price = data["wholesale_price"]
+        self.quantity = data["quantity"]
         return self
 
+    @classmethod
+    def adjust_quantity(cls, product_id, delta, minimum=0, supplier_id=None):
+        """ Adds to the quantity of a Product in a single UPDATE ... RETURNING
+
+        The addition happens in the database, so concurrent adjustments are
+        never lost, and it is refused when the quantity would drop below
+        the minimum
+
+        Args:
+            product_id (int): the id of the Product
+            delta (int): the amount to add, negative to take away
+            minimum (int): the lowest quantity allowed, None for no limit
+            supplier_id (int): only match a Product of this Supplier
+        Returns:
+            Product: the updated Product, or None if no row matched
+        """
+        logger.info("Adjusting quantity of product %s by %s ...", product_id, delta)
+        table = cls.__table__
+        quantity = db.func.coalesce(table.c.quantity, 0) + delta
+        condition = (table.c.id == product_id) & (table.c.tenant == current_tenant()) \
+            & table.c.deleted_at.is_(None)
+        if supplier_id is not None:
+            condition &= table.c.supplier_id == supplier_id
+        if minimum is not None:
+            condition &= quantity >= minimum
+        statement = (
+            table.update().where(condition)
+            .values(quantity=quantity, updated_at=datetime.utcnow())
+            .returning(*table.c)
+        )
+        return cls._update_returning(statement)
+
+    @classmethod
+    def _purge_dependents(cls, ids):
+        db.session.execute(Reservation.__table__.delete().where(Reservation.product_id.in_(ids)))
+
+    @classmethod
+    def find_offers(cls, name, limit=10):
+        """ Returns the cheapest Product in stock of each Supplier selling a Product
+
+        The Products with the name are read off ix_Product_name_price_active,
+        BestOffer.find_offers() answers the same from a precomputed table
+
+        Args:
+            name (string): the name of the Product
+            limit (int): the most Suppliers to return
+        Returns:
+            Query: offers with product_id, supplier_id, name, wholesale_price
+                and quantity, cheapest first
+        """
+        logger.debug("Processing offers for %s ...", name)
+        best = (
+            db.session.query(cls.id.label('product_id'), cls.supplier_id, cls.name,
+                             cls.wholesale_price, cls.quantity)
+            .filter(cls.tenant == current_tenant(), cls.deleted_at.is_(None), cls.name == name,
+                    cls.quantity > 0, cls.wholesale_price.isnot(None))
+            .distinct(cls.supplier_id)
+            .order_by(cls.supplier_id, cls.wholesale_price, cls.id)
+            .subquery()
+        )
+        return db.session.query(best).order_by(best.c.wholesale_price, best.c.supplier_id).limit(limit)
+
+
+######################################################################
+#  B E S T   O F F E R   M O D E L
+######################################################################
+
+# recomputes the best offer of one Supplier for one Product name, under a
+# lock so concurrent writes to the same Products are applied in turn
+_REFRESH_BEST_OFFER = """
+CREATE OR REPLACE FUNCTION refresh_best_offer(t text, n text, s integer) RETURNS void AS $$
+BEGIN
+    IF n IS NULL THEN
+        RETURN;
+    END IF;
+    PERFORM pg_advisory_xact_lock(hashtext('BestOffer/' || t || '/' || s || '/' || n));
+    INSERT INTO "BestOffer" (tenant, name, supplier_id, product_id, wholesale_price, quantity)
+    SELECT tenant, name, supplier_id, id, wholesale_price, quantity FROM "Product"
+    WHERE tenant = t AND supplier_id = s AND name = n AND deleted_at IS NULL
+        AND quantity > 0 AND wholesale_price IS NOT NULL
+    ORDER BY wholesale_price, id
+    LIMIT 1
+    ON CONFLICT (tenant, name, supplier_id) DO UPDATE SET
+        product_id = EXCLUDED.product_id,
+        wholesale_price = EXCLUDED.wholesale_price,
+        quantity = EXCLUDED.quantity;
+    IF NOT FOUND THEN
+        DELETE FROM "BestOffer" WHERE tenant = t AND name = n AND supplier_id = s;
+    END IF;
+END
+$$ LANGUAGE plpgsql
+"""
+
+_BEST_OFFER_TRIGGER = """
+CREATE OR REPLACE FUNCTION best_offer_trigger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM refresh_best_offer(OLD.tenant, OLD.name, OLD.supplier_id);
+    END IF;
+    IF TG_OP = 'INSERT' OR (TG_OP = 'UPDATE' AND (NEW.tenant, NEW.name, NEW.supplier_id)
+            IS DISTINCT FROM (OLD.tenant, OLD.name, OLD.supplier_id)) THEN
+        PERFORM refresh_best_offer(NEW.tenant, NEW.name, NEW.supplier_id);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+class BestOffer(db.Model):
+    """
+    Class that holds the cheapest Product in stock of each Supplier by name
+
+    A trigger on the Product table keeps the rows current on every write
+    when BEST_OFFERS_ENABLED is set, so comparing prices reads the first
+    rows of ix_BestOffer_name_price however many Products there are
+    """
+
+    __tablename__ = 'BestOffer'
+    __table_args__ = (
+        db.Index('ix_BestOffer_name_price', 'tenant', 'name', 'wholesale_price', 'supplier_id'),
+    )
+    tenant = db.Column(db.String(63), primary_key=True)
+    name = db.Column(db.String(63), primary_key=True)
+    supplier_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    product_id = db.Column(db.Integer, nullable=False)
+    wholesale_price = db.Column(db.Integer, nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return "<best offer %r supplier=[%s]>" % (self.name, self.supplier_id)
+
+    @classmethod
+    def find_offers(cls, name, limit=10):
+        """ Returns the cheapest Product in stock of each Supplier selling a Product
+
+        Args:
+            name (string): the name of the Product
+            limit (int): the most Suppliers to return
+        Returns:
+            Query: offers cheapest first, like Product.find_offers()
+        """
+        logger.debug("Processing best offers for %s ...", name)
+        return (
+            cls.query.filter(cls.tenant == current_tenant(), cls.name == name)
+            .order_by(cls.wholesale_price, cls.supplier_id)
+            .limit(limit)
+        )
+
+    @staticmethod
+    def installed(connection):
+        """ Is the trigger keeping the table current installed in a database """
+        return connection.execute(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'Product_best_offer'"
+        ).first() is not None
+
+    @staticmethod
+    def install(connection):
+        """ Installs the trigger on the Product table and fills the table """
+        connection.execute(_REFRESH_BEST_OFFER)
+        connection.execute(_BEST_OFFER_TRIGGER)
+        connection.execute(
+            'CREATE TRIGGER "Product_best_offer" '
+            "AFTER INSERT OR DELETE OR UPDATE OF tenant, name, supplier_id, wholesale_price, "
+            'quantity, deleted_at ON "Product" '
+            "FOR EACH ROW EXECUTE FUNCTION best_offer_trigger()"
+        )
+        connection.execute('DELETE FROM "BestOffer"')
+        connection.execute(
+            'INSERT INTO "BestOffer" (tenant, name, supplier_id, product_id, wholesale_price, quantity) '
+            "SELECT DISTINCT ON (tenant, name, supplier_id) "
+            'tenant, name, supplier_id, id, wholesale_price, quantity FROM "Product" '
+            "WHERE deleted_at IS NULL AND quantity > 0 AND name IS NOT NULL "
+            "AND wholesale_price IS NOT NULL "
+            "ORDER BY tenant, name, supplier_id, wholesale_price, id"
+        )
+
+    @staticmethod
+    def uninstall(connection):
+        """ Removes the trigger and empties the table """
+        connection.execute('DROP TRIGGER IF EXISTS "Product_best_offer" ON "Product"')
+        connection.execute('DELETE FROM "BestOffer"')
+
+
+def _install_best_offers(metadata, connection, tables=(), **kw):
+    """ Installs the trigger along with a new BestOffer table when enabled
+
+    It runs once every table was created, the trigger needs both tables
+    """
+    if BestOffer.__table__ in tables and connection.dialect.name == 'postgresql' \
+            and app.config['BEST_OFFERS_ENABLED']:
+        BestOffer.install(connection)
+
+
+event.listen(db.metadata, 'after_create', _install_best_offers)
+
+
+######################################################################
+#  P R I C E   H I S T O R Y   M O D E L S
+######################################################################
+
+# appends the price of a new Product, or the new price of a changed one, to
+# the history and folds it into the rollup of the day. A Product inserted
+# with history already recorded was moved from another shard.
+_RECORD_PRICE = """
+CREATE OR REPLACE FUNCTION record_price() RETURNS trigger AS $$
+DECLARE
+    at timestamp := now() AT TIME ZONE 'UTC';
+BEGIN
+    IF NEW.wholesale_price IS NULL THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' AND NEW.wholesale_price IS NOT DISTINCT FROM OLD.wholesale_price THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'INSERT' AND EXISTS (SELECT 1 FROM "PriceHistory"
+            WHERE tenant = NEW.tenant AND product_id = NEW.id) THEN
+        RETURN NULL;
+    END IF;
+    INSERT INTO "PriceHistory" (tenant, product_id, supplier_id, wholesale_price, recorded_at)
+    VALUES (NEW.tenant, NEW.id, NEW.supplier_id, NEW.wholesale_price, at);
+    INSERT INTO "PriceRollup" (tenant, product_id, day, supplier_id, low, high, total, count, close)
+    VALUES (NEW.tenant, NEW.id, at::date, NEW.supplier_id, NEW.wholesale_price,
+            NEW.wholesale_price, NEW.wholesale_price, 1, NEW.wholesale_price)
+    ON CONFLICT (tenant, product_id, day) DO UPDATE SET
+        low = least("PriceRollup".low, EXCLUDED.low),
+        high = greatest("PriceRollup".high, EXCLUDED.high),
+        total = "PriceRollup".total + EXCLUDED.total,
+        count = "PriceRollup".count + 1,
+        close = EXCLUDED.close;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql
+"""
+
+
+def _month_start(moment):
+    """ Returns the first day of the month of a date or datetime """
+    return datetime(moment.year, moment.month, 1)
+
+
+def _next_month(moment):
+    """ Returns the first day of the month after a date or datetime """
+    return _month_start(_month_start(moment) + timedelta(days=32))
+
+
+class PriceHistory(db.Model):
+    """
+    Class that records every wholesale price a Product had
+
+    A trigger on the Product table appends a row when a Product is created
+    and whenever its price changes, rows are never updated. The table is
+    partitioned by month and time ranges are found with a BRIN index on
+    recorded_at, which stays a few pages because rows arrive in time order.
+    """
+
+    __tablename__ = 'PriceHistory'
+    __table_args__ = (
+        db.Index('ix_PriceHistory_product', 'tenant', 'product_id', 'recorded_at'),
+        # autovacuum summarizes each range of pages once it fills up
+        db.Index('ix_PriceHistory_recorded_at', 'recorded_at', postgresql_using='brin',
+                 postgresql_with={'autosummarize': 'on'}),
+        {'postgresql_partition_by': 'RANGE (recorded_at)'},
+    )
+    id = db.Column(db.BigInteger, primary_key=True, autoincrement=True)
+    recorded_at = db.Column(db.DateTime, primary_key=True, default=datetime.utcnow)
+    tenant = db.Column(db.String(63), nullable=False, default=current_tenant)
+    product_id = db.Column(db.Integer, nullable=False)
+    supplier_id = db.Column(db.Integer, nullable=False)
+    wholesale_price = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return "<price %s of product [%s] at %s>" % (self.wholesale_price, self.product_id, self.recorded_at)
+
+    def serialize(self):
+        """ Serializes a recorded price into a dictionary, like a PriceRollup """
+        return {
+            "at": self.recorded_at.isoformat(),
+            "low": self.wholesale_price,
+            "high": self.wholesale_price,
+            "avg": float(self.wholesale_price),
+            "close": self.wholesale_price,
+        }
+
+    @classmethod
+    def series(cls, product_id, since, until):
+        """ Returns the prices a Product had between two timestamps, oldest first
+
+        Args:
+            product_id (int): the id of the Product
+            since (datetime): the naive UTC start of the range, included
+            until (datetime): the naive UTC end of the range, excluded
+        """
+        logger.debug("Processing price history of product %s ...", product_id)
+        return cls.query.filter(
+            cls.tenant == current_tenant(), cls.product_id == product_id,
+            cls.recorded_at >= since, cls.recorded_at < until
+        ).order_by(cls.recorded_at, cls.id)
+
+    @classmethod
+    def stats(cls, since, until, product_id=None, supplier_id=None):
+        """ Returns the lowest, highest and average price recorded in a range
+
+        Whole days are read from the daily rollups and only the hours at
+        either end from the history, so a year takes about 365 rows per
+        Product whatever the number of price changes
+
+        Args:
+            since (datetime): the naive UTC start of the range, included
+            until (datetime): the naive UTC end of the range, excluded
+            product_id (int): only count the prices of this Product
+            supplier_id (int): only count the prices of the Products of this Supplier
+        Returns:
+            dict: the count, min, max and avg of the prices
+        """
+        first_day = since.date() if since.time() == datetime.min.time() else since.date() + timedelta(days=1)
+        last_day = until.date()
+        parts = []
+        if first_day < last_day:
+            parts.append(PriceRollup.summarize(
+                PriceRollup.matching(product_id, supplier_id)
+                .filter(PriceRollup.day >= first_day, PriceRollup.day < last_day)
+            ))
+            edges = [(since, datetime.combine(first_day, datetime.min.time())),
+                     (datetime.combine(last_day, datetime.min.time()), until)]
+        else:
+            edges = [(since, until)]
+        for start, end in edges:
+            if start < end:
+                parts.append(cls._summarize(start, end, product_id, supplier_id))
+        count = int(sum(part[0] or 0 for part in parts))
+        lows = [part[1] for part in parts if part[0]]
+        highs = [part[2] for part in parts if part[0]]
+        total = sum(part[3] or 0 for part in parts)
+        return {
+            "count": count,
+            "min": min(lows) if lows else None,
+            "max": max(highs) if highs else None,
+            "avg": float(total) / count if count else None,
+        }
+
+    @classmethod
+    def _summarize(cls, since, until, product_id, supplier_id):
+        """ Returns the count, min, max and sum of the prices recorded in a range """
+        query = db.session.query(
+            db.func.count(cls.id), db.func.min(cls.wholesale_price),
+            db.func.max(cls.wholesale_price), db.func.sum(cls.wholesale_price)
+        ).filter(cls.tenant == current_tenant(), cls.recorded_at >= since, cls.recorded_at < until)
+        if product_id is not None:
+            query = query.filter(cls.product_id == product_id)
+        if supplier_id is not None:
+            query = query.filter(cls.supplier_id == supplier_id)
+        return query.one()
+
+    @staticmethod
+    def installed(connection):
+        """ Is the trigger recording prices installed in a database """
+        return connection.execute(
+            "SELECT 1 FROM pg_trigger WHERE tgname = 'Product_price_history'"
+        ).first() is not None
+
+    @classmethod
+    def install(cls, connection):
+        """ Installs the trigger on the Product table and records the current prices """
+        connection.execute(_RECORD_PRICE)
+        connection.execute(
+            'CREATE TRIGGER "Product_price_history" '
+            'AFTER INSERT OR UPDATE OF wholesale_price ON "Product" '
+            "FOR EACH ROW EXECUTE FUNCTION record_price()"
+        )
+        connection.execute(
+            'INSERT INTO "PriceHistory" (tenant, product_id, supplier_id, wholesale_price, recorded_at) '
+            "SELECT tenant, id, supplier_id, wholesale_price, now() AT TIME ZONE 'UTC' "
+            'FROM "Product" WHERE wholesale_price IS NOT NULL'
+        )
+        connection.execute(
+            'INSERT INTO "PriceRollup" (tenant, product_id, day, supplier_id, low, high, total, count, close) '
+            "SELECT tenant, product_id, recorded_at::date, supplier_id, wholesale_price, "
+            'wholesale_price, wholesale_price, 1, wholesale_price FROM "PriceHistory"'
+        )
+
+    @classmethod
+    def add_partitions(cls, connection, months_ahead):
+        """ Creates the monthly partitions from this month to months_ahead months on
+
+        Prices recorded when a month had no partition yet went to the
+        default one, they are moved into the new partition
+
+        Args:
+            connection (Connection): the database to change
+            months_ahead (int): the months after this one to create partitions for
+        Returns:
+            list: the names of the partitions created
+        """
+        created = []
+        month = _month_start(datetime.utcnow())
+        for _ in range(months_ahead + 1):
+            following = _next_month(month)
+            name = '{}_{:%Y_%m}'.format(cls.__tablename__, month)
+            if connection.execute(db.text('SELECT to_regclass(:name)'), name='"{}"'.format(name)).scalar() is None:
+                connection.execute('CREATE TABLE "{}" (LIKE "{}" INCLUDING DEFAULTS)'.format(name, cls.__tablename__))
+                connection.execute(db.text(
+                    'WITH moved AS (DELETE FROM "{0}_default" WHERE recorded_at >= :month '
+                    'AND recorded_at < :following RETURNING *) '
+                    'INSERT INTO "{1}" SELECT * FROM moved'.format(cls.__tablename__, name)
+                ), month=month, following=following)
+                connection.execute(
+                    'ALTER TABLE "{}" ATTACH PARTITION "{}" FOR VALUES FROM (\'{}\') TO (\'{}\')'.format(
+                        cls.__tablename__, name, month.date(), following.date())
+                )
+                logger.info("Created partition %s", name)
+                created.append(name)
+            month = following
+        return created
+
+
+class PriceRollup(db.Model):
+    """
+    Class that holds the low, high, sum and closing price of a Product each day
+
+    Kept current by the trigger recording prices, so statistics over long
+    ranges read one row per Product and day
+    """
+
+    __tablename__ = 'PriceRollup'
+    __table_args__ = (
+        db.Index('ix_PriceRollup_supplier', 'tenant', 'supplier_id', 'day'),
+    )
+    tenant = db.Column(db.String(63), primary_key=True, default=current_tenant)
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    day = db.Column(db.Date, primary_key=True)
+    supplier_id = db.Column(db.Integer, nullable=False)
+    low = db.Column(db.Integer, nullable=False)
+    high = db.Column(db.Integer, nullable=False)
+    total = db.Column(db.BigInteger, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    close = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return "<price rollup of product [%s] on %s>" % (self.product_id, self.day)
+
+    def serialize(self):
+        """ Serializes the prices of a day into a dictionary """
+        return {
+            "at": datetime.combine(self.day, datetime.min.time()).isoformat(),
+            "low": self.low,
+            "high": self.high,
+            "avg": float(self.total) / self.count,
+            "close": self.close,
+        }
+
+    @classmethod
+    def matching(cls, product_id=None, supplier_id=None):
+        """ Returns a query of the rollups of the current tenant for a Product or Supplier """
+        query = cls.query.filter(cls.tenant == current_tenant())
+        if product_id is not None:
+            query = query.filter(cls.product_id == product_id)
+        if supplier_id is not None:
+            query = query.filter(cls.supplier_id == supplier_id)
+        return query
+
+    @classmethod
+    def series(cls, product_id, since, until):
+        """ Returns the daily prices of a Product between two dates, oldest first
+
+        Args:
+            product_id (int): the id of the Product
+            since (date): the first day of the range
+            until (date): the day after the range
+        """
+        logger.debug("Processing daily prices of product %s ...", product_id)
+        return cls.matching(product_id).filter(cls.day >= since, cls.day < until).order_by(cls.day)
+
+    @classmethod
+    def summarize(cls, query):
+        """ Returns the count, min, max and sum of the prices of some rollups """
+        return query.with_entities(
+            db.func.sum(cls.count), db.func.min(cls.low), db.func.max(cls.high), db.func.sum(cls.total)
+        ).one()
+
+
+def _install_price_history(metadata, connection, tables=(), **kw):
+    """ Installs the trigger and the first partitions along with a new PriceHistory table """
+    if PriceHistory.__table__ in tables and connection.dialect.name == 'postgresql':
+        PriceHistory.install(connection)
+        PriceHistory.add_partitions(connection, app.config['PRICE_PARTITIONS_AHEAD'])
+
+
+event.listen(PriceHistory.__table__, 'after_create', DDL(
+    'CREATE TABLE "PriceHistory_default" PARTITION OF "PriceHistory" DEFAULT'
+).execute_if(dialect='postgresql'))
+event.listen(db.metadata, 'after_create', _install_price_history)
+
 
 #####################################################################
 #  S U P P L I E R S   M O D E L
@@ -150,19 +873,47 @@ class Supplier(db.Model, PersistentBase):
 
     # Table Schema
     __tablename__ = 'Supplier'
-    id = db.Column(db.Integer, primary_key=True)
+    __table_args__ = (
+        # the sort orders of the list, each ending in id so pages are read off them
+        db.Index('ix_Supplier_name_id_active', 'tenant', 'name', 'id',
+                 postgresql_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_Supplier_category_id_active', 'tenant', 'category', 'id',
+                 postgresql_where=db.text('deleted_at IS NULL')),
+        db.Index('ix_Supplier_updated_at_id_active', 'tenant', 'updated_at', 'id',
+                 postgresql_where=db.text('deleted_at IS NULL')),
+        # preferred Suppliers are few, so their index stays small
+        db.Index('ix_Supplier_preferred_active', 'tenant', 'id',
+                 postgresql_where=db.text('preferred AND deleted_at IS NULL')),
+        db.Index('ix_Supplier_deleted_at', 'deleted_at',
+                 postgresql_where=db.text('deleted_at IS NOT NULL')),
+        {'postgresql_partition_by': 'LIST (tenant)'},
+    )
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    tenant = db.Column(db.String(63), primary_key=True, default=current_tenant)
     name = db.Column(db.String(63))
     category = db.Column(db.String(63))
     address = db.Column(db.String(128))
     email = db.Column(db.String(63))
     phone_number = db.Column(db.String(32))
-    preferred = db.Column(db.String(32))
-    products = relationship('Product', order_by = Product.id, backref=db.backref('Supplier'), lazy=True)
+    preferred = db.Column(db.Boolean, nullable=False, default=False, server_default=db.false())
+    updated_at = db.Column(db.DateTime, index=True, default=datetime.utcnow, onupdate=datetime.utcnow)
+    deleted_at = db.Column(db.DateTime)
+    products = relationship(
+        'Product', order_by = Product.id, backref=db.backref('Supplier'), lazy=True,
+        primaryjoin='and_(Supplier.id == Product.supplier_id, Supplier.tenant == Product.tenant, '
+                    'Product.deleted_at.is_(None))'
+    )
+
 
+    SORT_KEYS = ('id', 'name', 'category', 'updated_at')
 
     def __repr__(self):
         return "<supplier %r id=[%s]>" % (self.name, self.id)
 
+    def sort_key(self, sort):
+        """ Returns the position of a Supplier in a sort order, see page() """
+        return (self.id,) if sort == 'id' else (getattr(self, sort), self.id)
+
     def serialize(self):
         """ Serializes a Supplier into a dictionary """
         supplier = {
@@ -173,6 +924,7 @@ class Supplier(db.Model, PersistentBase):
             "email":self.email,
             "phone_number":self.phone_number,
             "preferred":self.preferred,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
             "products": []
         }
         for product in self.products:
@@ -186,29 +938,159 @@ class Supplier(db.Model, PersistentBase):
         Args:
             data (dict): A dictionary containing the resource data
         """
-        try:
-            self.name = data["name"]
-            self.category = data["category"]
-            self.address = data["address"]
-            self.email = data["email"]
-            self.phone_number = data.get("phone_number")
-            self.preferred = data.get("preferred")
-            #handle inner list of products
-            product_list = data["products"]
-            for json_product in product_list:
-                product = Product()
-                product.deserialize(json_product)
-                self.products.append(product)
-
-            
-        except KeyError as error:
-            raise DataValidationError("Invalid Supplier: missing " + error.args[0])
-        except TypeError as error:
-            raise DataValidationError(
-                "Invalid Supplier: body of request contained" "bad or no data"
-            )
+        errors = validate_supplier(data)
+        if errors:
+            raise DataValidationError("Invalid Supplier: " + "; ".join(errors), errors=errors)
+        self.name = data["name"]
+        self.category = data["category"]
+        self.address = data["address"]
+        self.email = data["email"]
+        self.phone_number = data.get("phone_number")
+        self.preferred = bool(data.get("preferred"))
+        #handle inner list of products
+        for json_product in data["products"]:
+            self.products.append(Product()._assign(json_product))
         return self
 
+    def _place(self):
+        if sharding.enabled():
+            # the id decides the shard, so it is taken before the insert
+            if self.id is None:
+                self.id = sharding.next_id(self.__tablename__)
+            sharding.set_shard(sharding.shard_for(self.id))
+
+    def _delete_children(self, now):
+        product = Product.__table__
+        db.session.execute(
+            product.update()
+            .where(product.c.supplier_id == self.id)
+            .where(product.c.tenant == self.tenant)
+            .where(product.c.deleted_at.is_(None))
+            .values(deleted_at=now, updated_at=now)
+        )
+
+    @classmethod
+    def _purge_dependents(cls, ids):
+        products = db.select([Product.id]).where(Product.supplier_id.in_(ids))
+        db.session.execute(Reservation.__table__.delete().where(Reservation.product_id.in_(products)))
+        db.session.execute(Product.__table__.delete().where(Product.supplier_id.in_(ids)))
+
+    @classmethod
+    def remove_all(cls):
+        """ Removes every Supplier of every tenant at once (for testing only)
+
+        TRUNCATE empties the tables without scanning or logging each row.
+        It fires no row triggers, so the tables they keep are emptied too:
+        the ids start again at 1 and must not find the prices or offers of
+        the Products removed
+        """
+        logger.info("Removing all Suppliers")
+        for _ in sharding.each_shard():
+            db.session.execute(
+                'TRUNCATE "Reservation", "Product", "Supplier", "Tombstone", '
+                '"PriceHistory", "PriceRollup", "BestOffer" RESTART IDENTITY'
+            )
+        db.session.commit()
+
+    @classmethod
+    def mark_preferred(cls, supplier_id, preferred=True, expected=None):
+        """ Sets the preferred flag of a Supplier in a single UPDATE ... RETURNING
+
+        The flag is written without reading the Supplier first, so
+        concurrent changes never overwrite each other. With expected the
+        change only happens if the flag still has that value.
+
+        Args:
+            supplier_id (int): the id of the Supplier
+            preferred (boolean): the new value of the flag
+            expected (boolean): the value the flag must have now, None for any
+        Returns:
+            Supplier: the updated Supplier, or None if no row matched
+        """
+        logger.info("Setting preferred flag of supplier %s to %s ...", supplier_id, preferred)
+        table = cls.__table__
+        condition = (table.c.id == supplier_id) & (table.c.tenant == current_tenant()) \
+            & table.c.deleted_at.is_(None)
+        if expected is not None:
+            condition &= table.c.preferred == expected
+        statement = (
+            table.update().where(condition)
+            .values(preferred=preferred, updated_at=datetime.utcnow())
+            .returning(*table.c)
+        )
+        return cls._update_returning(statement, 'products')
+
+    @classmethod
+    def mark_preferred_many(cls, supplier_ids, preferred=True):
+        """ Sets the preferred flag of many Suppliers in one statement
+
+        Args:
+            supplier_ids (list): the ids of the Suppliers
+            preferred (boolean): the new value of the flag
+        Returns:
+            list: the ids of the Suppliers whose flag changed
+        """
+        logger.info("Setting preferred flag of %s suppliers to %s ...", len(supplier_ids), preferred)
+        if not supplier_ids:
+            return []
+        table = cls.__table__
+        changed = []
+        for group in sharding.by_shard(supplier_ids):
+            statement = (
+                table.update()
+                .where(table.c.id.in_(group))
+                .where(table.c.tenant == current_tenant())
+                .where(table.c.deleted_at.is_(None))
+                .where(table.c.preferred != preferred)
+                .values(preferred=preferred, updated_at=datetime.utcnow())
+                .returning(table.c.id)
+            )
+            changed.extend(row.id for row in db.session.execute(statement))
+        db.session.commit()
+        return sorted(changed)
+
+    @classmethod
+    def page(cls, query, sort='id', descending=False, after=None, limit=None):
+        """ Orders a query of Suppliers for keyset paging
+
+        Rows are ordered by the sort column and then by id, the order of
+        the (tenant, <sort>, id) indexes, so the next page starts right
+        after the sort key of the last row instead of skipping rows
+
+        Args:
+            query (Query): the Suppliers to order
+            sort (string): id, name, category or updated_at
+            descending (boolean): sort from the largest value down
+            after (tuple): the sort_key() of the last row of the previous page
+            limit (int): the most rows to return
+        """
+        columns = [cls.id] if sort == 'id' else [getattr(cls, sort), cls.id]
+        if after is not None:
+            key = db.tuple_(*columns)
+            query = query.filter(key < after if descending else key > after)
+        query = query.order_by(*[column.desc() if descending else column for column in columns])
+        return query.limit(limit) if limit else query
+
+    @classmethod
+    def find_many(cls, supplier_ids):
+        """ Finds many Suppliers by id with their Products
+
+        Runs one IN query and one Product query on each shard holding
+        some of the ids
+
+        Args:
+            supplier_ids (list): the ids of the Suppliers
+        Returns:
+            list: the Suppliers found, in no particular order
+        """
+        logger.debug("Processing lookup for %s suppliers ...", len(supplier_ids))
+        found = []
+        for group in sharding.by_shard(supplier_ids):
+            found.extend(
+                cls.active().filter(cls.id.in_(group)).options(selectinload(cls.products)).all()
+            )
+        return found
+
     @classmethod
     def find_by_name(cls, name):
         """ Returns all Supplier with the given name
@@ -216,8 +1098,8 @@ class Supplier(db.Model, PersistentBase):
         Args:
             name (string): the name of the Supplier you want to match
         """
-        logger.info("Processing name query for %s ...", name)
-        return cls.query.filter(cls.name == name)
+        logger.debug("Processing name query for %s ...", name)
+        return cls.active().filter(cls.name == name)
 
     #whoever is doing the query story should create more query model
 
@@ -228,8 +1110,8 @@ class Supplier(db.Model, PersistentBase):
         Args:
             category (string): the category of the Suppliers you want to match
         """
-        logger.info("Processing category query for %s ...", category)
-        return cls.query.filter(cls.category == category)
+        logger.debug("Processing category query for %s ...", category)
+        return cls.active().filter(cls.category == category)
 
     @classmethod
     def find_by_address(cls, address):
@@ -238,8 +1120,8 @@ class Supplier(db.Model, PersistentBase):
         Args:
             address (string): the address of the Suppliers you want to match
         """
-        logger.info("Processing address query for %s ...", address)
-        return cls.query.filter(cls.address == address)
+        logger.debug("Processing address query for %s ...", address)
+        return cls.active().filter(cls.address == address)
 
     @classmethod
     def find_by_email(cls, email):
@@ -248,8 +1130,8 @@ class Supplier(db.Model, PersistentBase):
         Args:
             email (string): the email of the Suppliers you want to match
         """
-        logger.info("Processing email query for %s ...", email)
-        return cls.query.filter(cls.email == email)
+        logger.debug("Processing email query for %s ...", email)
+        return cls.active().filter(cls.email == email)
 
     @classmethod
     def find_by_phone_number(cls, phone_number):
@@ -258,15 +1140,386 @@ class Supplier(db.Model, PersistentBase):
         Args:
             phone_number (string): the phone_number of the Suppliers you want to match
         """
-        logger.info("Processing phone_number query for %s ...", phone_number)
-        return cls.query.filter(cls.phone_number == phone_number) 
+        logger.debug("Processing phone_number query for %s ...", phone_number)
+        return cls.active().filter(cls.phone_number == phone_number) 
 
     @classmethod
     def find_by_preferred(cls, preferred):
         """ Returns all Suppliers with the preferred flag set
 
+        Preferred Suppliers are read from the partial index
+        ix_Supplier_preferred_active
+
         Args:
             preferred (boolean): the preferred flag of the Suppliers you want to match
         """
-        logger.info("Processing preferred flag query for %s ...", preferred)
-        return cls.query.filter(cls.preferred == preferred) 
\ No newline at end of file
+        logger.debug("Processing preferred flag query for %s ...", preferred)
+        return cls.active().filter(cls.preferred if preferred else db.not_(cls.preferred))
+
+    @classmethod
+    def find_modified_since(cls, since):
+        """ Returns all Suppliers changed after a timestamp
+
+        A Supplier counts as changed when its own row or any of its
+        products was written after the timestamp
+
+        Args:
+            since (datetime): the naive UTC timestamp to compare against
+        """
+        logger.debug("Processing modified since query for %s ...", since)
+        return cls.active().filter(
+            db.or_(
+                cls.updated_at > since,
+                # deleted products count too, the Supplier lost them
+                db.exists()
+                .where(Product.supplier_id == cls.id)
+                .where(Product.tenant == cls.tenant)
+                .where(Product.updated_at > since)
+            )
+        )
+
+
+######################################################################
+#  R E S E R V A T I O N S   M O D E L
+######################################################################
+
+class Reservation(db.Model):
+    """
+    Class that represents stock of a Product held for an order
+
+    Reserving takes the stock off Product.quantity and releasing puts it
+    back, each in a single transaction
+    """
+
+    HELD = 'held'
+    RELEASED = 'released'
+
+    __tablename__ = 'Reservation'
+    __table_args__ = (
+        db.ForeignKeyConstraint(['product_id', 'tenant'], ['Product.id', 'Product.tenant']),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    tenant = db.Column(db.String(63), nullable=False, default=current_tenant)
+    product_id = db.Column(db.Integer, nullable=False, index=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    reference = db.Column(db.String(63))
+    status = db.Column(db.String(16), nullable=False, default=HELD)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    def __repr__(self):
+        return "<reservation %s of product %s id=[%s]>" % (self.quantity, self.product_id, self.id)
+
+    def serialize(self):
+        """ Serializes a Reservation into a dictionary """
+        return {
+            "id": self.id,
+            "product_id": self.product_id,
+            "quantity": self.quantity,
+            "reference": self.reference,
+            "status": self.status,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+        }
+
+    @classmethod
+    def find(cls, by_id):
+        """ Finds a Reservation by it's ID """
+        logger.debug("Processing lookup for reservation %s ...", by_id)
+        return cls.query.filter(cls.id == by_id, cls.tenant == current_tenant()).first()
+
+    @classmethod
+    def reserve(cls, items, reference=None):
+        """ Takes stock of one or more Products for an order, all or nothing
+
+        A single Product is reserved with one conditional decrement. Several
+        Products are locked with SELECT ... FOR UPDATE SKIP LOCKED in id
+        order, so an order never waits behind another one: if any of its
+        rows is locked the reservation fails at once and can be retried.
+
+        Args:
+            items (list): dictionaries with a product_id and a quantity
+            reference (string): the order the stock is held for
+        Returns:
+            list: the new Reservations
+        Raises:
+            ReservationError: when a Product does not exist, is short of
+                stock or is being reserved by another order
+        """
+        wanted = {}
+        for item in items:
+            wanted[item["product_id"]] = wanted.get(item["product_id"], 0) + item["quantity"]
+        logger.info("Reserving %s products for %s ...", len(wanted), reference)
+        product = Product.__table__
+        tenant = current_tenant()
+        try:
+            if len(wanted) == 1:
+                (product_id, quantity), = wanted.items()
+                taken = db.session.execute(
+                    product.update()
+                    .where(product.c.id == product_id)
+                    .where(product.c.tenant == tenant)
+                    .where(product.c.deleted_at.is_(None))
+                    .where(product.c.quantity >= quantity)
+                    .values(quantity=product.c.quantity - quantity, updated_at=datetime.utcnow())
+                    .returning(product.c.id)
+                ).first()
+                if taken is None:
+                    cls._fail(wanted, {})
+            else:
+                locked = dict(db.session.execute(
+                    db.select([product.c.id, product.c.quantity])
+                    .where(product.c.id.in_(list(wanted)))
+                    .where(product.c.tenant == tenant)
+                    .where(product.c.deleted_at.is_(None))
+                    .order_by(product.c.id)
+                    .with_for_update(skip_locked=True)
+                ).fetchall())
+                if len(locked) < len(wanted) or any(
+                        (locked[i] or 0) < quantity for i, quantity in wanted.items()):
+                    cls._fail(wanted, locked)
+                now = datetime.utcnow()
+                for product_id, quantity in wanted.items():
+                    db.session.execute(
+                        product.update()
+                        .where(product.c.id == product_id)
+                        .where(product.c.tenant == tenant)
+                        .values(quantity=product.c.quantity - quantity, updated_at=now)
+                    )
+            reservations = [
+                cls(product_id=product_id, quantity=quantity, reference=reference, status=cls.HELD)
+                for product_id, quantity in wanted.items()
+            ]
+            db.session.add_all(reservations)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return reservations
+
+    @classmethod
+    def _fail(cls, wanted, locked):
+        """ Explains why the wanted stock could not be taken """
+        db.session.rollback()
+        existing = dict(db.session.query(Product.id, Product.quantity)
+                        .filter(Product.id.in_(list(wanted)),
+                                Product.tenant == current_tenant(),
+                                Product.deleted_at.is_(None)))
+        for product_id, quantity in sorted(wanted.items()):
+            if product_id not in existing:
+                raise ReservationError(
+                    "Product with id [{}] was not found.".format(product_id), not_found=True
+                )
+            if (existing[product_id] or 0) < quantity:
+                raise ReservationError("Product with id [{}] has only {} in stock.".format(
+                    product_id, existing[product_id] or 0
+                ))
+        busy = sorted(set(wanted) - set(locked))
+        raise ReservationError(
+            "Products {} are being reserved by another order, retry.".format(busy)
+        )
+
+    @classmethod
+    def release(cls, reservation_id):
+        """ Puts the stock of a held Reservation back on its Product
+
+        Returns:
+            Reservation: the released Reservation
+        Raises:
+            ReservationError: when the Reservation does not exist or was
+                already released
+        """
+        logger.info("Releasing reservation %s ...", reservation_id)
+        table = cls.__table__
+        product = Product.__table__
+        released = db.session.execute(
+            table.update()
+            .where(table.c.id == reservation_id)
+            .where(table.c.tenant == current_tenant())
+            .where(table.c.status == cls.HELD)
+            .values(status=cls.RELEASED)
+            .returning(table.c.product_id, table.c.tenant, table.c.quantity)
+        ).first()
+        if released is None:
+            db.session.rollback()
+            if cls.find(reservation_id) is None:
+                raise ReservationError(
+                    "Reservation with id [{}] was not found.".format(reservation_id), not_found=True
+                )
+            raise ReservationError(
+                "Reservation with id [{}] was already released.".format(reservation_id)
+            )
+        db.session.execute(
+            product.update()
+            .where(product.c.id == released.product_id)
+            .where(product.c.tenant == released.tenant)
+            .values(quantity=product.c.quantity + released.quantity, updated_at=datetime.utcnow())
+        )
+        db.session.commit()
+        return cls.find(reservation_id)
+
+
+######################################################################
+#  J O B   M O D E L
+######################################################################
+
+class Job(db.Model):
+    """
+    Class that represents a heavy operation queued for the workers
+
+    Jobs live in the main database even when the catalog is sharded. A
+    worker claims a job by leasing it until locked_until, and a job whose
+    worker died is claimed again once the lease runs out
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    __tablename__ = 'Job'
+    __table_args__ = (
+        db.Index('ix_Job_pending', 'run_at',
+                 postgresql_where=db.text("status IN ('queued', 'running')")),
+        {'info': {'global': True}},
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    tenant = db.Column(db.String(63), nullable=False, default=current_tenant)
+    kind = db.Column(db.String(63), nullable=False)
+    params = db.Column(db.JSON, nullable=False, default=dict)
+    status = db.Column(db.String(16), nullable=False, default=QUEUED)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=1)
+    done = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    result = db.Column(db.JSON)
+    error = db.Column(db.Text)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_until = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return "<job %s %s id=[%s]>" % (self.kind, self.status, self.id)
+
+    def serialize(self):
+        """ Serializes a Job into a dictionary """
+        return {
+            "id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "attempts": self.attempts,
+            "done": self.done,
+            "total": self.total,
+            "result": self.result,
+            "error": self.error,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+        }
+
+    @classmethod
+    def enqueue(cls, kind, params=None, max_attempts=1):
+        """ Queues a job for the current tenant and returns it
+
+        Args:
+            kind (string): the name of the handler that runs the job
+            params (dict): the JSON parameters passed to the handler
+            max_attempts (int): how many times the job is tried before it fails
+        """
+        job = cls(kind=kind, params=params or {}, max_attempts=max_attempts)
+        db.session.add(job)
+        db.session.commit()
+        logger.info("Queued job %s %s", job.id, kind)
+        return job
+
+    @classmethod
+    def find(cls, by_id):
+        """ Finds a Job of the current tenant by it's ID """
+        logger.debug("Processing lookup for job %s ...", by_id)
+        return cls.query.filter(cls.id == by_id, cls.tenant == current_tenant()).first()
+
+    @classmethod
+    def claim(cls, lease_seconds, kinds=None):
+        """ Leases the next job that is due to a worker
+
+        Jobs locked by another worker's claim are skipped, so workers never
+        wait on each other. A job whose lease ran out on its last attempt
+        is failed instead of claimed again
+
+        Args:
+            lease_seconds (float): how long the worker may run the job unseen
+            kinds (list): the job kinds the worker runs, all when None
+        Returns:
+            Job: the leased job or None if none is due
+        """
+        now = datetime.utcnow()
+        expired = db.and_(cls.status == cls.RUNNING, cls.locked_until < now)
+        exhausted = cls.query.filter(expired, cls.attempts >= cls.max_attempts)
+        query = cls.query.filter(db.or_(
+            db.and_(cls.status == cls.QUEUED, cls.run_at <= now),
+            db.and_(expired, cls.attempts < cls.max_attempts),
+        ))
+        if kinds:
+            exhausted = exhausted.filter(cls.kind.in_(kinds))
+            query = query.filter(cls.kind.in_(kinds))
+        # an UPDATE would wait for the rows another worker is claiming, so lock what is free first
+        ids = [row.id for row in exhausted.with_entities(cls.id).with_for_update(skip_locked=True)]
+        failed = cls.query.filter(cls.id.in_(ids)).update({
+            cls.status: cls.FAILED,
+            cls.error: 'The lease of its last attempt ran out',
+            cls.locked_until: None,
+            cls.finished_at: now,
+        }, synchronize_session=False) if ids else 0
+        if failed:
+            logger.warning("Failed %s jobs whose last attempt stopped reporting", failed)
+        job = query.order_by(cls.run_at, cls.id).with_for_update(skip_locked=True).first()
+        if job is not None:
+            job.status = cls.RUNNING
+            job.attempts += 1
+            job.locked_until = now + timedelta(seconds=lease_seconds)
+        db.session.commit()
+        return job
+
+    def report(self, done, total, lease_seconds):
+        """ Records the progress of a running job and extends its lease
+
+        Commits the running transaction, so the work done so far and its
+        progress are saved together
+        """
+        self.done = done
+        self.total = total
+        self.locked_until = datetime.utcnow() + timedelta(seconds=lease_seconds)
+        db.session.commit()
+
+    def finish(self, result=None):
+        """ Marks a job as done """
+        self.status = self.DONE
+        self.result = result
+        self.error = None
+        self.locked_until = None
+        self.finished_at = datetime.utcnow()
+        db.session.commit()
+
+    def fail(self, error, retry_seconds):
+        """ Queues a job that raised again after a back off, or fails it for good
+
+        Args:
+            error (string): what went wrong
+            retry_seconds (float): the delay before the first retry, doubled each time
+        """
+        now = datetime.utcnow()
+        self.error = error
+        self.locked_until = None
+        if self.attempts < self.max_attempts:
+            self.status = self.QUEUED
+            self.run_at = now + timedelta(seconds=retry_seconds * 2 ** (self.attempts - 1))
+        else:
+            self.status = self.FAILED
+            self.finished_at = now
+        db.session.commit()
+
+
+_partition_by_tenant(Supplier.__table__)
+_partition_by_tenant(Product.__table__)
+
+# ids are unique across shards
+for _model in (Supplier, Product, Reservation):
+    event.listen(_model, 'before_insert', sharding.assign_id)
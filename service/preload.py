@@ -0,0 +1,81 @@
+"""
+Preloaded Workers
+
+With PRELOAD_APP (see gunicorn.conf.py) gunicorn imports the app once in
+its master and forks the workers from it, so they share the pages holding
+Flask, flask_restplus, the models and the compiled validators copy-on-write
+instead of each importing their own. The hooks here get the master ready
+for that:
+
+- warm() does what every worker would otherwise do on its first requests:
+  runs the before_first_request functions, builds the Swagger spec and the
+  template of the docs page and, when CATALOG_ENABLED is set, loads the
+  catalog of the default tenant
+- before_fork() closes the database connections the master opened, since
+  a socket used by two processes mixes up their conversations, and freezes
+  the objects of the master out of the garbage collector, whose collections
+  would write to every one of them and copy their pages into each worker
+- after_fork() turns the collector back on in the worker and starts the
+  log listener again, its thread stayed in the master
+
+The collector is off in the master from the moment gunicorn reads its
+config, so the import does not leave freed holes in the pages to share.
+A connection checked out in another process than the one that opened it
+is thrown away and replaced. The other threads of the service are
+WorkerThreads, see service.workers, and start afresh in a forked worker.
+"""
+import os
+import gc
+import logging
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+from service import log, sharding
+from service.models import db
+from service.service import api, catalog
+from . import app
+
+logger = logging.getLogger(__name__)
+
+
+@event.listens_for(Pool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    """ Notes the process that opened a connection """
+    connection_record.info['pid'] = os.getpid()
+
+
+@event.listens_for(Pool, 'checkout')
+def refuse_inherited(dbapi_connection, connection_record, connection_proxy):
+    """ Makes the pool replace a connection opened before a fork """
+    pid = connection_record.info.get('pid')
+    if pid is not None and pid != os.getpid():
+        # drop it without closing, the socket still belongs to the parent
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError(
+            "Connection opened in process {} checked out in {}".format(pid, os.getpid())
+        )
+
+
+def warm():
+    """ Does in the master what the workers would do on their first requests """
+    app.try_trigger_before_first_request_functions()
+    with app.test_request_context('/'):
+        if 'error' in api.__schema__:
+            logger.warning("Could not build the Swagger spec before forking")
+        app.jinja_env.get_template('swagger-ui.html')
+    if catalog.enabled:
+        catalog.refresh(full=True)
+    logger.info("Preloaded the app in the master %s", os.getpid())
+
+
+def before_fork():
+    """ Leaves nothing in the master that a worker must not share """
+    with app.app_context():
+        db.engine.dispose()
+    sharding.dispose()
+    gc.freeze()
+
+
+def after_fork():
+    """ Gets a forked worker going """
+    gc.enable()
+    log.restart_listener()
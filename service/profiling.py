@@ -0,0 +1,218 @@
+"""
+Profiling
+
+An opt-in, admin-only view into where a worker spends its time. Nothing in
+this module runs unless PROFILING_ENABLED is set when the service starts:
+the request hooks are not even registered otherwise.
+
+Two ways to profile, both guarded by the PROFILING_TOKEN sent in the
+X-Admin-Token header:
+
+- GET /api/admin/profile?seconds=N samples the stacks of every thread of
+  the worker that gets it for N seconds, from a thread of its own, so the
+  requests the worker serves meanwhile are sampled as well, on a sync
+  worker too; it answers 202 at once with the id the stacks can be fetched
+  with from GET /api/admin/profiles/{id} once the N seconds are over
+- any request sent with an X-Profile header runs under cProfile and a stack
+  sampler; the results are saved under PROFILE_DIR and the response carries
+  an X-Profile-Id to fetch them from GET /api/admin/profiles/{id}
+
+Stacks are written in the collapsed format read by flamegraph.pl and
+speedscope, one line per distinct stack with its sample count. Frames are
+named module:Class.method, e.g. service.service:SupplierCollection.get.
+"""
+import io
+import os
+import re
+import sys
+import hmac
+import time
+import pstats
+import cProfile
+import logging
+import threading
+from collections import Counter
+from uuid import uuid4
+from flask import request, g
+from . import app
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ID = re.compile(r'^[0-9a-f]{32}$')
+
+FORMATS = {
+    'collapsed': '.collapsed',
+    'pstats': '.txt',
+}
+
+
+######################################################################
+#  S T A C K   S A M P L I N G
+######################################################################
+def frame_name(frame):
+    """ Names a frame module:Class.method when it runs a method """
+    code = frame.f_code
+    name = code.co_name
+    if code.co_argcount and code.co_varnames[0] in ('self', 'cls'):
+        owner = frame.f_locals.get(code.co_varnames[0])
+        if owner is not None:
+            owner = owner if isinstance(owner, type) else type(owner)
+            name = owner.__name__ + '.' + name
+    return '{}:{}'.format(frame.f_globals.get('__name__', '?'), name)
+
+
+def collapse(frame):
+    """ Returns the stack of a frame, outermost first, joined with ; """
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class StackSampler():
+    """
+    Counts the stacks of threads sampled at a fixed interval
+
+    Args:
+        thread_ids (set): the threads to sample, or None for all others
+        interval (float): seconds between samples
+    """
+
+    def __init__(self, thread_ids=None, interval=0.005):
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        """ Takes one sample of the threads """
+        me = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():  # pylint: disable=protected-access
+            if thread_id == me:
+                continue
+            if self.thread_ids is None or thread_id in self.thread_ids:
+                self.stacks[collapse(frame)] += 1
+        self.samples += 1
+
+    def run(self, seconds):
+        """ Samples on the calling thread for a number of seconds """
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline and not self._stop.is_set():
+            self.sample()
+            self._stop.wait(self.interval)
+        return self
+
+    def start(self):
+        """ Samples on a background thread until stop() is called """
+        self._thread = threading.Thread(target=self.run, args=(float('inf'),), daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """ Stops a background sampler """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        return self
+
+    def collapsed(self):
+        """ Returns the samples in collapsed stack format """
+        return ''.join(
+            '{} {}\n'.format(stack, count) for stack, count in self.stacks.most_common()
+        )
+
+
+def sample_worker(seconds):
+    """ Samples every thread of this worker in the background
+
+    The collapsed stacks are saved under PROFILE_DIR when the time is up
+
+    Returns:
+        tuple: the profile id to fetch the stacks with and the seconds sampled
+    """
+    seconds = min(float(seconds), app.config['PROFILE_MAX_SECONDS'])
+    sampler = StackSampler(interval=app.config['PROFILE_SAMPLE_INTERVAL'])
+    profile_id = uuid4().hex
+    base = os.path.join(app.config['PROFILE_DIR'], profile_id)
+    os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+
+    def run():
+        sampler.run(seconds)
+        # under a temporary name, so the stacks are only found once complete
+        with open(base + '.new', 'w') as collapsed_file:
+            collapsed_file.write(sampler.collapsed())
+        os.rename(base + '.new', base + FORMATS['collapsed'])
+        logger.info("Saved profile %s of worker %s", profile_id, os.getpid())
+
+    threading.Thread(target=run, name='profile-worker', daemon=True).start()
+    logger.warning("Sampling worker %s for %s seconds", os.getpid(), seconds)
+    return profile_id, seconds
+
+
+######################################################################
+#  A C C E S S
+######################################################################
+def authorized():
+    """ Is the request carrying the admin token """
+    token = app.config['PROFILING_TOKEN']
+    offered = request.headers.get('X-Admin-Token', '')
+    return bool(token) and hmac.compare_digest(token.encode('utf8'), offered.encode('utf8'))
+
+
+def read_profile(profile_id, output):
+    """ Returns a saved profile of a request, or None if it does not exist """
+    if not PROFILE_ID.match(profile_id) or output not in FORMATS:
+        return None
+    path = os.path.join(app.config['PROFILE_DIR'], profile_id + FORMATS[output])
+    if not os.path.exists(path):
+        return None
+    with open(path) as profile_file:
+        return profile_file.read()
+
+
+######################################################################
+#  P E R - R E Q U E S T   P R O F I L I N G
+######################################################################
+def start_request_profile():
+    """ Profiles the request when asked by an admin """
+    if 'X-Profile' not in request.headers:
+        return
+    if not authorized():
+        logger.warning("Ignoring X-Profile without a valid admin token")
+        return
+    g.sampler = StackSampler({threading.get_ident()}, app.config['PROFILE_SAMPLE_INTERVAL'])
+    g.sampler.start()
+    g.profiler = cProfile.Profile()
+    g.profiler.enable()
+
+
+def finish_request_profile(response):
+    """ Saves the profile of the request and points the caller to it """
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return response
+    profiler.disable()
+    sampler = g.pop('sampler').stop()
+
+    stats = io.StringIO()
+    pstats.Stats(profiler, stream=stats).sort_stats('cumulative').print_stats(50)
+    profile_id = uuid4().hex
+    os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+    base = os.path.join(app.config['PROFILE_DIR'], profile_id)
+    with open(base + FORMATS['pstats'], 'w') as stats_file:
+        stats_file.write(stats.getvalue())
+    with open(base + FORMATS['collapsed'], 'w') as collapsed_file:
+        collapsed_file.write(sampler.collapsed())
+    profiler.dump_stats(base + '.prof')
+    logger.info("Saved profile %s of %s %s", profile_id, request.method, request.path)
+    response.headers['X-Profile-Id'] = profile_id
+    return response
+
+
+def init_profiling(app):
+    """ Registers the per-request profiling hooks """
+    app.before_request(start_request_profile)
+    app.after_request(finish_request_profile)
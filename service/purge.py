@@ -0,0 +1,65 @@
+"""
+Purging Deleted Rows
+
+Deleting a Supplier or Product only marks it with deleted_at, which is
+cheap and leaves the row for delta sync and audits. The rows are removed
+for good once they are older than PURGE_AFTER_DAYS, in batches of
+PURGE_BATCH_SIZE rows per transaction, so a large cleanup never holds a
+long lock or loads the rows into memory.
+
+Run it from cron with:
+  flask purge
+
+or hand it to the workers with:
+  flask jobs enqueue purge --params '{"days": 30}'
+"""
+import logging
+from datetime import datetime, timedelta
+import click
+from service.models import Supplier, Product
+from service import sharding, jobs
+from . import app
+
+logger = logging.getLogger(__name__)
+
+
+def purge_deleted(days=None, batch_size=None):
+    """
+    Removes the Suppliers and Products deleted more than some days ago
+
+    Products go first so the Suppliers are left with nothing to cascade to
+
+    Args:
+        days (int): how long deleted rows are kept, PURGE_AFTER_DAYS by default
+        batch_size (int): rows per transaction, PURGE_BATCH_SIZE by default
+    Returns:
+        dict: the number of rows removed from each table
+    """
+    days = app.config['PURGE_AFTER_DAYS'] if days is None else days
+    batch_size = batch_size or app.config['PURGE_BATCH_SIZE']
+    older_than = datetime.utcnow() - timedelta(days=days)
+    counts = {}
+    for _ in sharding.each_shard():
+        for model in (Product, Supplier):
+            counted = counts.get(model.__tablename__, 0)
+            counts[model.__tablename__] = counted + model.purge(older_than, batch_size)
+    logger.info("Purged rows deleted before %s: %s", older_than, counts)
+    return counts
+
+
+@jobs.handler('purge')
+def purge_job(job):
+    """ Purges deleted rows for a queued job, which may name days and batch_size """
+    return purge_deleted(job.params.get('days'), job.params.get('batch_size'))
+
+
+######################################################################
+#  C O M M A N D   L I N E
+######################################################################
+@app.cli.command('purge')
+@click.option('--days', type=int, default=None, help='Keep rows deleted more recently than this')
+@click.option('--batch-size', type=int, default=None, help='Rows deleted per transaction')
+def purge_command(days, batch_size):
+    """ Removes soft deleted Suppliers and Products for good """
+    for name, count in purge_deleted(days, batch_size).items():
+        click.echo("{}: {} rows purged".format(name, count))
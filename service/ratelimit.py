@@ -0,0 +1,300 @@
+"""
+Rate Limiting and Load Shedding
+
+Every request draws tokens from a bucket kept per client, where the client
+is the X-Api-Key header when it is one of RATE_LIMIT_API_KEYS, or else the
+remote address; behind a router PROXY_X_FOR makes that the address of the
+client from X-Forwarded-For instead of the router's. Each bucket refills at
+RATE_LIMIT_RATE tokens per second up to RATE_LIMIT_BURST, and endpoints cost
+different amounts: listing every Supplier costs far more than reading one.
+A client that runs out gets 429 with Retry-After set to when it can afford
+the request, so one busy integration cannot starve the others.
+
+Load shedding protects the worker itself. When more than SHED_MAX_IN_FLIGHT
+requests are running in this process, or a request waited in the router
+queue longer than SHED_MAX_QUEUE_MS (from the X-Request-Start header), it is
+turned away with 503 and Retry-After before doing any work.
+
+Tenants get budgets of their own so one business unit cannot crowd out
+the rest: at most TENANT_MAX_IN_FLIGHT requests of a tenant run in this
+worker at once, which also bounds the database connections it holds, and
+each tenant draws from a second bucket keyed tenant:<name> that refills at
+TENANT_RATE_LIMIT_RATE up to TENANT_RATE_LIMIT_BURST. A request the tenant
+bucket turns away gives the client back the tokens it drew.
+
+Buckets live in a pluggable backend chosen by RATE_LIMIT_BACKEND:
+
+memory - per worker, no shared state
+database - shared by every worker through one upsert per request
+"""
+import time
+import logging
+import threading
+from flask import request, g
+from sqlalchemy import text
+from service.models import db, current_tenant
+from . import app
+
+logger = logging.getLogger(__name__)
+
+# tokens drawn per request, by (endpoint, method)
+ENDPOINT_COSTS = {
+    ('supplier_collection', 'GET'): 10,
+    ('supplier_collection', 'POST'): 2,
+    ('supplier_resource', 'GET'): 1,
+    ('supplier_resource', 'PUT'): 2,
+    ('supplier_resource', 'DELETE'): 2,
+    ('preferred_resource', 'PUT'): 2,
+    ('preferred_resource', 'DELETE'): 2,
+    ('preferred_collection', 'PUT'): 10,
+    ('quantity_resource', 'POST'): 2,
+    ('reservation_collection', 'POST'): 2,
+    ('reservation_resource', 'DELETE'): 2,
+    ('snapshot_table_resource', 'GET'): 20,
+}
+DEFAULT_COST = 1
+
+# endpoints that are never limited
+EXEMPT_ENDPOINTS = {'static', 'doc', 'specs', 'restplus_doc.static'}
+
+
+class RateLimitExceeded(Exception):
+    """ Used when a client has spent its tokens """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ServiceOverloaded(Exception):
+    """ Used when the worker sheds load """
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+######################################################################
+#  B A C K E N D S
+######################################################################
+class MemoryBackend():
+    """ Token buckets held in this worker's memory """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def consume(self, key, cost, rate, burst, now=None):
+        """
+        Draws cost tokens from the bucket of a client
+
+        Returns:
+            tuple: (allowed, seconds until the request could be afforded)
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+    def refund(self, key, cost, burst):
+        """ Gives back tokens drawn for a request that was turned away after all """
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (burst, time.time()))
+            self._buckets[key] = (min(burst, tokens + cost), updated)
+
+    def reset(self):
+        """ Forgets every bucket """
+        with self._lock:
+            self._buckets.clear()
+
+
+class DatabaseBackend():
+    """ Token buckets shared by all workers in a database table
+
+    One INSERT ... ON CONFLICT DO UPDATE refills and draws atomically, so
+    concurrent workers never lose each other's updates.
+    """
+
+    UPSERT = text(
+        'INSERT INTO "RateLimitBucket" (key, tokens, updated_at, allowed) '
+        'VALUES (:key, CASE WHEN :burst >= :cost THEN :burst - :cost ELSE :burst END, :now, '
+        '  :burst >= :cost) '
+        'ON CONFLICT (key) DO UPDATE SET '
+        '  tokens = CASE WHEN LEAST(:burst, "RateLimitBucket".tokens '
+        '      + (:now - "RateLimitBucket".updated_at) * :rate) >= :cost '
+        '    THEN LEAST(:burst, "RateLimitBucket".tokens '
+        '      + (:now - "RateLimitBucket".updated_at) * :rate) - :cost '
+        '    ELSE LEAST(:burst, "RateLimitBucket".tokens '
+        '      + (:now - "RateLimitBucket".updated_at) * :rate) END, '
+        '  allowed = LEAST(:burst, "RateLimitBucket".tokens '
+        '      + (:now - "RateLimitBucket".updated_at) * :rate) >= :cost, '
+        '  updated_at = GREATEST(:now, "RateLimitBucket".updated_at) '
+        'RETURNING tokens, allowed'
+    )
+
+    REFUND = text(
+        'UPDATE "RateLimitBucket" SET tokens = LEAST(:burst, tokens + :cost) WHERE key = :key'
+    )
+
+    def consume(self, key, cost, rate, burst, now=None):
+        """
+        Draws cost tokens from the bucket of a client
+
+        Returns:
+            tuple: (allowed, seconds until the request could be afforded)
+        """
+        now = time.time() if now is None else now
+        params = dict(key=key, cost=float(cost), rate=float(rate), burst=float(burst), now=now)
+        with db.engine.begin() as connection:
+            tokens, allowed = connection.execute(self.UPSERT, params).first()
+        return allowed, 0 if allowed else (cost - tokens) / rate
+
+    def refund(self, key, cost, burst):
+        """ Gives back tokens drawn for a request that was turned away after all """
+        params = dict(key=key, cost=float(cost), burst=float(burst))
+        with db.engine.begin() as connection:
+            connection.execute(self.REFUND, params)
+
+    def reset(self):
+        """ Forgets every bucket """
+        with db.engine.begin() as connection:
+            connection.execute(text('DELETE FROM "RateLimitBucket"'))
+
+
+class RateLimitBucket(db.Model):
+    """ Class that represents the token bucket of one client """
+
+    __tablename__ = 'RateLimitBucket'
+    key = db.Column(db.String(128), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.Float, nullable=False)  # epoch seconds
+    allowed = db.Column(db.Boolean, nullable=False)
+
+
+BACKENDS = {
+    'memory': MemoryBackend,
+    'database': DatabaseBackend,
+}
+
+_backend = None
+
+
+def get_backend():
+    """ Returns the configured backend, creating it on first use """
+    global _backend
+    name = app.config['RATE_LIMIT_BACKEND']
+    if _backend is None or not isinstance(_backend, BACKENDS[name]):
+        _backend = BACKENDS[name]()
+    return _backend
+
+
+######################################################################
+#  L O A D   S H E D D I N G
+######################################################################
+_in_flight = 0
+_tenant_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+def _queue_wait_ms():
+    """ Returns how long the request waited before reaching the worker """
+    started = request.headers.get('X-Request-Start', '')
+    started = started[2:] if started.startswith('t=') else started
+    try:
+        started = float(started)
+    except ValueError:
+        return 0
+    # routers send seconds, milliseconds or microseconds since the epoch
+    while started > time.time() * 10:
+        started /= 1000
+    return max(0, (time.time() - started) * 1000)
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def client_key():
+    """ Identifies the client a request is charged to """
+    api_key = request.headers.get('X-Api-Key')
+    # an unknown key must not buy a fresh bucket
+    if api_key and api_key in app.config['RATE_LIMIT_API_KEYS']:
+        return 'key:' + api_key
+    return 'addr:' + (request.remote_addr or 'unknown')
+
+
+def request_cost():
+    """ Returns the tokens the current request costs """
+    return ENDPOINT_COSTS.get((request.endpoint, request.method), DEFAULT_COST)
+
+
+def _charge(key, cost, rate, burst, message):
+    """ Draws from the bucket of a key, honouring RATE_LIMIT_OVERRIDES """
+    rate, burst = app.config['RATE_LIMIT_OVERRIDES'].get(key, (rate, burst))
+    allowed, retry_after = get_backend().consume(key, cost, rate, burst)
+    if not allowed:
+        logger.warning("Rate limit exceeded for %s", key)
+        raise RateLimitExceeded(message, retry_after)
+
+
+def _refund(key, cost, burst):
+    """ Gives tokens back to the bucket of a key, honouring RATE_LIMIT_OVERRIDES """
+    _, burst = app.config['RATE_LIMIT_OVERRIDES'].get(key, (None, burst))
+    get_backend().refund(key, cost, burst)
+
+
+@app.before_request
+def limit_request():
+    """ Sheds load and charges the client before any work is done """
+    global _in_flight
+    g.counted_in_flight = None
+    if request.endpoint in EXEMPT_ENDPOINTS:
+        return
+    if app.config['SHED_ENABLED']:
+        tenant = current_tenant()
+        with _in_flight_lock:
+            overloaded = _in_flight >= app.config['SHED_MAX_IN_FLIGHT']
+            tenant_overloaded = _tenant_in_flight.get(tenant, 0) >= app.config['TENANT_MAX_IN_FLIGHT']
+            if not overloaded and not tenant_overloaded:
+                _in_flight += 1
+                _tenant_in_flight[tenant] = _tenant_in_flight.get(tenant, 0) + 1
+                g.counted_in_flight = tenant
+        if overloaded:
+            raise ServiceOverloaded("Too many requests in flight", app.config['SHED_RETRY_AFTER'])
+        if tenant_overloaded:
+            raise ServiceOverloaded(
+                "Too many requests in flight for this tenant", app.config['SHED_RETRY_AFTER']
+            )
+        if _queue_wait_ms() > app.config['SHED_MAX_QUEUE_MS']:
+            raise ServiceOverloaded("Request queued for too long", app.config['SHED_RETRY_AFTER'])
+
+    if app.config['RATE_LIMIT_ENABLED']:
+        cost = request_cost()
+        client = client_key()
+        _charge(client, cost, app.config['RATE_LIMIT_RATE'], app.config['RATE_LIMIT_BURST'],
+                "Rate limit exceeded for this client")
+        try:
+            _charge('tenant:' + current_tenant(), cost, app.config['TENANT_RATE_LIMIT_RATE'],
+                    app.config['TENANT_RATE_LIMIT_BURST'], "Rate limit exceeded for this tenant")
+        except RateLimitExceeded:
+            # the request is not served, so the client must not pay for it
+            _refund(client, cost, app.config['RATE_LIMIT_BURST'])
+            raise
+
+
+@app.teardown_request
+def release_request(exception=None):
+    """ Stops counting the request as in flight """
+    global _in_flight
+    tenant = g.get('counted_in_flight')
+    if tenant is not None:
+        with _in_flight_lock:
+            _in_flight -= 1
+            _tenant_in_flight[tenant] -= 1
+            if not _tenant_in_flight[tenant]:
+                del _tenant_in_flight[tenant]
+
@@ -0,0 +1,352 @@
+"""
+Supplier and Product Schema
+
+The single description of the Supplier and Product documents. Everything
+else is derived from it when the service starts:
+
+- validator functions, generated as Python source and compiled once, that
+  check a payload in one pass and return every error instead of stopping
+  at the first one
+- the flask_restplus models used for marshalling and the Swagger docs
+
+Validators take the document and a path prefix and return a list of error
+messages, empty when the document is valid:
+
+    errors = validate_supplier(payload)
+    errors = validate_many(validate_supplier, payloads)
+
+Read only fields are ignored on input and unknown fields are dropped by the
+models, as before.
+"""
+from flask_restplus import fields
+
+MISSING = object()
+
+# the largest value of a PostgreSQL integer column
+INTEGER_MAX = 2 ** 31 - 1
+
+
+class Field():
+    """
+    Describes one field of a document
+
+    Args:
+        kind (string): string, integer, boolean, datetime, object or array
+        required (boolean): must be present and not null on input
+        max_length (int): the longest string accepted
+        minimum (int): the smallest integer accepted
+        maximum (int): the largest integer accepted
+        read_only (boolean): set by the service and ignored on input
+        items (string): the schema name or the kind of array items
+    """
+
+    def __init__(self, kind, description, required=False, max_length=None,
+                 read_only=False, items=None, default=None, minimum=None, maximum=None):
+        self.kind = kind
+        self.description = description
+        self.required = required
+        self.max_length = max_length
+        self.read_only = read_only
+        self.items = items
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+
+
+PRODUCT_FIELDS = {
+    'id': Field('integer', 'The unique id assigned internally by service', read_only=True),
+    'supplier_id': Field('integer', 'The id of the Supplier of the Product'),
+    'name': Field('string', 'The name of the Product', required=True, max_length=63),
+    'desc': Field('string', 'The description of the Product', required=True, max_length=256),
+    'wholesale_price': Field('integer', 'The wholesale price of the Product', required=True),
+    'quantity': Field('integer', 'The quantity in stock', required=True),
+    'updated_at': Field('datetime', 'When the Product last changed', read_only=True),
+}
+
+SUPPLIER_FIELDS = {
+    'id': Field('integer', 'The unique id assigned internally by service', read_only=True),
+    'name': Field('string', 'The name of the Supplier', required=True, max_length=63),
+    'category': Field('string', 'The category of Supplier (e.g., furnishing, home & beauty etc.)',
+                      required=True, max_length=63),
+    'address': Field('string', 'The address of the Supplier', required=True, max_length=128),
+    'email': Field('string', 'The email of the Supplier', required=True, max_length=63),
+    'phone_number': Field('string', 'The phone number of the Supplier', max_length=32),
+    'preferred': Field('boolean', 'Is the Supplier preferred?'),
+    'products': Field('array', 'The Products the Supplier sells', required=True, items='Product'),
+    'updated_at': Field('datetime', 'When the Supplier or one of its products last changed',
+                        read_only=True),
+    'deleted': Field('boolean', 'Is this a tombstone for a deleted Supplier?',
+                     read_only=True, default=False),
+}
+
+PREFERRED_UPDATE_FIELDS = {
+    'ids': Field('array', 'The ids of the Suppliers to change', required=True, items='integer'),
+    'preferred': Field('boolean', 'The new value of the preferred flag', required=True),
+}
+
+QUANTITY_ADJUSTMENT_FIELDS = {
+    'delta': Field('integer', 'The amount to add to the quantity, negative to take away',
+                   required=True),
+}
+
+RESERVATION_ITEM_FIELDS = {
+    'product_id': Field('integer', 'The id of the Product to reserve', required=True),
+    'quantity': Field('integer', 'How many to reserve', required=True, minimum=1),
+}
+
+RESERVATION_REQUEST_FIELDS = {
+    'items': Field('array', 'The Products to reserve together', required=True,
+                   items='ReservationItem'),
+    'reference': Field('string', 'The order the reservation is for', max_length=63),
+}
+
+RESERVATION_FIELDS = {
+    'id': Field('integer', 'The unique id assigned internally by service', read_only=True),
+    'product_id': Field('integer', 'The id of the reserved Product', read_only=True),
+    'quantity': Field('integer', 'How many are reserved', read_only=True),
+    'reference': Field('string', 'The order the reservation is for', read_only=True),
+    'status': Field('string', 'held or released', read_only=True),
+    'created_at': Field('datetime', 'When the stock was reserved', read_only=True),
+}
+
+SUPPLIER_LOOKUP_FIELDS = {
+    'ids': Field('array', 'The ids of the Suppliers to find', required=True, items='integer'),
+}
+
+SUPPLIER_LOOKUP_RESULT_FIELDS = {
+    'suppliers': Field('array', 'The Suppliers found, in the order asked for',
+                       read_only=True, items='Supplier'),
+    'missing': Field('array', 'The ids that were not found', read_only=True, items='integer'),
+}
+
+SUPPLIER_IMPORT_FIELDS = {
+    'suppliers': Field('array', 'The Suppliers to create', required=True, items='Supplier'),
+}
+
+QUANTITY_DELTA_FIELDS = {
+    'product_id': Field('integer', 'The id of the Product', required=True,
+                        minimum=1, maximum=INTEGER_MAX),
+    'delta': Field('integer', 'The amount to add to the quantity, negative to take away',
+                   required=True, minimum=-INTEGER_MAX, maximum=INTEGER_MAX),
+}
+
+QUANTITY_DELTAS_FIELDS = {
+    'deltas': Field('array', 'The stock movements to write', required=True, items='QuantityDelta'),
+}
+
+OFFER_FIELDS = {
+    'product_id': Field('integer', 'The id of the Product on offer', read_only=True),
+    'supplier_id': Field('integer', 'The id of the Supplier selling it', read_only=True),
+    'name': Field('string', 'The name of the Product', read_only=True),
+    'wholesale_price': Field('integer', 'The wholesale price of the Product', read_only=True),
+    'quantity': Field('integer', 'The quantity in stock', read_only=True),
+}
+
+PRICE_POINT_FIELDS = {
+    'at': Field('datetime', 'When the price was recorded, or the day it sums up', read_only=True),
+    'low': Field('integer', 'The lowest price', read_only=True),
+    'high': Field('integer', 'The highest price', read_only=True),
+    'avg': Field('number', 'The average of the prices recorded', read_only=True),
+    'close': Field('integer', 'The last price', read_only=True),
+}
+
+PRICE_STATS_FIELDS = {
+    'count': Field('integer', 'How many prices were recorded', read_only=True),
+    'min': Field('integer', 'The lowest price recorded', read_only=True),
+    'max': Field('integer', 'The highest price recorded', read_only=True),
+    'avg': Field('number', 'The average of the prices recorded', read_only=True),
+}
+
+JOB_FIELDS = {
+    'id': Field('integer', 'The unique id assigned internally by service', read_only=True),
+    'kind': Field('string', 'What the job does', read_only=True),
+    'status': Field('string', 'queued, running, done or failed', read_only=True),
+    'attempts': Field('integer', 'How many times the job was started', read_only=True),
+    'done': Field('integer', 'How much of the work is done', read_only=True),
+    'total': Field('integer', 'How much work there is, when known', read_only=True),
+    'result': Field('object', 'What the job produced once done', read_only=True),
+    'error': Field('string', 'Why the last attempt failed', read_only=True),
+    'created_at': Field('datetime', 'When the job was queued', read_only=True),
+    'finished_at': Field('datetime', 'When the job was done or failed', read_only=True),
+}
+
+SCHEMAS = {
+    'Product': PRODUCT_FIELDS,
+    'Supplier': SUPPLIER_FIELDS,
+    'PreferredUpdate': PREFERRED_UPDATE_FIELDS,
+    'QuantityAdjustment': QUANTITY_ADJUSTMENT_FIELDS,
+    'ReservationItem': RESERVATION_ITEM_FIELDS,
+    'ReservationRequest': RESERVATION_REQUEST_FIELDS,
+    'Reservation': RESERVATION_FIELDS,
+    'SupplierLookup': SUPPLIER_LOOKUP_FIELDS,
+    'SupplierLookupResult': SUPPLIER_LOOKUP_RESULT_FIELDS,
+    'SupplierImport': SUPPLIER_IMPORT_FIELDS,
+    'QuantityDelta': QUANTITY_DELTA_FIELDS,
+    'QuantityDeltas': QUANTITY_DELTAS_FIELDS,
+    'Offer': OFFER_FIELDS,
+    'PricePoint': PRICE_POINT_FIELDS,
+    'PriceStats': PRICE_STATS_FIELDS,
+    'Job': JOB_FIELDS,
+}
+
+TYPE_CHECKS = {
+    'string': ('str', 'a string'),
+    'integer': ('int', 'an integer'),
+    'number': ('float', 'a number'),
+    'boolean': ('bool', 'a boolean'),
+    'datetime': ('str', 'an ISO 8601 string'),
+    'array': ('list', 'an array'),
+    'object': ('dict', 'an object'),
+}
+
+
+######################################################################
+#  V A L I D A T O R S
+######################################################################
+def _validator_source(name, schema):
+    """ Generates the Python source of the validator for a schema """
+    lines = [
+        "def validate_{}(data, path=''):".format(name.lower()),
+        "    if not isinstance(data, dict):",
+        "        return [path + 'body must be an object']",
+        "    errors = []",
+    ]
+    for key, field in schema.items():
+        if field.read_only:
+            continue
+        type_name, type_label = TYPE_CHECKS[field.kind]
+        lines.append("    value = data.get({!r}, MISSING)".format(key))
+        lines.append("    if value is MISSING or value is None:")
+        if field.required:
+            lines.append("        errors.append(path + {!r})".format(key + " is required"))
+        else:
+            lines.append("        pass")
+        lines.append("    elif type(value) is not {}:".format(type_name))
+        lines.append("        errors.append(path + {!r})".format(
+            "{} must be {}".format(key, type_label)
+        ))
+        if field.max_length:
+            lines += [
+                "    elif len(value) > {}:".format(field.max_length),
+                "        errors.append(path + {!r})".format(
+                    "{} must be at most {} characters".format(key, field.max_length)
+                ),
+            ]
+        if field.minimum is not None:
+            lines += [
+                "    elif value < {}:".format(field.minimum),
+                "        errors.append(path + {!r})".format(
+                    "{} must be at least {}".format(key, field.minimum)
+                ),
+            ]
+        if field.maximum is not None:
+            lines += [
+                "    elif value > {}:".format(field.maximum),
+                "        errors.append(path + {!r})".format(
+                    "{} must be at most {}".format(key, field.maximum)
+                ),
+            ]
+        if field.items in TYPE_CHECKS:
+            item_type, item_label = TYPE_CHECKS[field.items]
+            lines += [
+                "    else:",
+                "        for index, item in enumerate(value):",
+                "            if type(item) is not {}:".format(item_type),
+                "                errors.append(path + '{}[%d] must be {}' % index)".format(
+                    key, item_label
+                ),
+            ]
+        elif field.items:
+            lines += [
+                "    else:",
+                "        for index, item in enumerate(value):",
+                "            errors.extend(validate_{}(item, path + '{}[%d].' % index))".format(
+                    field.items.lower(), key
+                ),
+            ]
+    lines.append("    return errors")
+    return "\n".join(lines)
+
+
+def compile_validators(schemas):
+    """ Compiles a validator function for every schema
+
+    Returns:
+        dict: the validator function of each schema name
+    """
+    namespace = {'MISSING': MISSING}
+    validators = {}
+    for name, schema in schemas.items():
+        source = _validator_source(name, schema)
+        exec(compile(source, '<schema {}>'.format(name), 'exec'), namespace)
+        validators[name] = namespace['validate_' + name.lower()]
+        validators[name].source = source
+    return validators
+
+
+def validate_many(validator, items):
+    """ Validates a list of documents and returns the errors of all of them """
+    if not isinstance(items, list):
+        return ['body must be an array']
+    errors = []
+    for index, item in enumerate(items):
+        errors.extend(validator(item, '[%d].' % index))
+    return errors
+
+
+VALIDATORS = compile_validators(SCHEMAS)
+validate_product = VALIDATORS['Product']
+validate_supplier = VALIDATORS['Supplier']
+validate_preferred_update = VALIDATORS['PreferredUpdate']
+validate_quantity_adjustment = VALIDATORS['QuantityAdjustment']
+validate_reservation_request = VALIDATORS['ReservationRequest']
+validate_supplier_lookup = VALIDATORS['SupplierLookup']
+validate_supplier_import = VALIDATORS['SupplierImport']
+validate_quantity_deltas = VALIDATORS['QuantityDeltas']
+
+
+######################################################################
+#  A P I   M O D E L S
+######################################################################
+def _api_field(field, models):
+    """ Builds the flask_restplus field of a schema field """
+    options = dict(
+        description=field.description, required=field.required, readonly=field.read_only
+    )
+    if field.max_length:
+        options['max_length'] = field.max_length
+    if field.default is not None:
+        options['default'] = field.default
+    if field.minimum is not None:
+        options['min'] = field.minimum
+    if field.maximum is not None:
+        options['max'] = field.maximum
+    if field.kind == 'string':
+        return fields.String(**options)
+    if field.kind == 'integer':
+        return fields.Integer(**options)
+    if field.kind == 'number':
+        return fields.Float(**options)
+    if field.kind == 'boolean':
+        return fields.Boolean(**options)
+    if field.kind == 'datetime':
+        return fields.DateTime(**options)
+    if field.kind == 'object':
+        return fields.Raw(**options)
+    if field.items in TYPE_CHECKS:
+        return fields.List(_api_field(Field(field.items, field.description), models), **options)
+    return fields.List(fields.Nested(models[field.items]), **options)
+
+
+def api_models(api):
+    """ Registers a flask_restplus model for every schema on an Api
+
+    Returns:
+        dict: the model of each schema name
+    """
+    models = {}
+    for name, schema in SCHEMAS.items():
+        models[name] = api.model(name, {
+            key: _api_field(field, models) for key, field in schema.items()
+        })
+    return models
@@ -5,15 +5,41 @@ Paths:
 ------
 GET / - Displays a UI for Selenium testing
 GET /suppliers - Returns a list all of the Suppliers
+GET /suppliers?ids={id},{id} - Returns the Suppliers with the given ids
+GET /suppliers?sort={field}&order=desc - Returns the Suppliers sorted by name, category, id or updated_at
+POST /suppliers:lookup - Returns the Suppliers with the ids in the body
 GET /suppliers/{id} - Returns the Supplier with a given id number
 POST /suppliers - creates a new Supplier record in the database
 PUT /suppliers/{id} - updates a Supplier record in the database
 DELETE /suppliers/{id} - deletes a Supplier record in the database
+PUT /suppliers/{id}/preferred - marks a Supplier as preferred
+DELETE /suppliers/{id}/preferred - marks a Supplier as not preferred
+PUT /suppliers/preferred - sets the preferred flag of many Suppliers
+POST /suppliers/{id}/products/{id}/quantity - adjusts the stock of a Product
+POST /products/quantity-deltas - queues stock movements of many Products to write in batches
+GET /products/quantity-deltas - returns the counters of the write-behind buffer
+GET /products/compare?name={name} - returns the cheapest offer of each Supplier for a Product
+GET /products/{id}/prices - returns the wholesale price history of a Product
+GET /products/{id}/prices/stats - returns the min, max and average price of a Product
+GET /suppliers/{id}/prices/stats - returns the min, max and average price of a Supplier
+POST /reservations - reserves stock of one or more Products
+GET /reservations/{id} - returns the Reservation with a given id number
+DELETE /reservations/{id} - releases the stock of a Reservation
+POST /suppliers/import - queues a bulk import of Suppliers
+POST /snapshots - queues a new analytics snapshot
+GET /jobs/{id} - returns the status and progress of a queued Job
 """
 
 import os
 import sys
+import json
+import math
+import base64
+import binascii
 import logging
+from datetime import datetime, timedelta, timezone
+from functools import wraps
+from collections import OrderedDict
 #from functools import wraps
 from flask import Flask, jsonify, request, url_for, make_response, abort, render_template
 from flask_api import status  # HTTP Status Codes
@@ -22,7 +48,16 @@ from flask_restplus import Api, Resource, fields, reqparse, inputs
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from service.models import Supplier, DataValidationError, Product
+from sqlalchemy.orm import selectinload
+from service.models import Supplier, DataValidationError, Product, Tombstone, BestOffer
+from service.models import PriceHistory, PriceRollup
+from service.models import Reservation, ReservationError, Job, current_tenant
+from service import snapshot, schema, profiling, jobs
+from service import tracing, sharding, writebehind
+from service.catalog import Catalog
+from service.ratelimit import RateLimitExceeded, ServiceOverloaded
+from service.deadlines import DeadlineExceeded, ClientDisconnected
+from service.breaker import StaleCache, DatabaseUnavailable
 
 # Import Flask application
 from . import app
@@ -38,44 +73,106 @@ api = Api(app,
          default_label='Everything About Suppliers',
          doc='/apidocs', # default also could use doc='/apidocs/'
           #authorizations=authorizations,
-         prefix='/api'
+         prefix='/api',
+         decorators=[tracing.trace_resource]
         )
 
-#Define the model so that the docs reflect what can be sent
-supplier_model = api.model('Supplier', {
-    '_id': fields.Integer(readOnly=True,
-                         description='The unique id assigned internally by service'),
-    'name': fields.String(required=True,
-                          description='The name of the Supplier'),
-    'category': fields.String(required=True,
-                              description='The category of Supplier (e.g., furnishing, home & beauty etc.)'),
-    'preferred': fields.Boolean(required=True,
-                                description='Is the Supplier preferred?')
-})
-
-create_model = api.model('Supplier', {
-    'name': fields.String(required=True,
-                          description='The name of the Supplier'),
-    'category': fields.String(required=True,
-                              description='The category of Supplier (e.g., furnishing, home & beauty etc.)'),
-    'preferred': fields.Boolean(required=True,
-                                description='Is the Supplier preferred?')
-})
+#Define the models so that the docs reflect what can be sent
+models = schema.api_models(api)
+product_model = models['Product']
+supplier_model = models['Supplier']
+preferred_update_model = models['PreferredUpdate']
+quantity_adjustment_model = models['QuantityAdjustment']
+quantity_deltas_model = models['QuantityDeltas']
+reservation_request_model = models['ReservationRequest']
+reservation_model = models['Reservation']
+supplier_lookup_model = models['SupplierLookup']
+supplier_lookup_result_model = models['SupplierLookupResult']
+supplier_import_model = models['SupplierImport']
+job_model = models['Job']
+offer_model = models['Offer']
+price_point_model = models['PricePoint']
+price_stats_model = models['PriceStats']
+
+def _id_list(value):
+    """ Parses a comma separated list of ids """
+    return [int(item) for item in value.split(',') if item.strip()]
 
 # # query string arguments
 supplier_args = reqparse.RequestParser()
+supplier_args.add_argument('ids', type=_id_list, required=False,
+                           help='Comma separated ids of the Suppliers to return, in that order')
 supplier_args.add_argument('name', type=str, required=False, help='List Suppliers by name')
 supplier_args.add_argument('category', type=str, required=False, help='List Suppliers by category')
 supplier_args.add_argument('preferred', type=inputs.boolean, required=False, help='List Suppliers by preferred')
+supplier_args.add_argument('modified_since', type=inputs.datetime_from_iso8601, required=False,
+                           help='List Suppliers changed or deleted after this ISO 8601 timestamp, '
+                                'pass X-Server-Time of the last sync; some may be listed again, '
+                                'the deleted ones on the last page')
+supplier_args.add_argument('sort', type=str, required=False, default='id', choices=Supplier.SORT_KEYS,
+                           help='The field to list Suppliers by, ties are listed by id')
+supplier_args.add_argument('order', type=str, required=False, default='asc', choices=('asc', 'desc'),
+                           help='List Suppliers in ascending or descending order')
+supplier_args.add_argument('after', type=str, required=False,
+                           help='List Suppliers after this cursor (X-Next-Cursor of the last page)')
+supplier_args.add_argument('limit', type=inputs.positive, required=False,
+                           help='The most Suppliers to return')
+
+# optional in-memory index that serves the GET endpoints (CATALOG_ENABLED)
+catalog = Catalog(api, supplier_model)
+
+# last good responses of the GET endpoints, served while the database is down
+stale = StaleCache(api)
+
+snapshot_args = reqparse.RequestParser()
+snapshot_args.add_argument('columns', type=str, required=False,
+                           help='Comma separated list of columns to read')
+
+compare_args = reqparse.RequestParser()
+compare_args.add_argument('name', type=str, required=True, help='The name of the Product to compare')
+compare_args.add_argument('limit', type=inputs.positive, required=False, default=10,
+                          help='The most Suppliers to return')
+
+price_args = reqparse.RequestParser()
+price_args.add_argument('since', type=inputs.datetime_from_iso8601, required=False,
+                        help='The start of the range, PRICE_DEFAULT_DAYS before until by default')
+price_args.add_argument('until', type=inputs.datetime_from_iso8601, required=False,
+                        help='The end of the range, now by default')
+price_args.add_argument('interval', type=str, required=False, default='raw', choices=('raw', 'day'),
+                        help='Every price recorded or one point for each day')
+
+preferred_args = reqparse.RequestParser()
+preferred_args.add_argument('expected', type=inputs.boolean, required=False,
+                            help='Only change the flag if it currently has this value')
+
+profile_args = reqparse.RequestParser()
+profile_args.add_argument('seconds', type=float, required=False, default=5,
+                          help='How long to sample the worker for')
+
+profile_output_args = reqparse.RequestParser()
+profile_output_args.add_argument('format', type=str, required=False, default='collapsed',
+                                 choices=sorted(profiling.FORMATS),
+                                 help='collapsed stacks for flame graphs or cProfile stats')
 
 
 ######################################################################
 # Error Handlers
 ######################################################################
+@api.errorhandler(DataValidationError)
 @app.errorhandler(DataValidationError)
 def request_validation_error(error):
-    """ Handles Value Errors from bad data """
-    return bad_request(error)
+    """ Handles Value Errors from bad data with every error found """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        dict(
+            status=status.HTTP_400_BAD_REQUEST,
+            error="Bad Request",
+            message=message,
+            errors=error.errors,
+        ),
+        status.HTTP_400_BAD_REQUEST,
+    )
 
 
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
@@ -146,6 +243,85 @@ def internal_server_error(error):
         status.HTTP_500_INTERNAL_SERVER_ERROR,
     )
 
+@api.errorhandler(RateLimitExceeded)
+@app.errorhandler(RateLimitExceeded)
+def too_many_requests(error):
+    """ Handles clients over their rate limit with 429_TOO_MANY_REQUESTS """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        dict(
+            status=status.HTTP_429_TOO_MANY_REQUESTS,
+            error="Too Many Requests",
+            message=message,
+        ),
+        status.HTTP_429_TOO_MANY_REQUESTS,
+        {'Retry-After': str(max(1, math.ceil(error.retry_after)))},
+    )
+
+
+@api.errorhandler(ServiceOverloaded)
+@app.errorhandler(ServiceOverloaded)
+def service_overloaded(error):
+    """ Handles shed requests with 503_SERVICE_UNAVAILABLE """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        dict(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {'Retry-After': str(max(1, math.ceil(error.retry_after)))},
+    )
+
+@api.errorhandler(DatabaseUnavailable)
+@app.errorhandler(DatabaseUnavailable)
+def database_unavailable(error):
+    """ Handles requests kept away from the database with 503_SERVICE_UNAVAILABLE """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        dict(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+        {'Retry-After': str(max(1, math.ceil(error.retry_after)))},
+    )
+
+@api.errorhandler(DeadlineExceeded)
+@app.errorhandler(DeadlineExceeded)
+def deadline_exceeded(error):
+    """ Handles requests that ran out of time with 504_GATEWAY_TIMEOUT """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        dict(
+            status=status.HTTP_504_GATEWAY_TIMEOUT,
+            error="Gateway Timeout",
+            message=message,
+        ),
+        status.HTTP_504_GATEWAY_TIMEOUT,
+    )
+
+@api.errorhandler(ClientDisconnected)
+@app.errorhandler(ClientDisconnected)
+def client_disconnected(error):
+    """ Handles requests whose client went away with 503_SERVICE_UNAVAILABLE """
+    message = str(error)
+    app.logger.warning(message)
+    return (
+        dict(
+            status=status.HTTP_503_SERVICE_UNAVAILABLE,
+            error="Service Unavailable",
+            message=message,
+        ),
+        status.HTTP_503_SERVICE_UNAVAILABLE,
+    )
+
 ######################################################################
 #  PATH: /suppliers/{id}
 ######################################################################
@@ -166,7 +342,10 @@ class SupplierResource(Resource):
     #------------------------------------------------------------------
     @api.doc('get_suppliers')
     @api.response(404, 'Supplier not found')
-    @api.marshal_with(supplier_model)
+    @api.response(503, 'The database is unavailable and the Supplier was never read before')
+    @stale.serve
+    @catalog.serve_one
+    @tracing.traced_marshal(api.marshal_with(supplier_model))
     def get(self, supplier_id):
         """
         Retrieve a single Supplier
@@ -177,7 +356,9 @@ class SupplierResource(Resource):
         supplier = Supplier.find(supplier_id)
         if not supplier:
             api.abort(status.HTTP_404_NOT_FOUND, "Supplier with id '{}' was not found.".format(supplier_id))
-        return supplier.serialize(), status.HTTP_200_OK
+        with tracing.span('serialize'):
+            result = supplier.serialize()
+        return result, status.HTTP_200_OK
 
     #------------------------------------------------------------------
     # DELETE A SUPPLIER
@@ -195,11 +376,82 @@ class SupplierResource(Resource):
         supplier = Supplier.find(supplier_id)
         if supplier:
             supplier.delete()
+            catalog.remove(supplier.id)
+        # the last good response must not bring the Supplier back while the database is down
+        stale.evict(current_tenant(), request.path)
         return '', status.HTTP_204_NO_CONTENT
 
 ######################################################################
 #  PATH: /suppliers
 ######################################################################
+def _serve_ids(func):
+    """ Answers GET /suppliers?ids= with the Suppliers asked for
+
+    The ids not found are listed in the X-Missing-Ids header
+    """
+    @wraps(func)
+    def wrapper(resource):
+        ids = supplier_args.parse_args()['ids']
+        if ids is None:
+            return func(resource)
+        documents, missing = _lookup(ids)
+        headers = {'X-Missing-Ids': ','.join(str(i) for i in missing)} if missing else None
+        return catalog.respond(b'[' + b','.join(documents) + b']', headers)
+    return wrapper
+
+def _lookup(supplier_ids):
+    """ Finds many Suppliers by id
+
+    The catalog answers for the Suppliers it holds, when it is enabled,
+    and the others are read with one query
+
+    Returns:
+        tuple: the JSON of the Suppliers found in the order asked for, and
+            the ids that were not found
+    """
+    ids = list(OrderedDict.fromkeys(supplier_ids))
+    if len(ids) > app.config['LOOKUP_MAX_IDS']:
+        api.abort(status.HTTP_400_BAD_REQUEST,
+                  'At most {} Suppliers can be looked up at once.'.format(app.config['LOOKUP_MAX_IDS']))
+    app.logger.info('Request to look up [%s] Suppliers', len(ids))
+    documents = catalog.for_tenant(current_tenant()).lookup(ids) if catalog.enabled else {}
+    unknown = [supplier_id for supplier_id in ids if supplier_id not in documents]
+    if unknown:
+        for supplier in Supplier.find_many(unknown):
+            documents[supplier.id] = catalog.encode(supplier)
+    return (
+        [documents[supplier_id] for supplier_id in ids if supplier_id in documents],
+        [supplier_id for supplier_id in ids if supplier_id not in documents],
+    )
+
+
+def _encode_cursor(supplier, sort):
+    """ Returns the X-Next-Cursor that continues a list after a Supplier
+
+    The cursor is the id when listing by id and otherwise the sort value
+    and id, as URL safe base64 JSON
+    """
+    if sort == 'id':
+        return str(supplier.id)
+    value, supplier_id = supplier.sort_key(sort)
+    if isinstance(value, datetime):
+        value = value.isoformat()
+    return base64.urlsafe_b64encode(json.dumps([value, supplier_id]).encode('utf8')).decode('ascii')
+
+def _decode_cursor(cursor, sort):
+    """ Returns the sort key an X-Next-Cursor stands for, see Supplier.sort_key() """
+    try:
+        if sort == 'id':
+            return (int(cursor),)
+        value, supplier_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if sort == 'updated_at':
+            value = datetime.fromisoformat(value)
+        return (value, int(supplier_id))
+    except (ValueError, TypeError, binascii.Error):
+        api.abort(status.HTTP_400_BAD_REQUEST,
+                  "The cursor '{}' is not one returned when listing by {}.".format(cursor, sort))
+
+
 @api.route('/suppliers', strict_slashes=False)
 class SupplierCollection(Resource):
     """ Handles all interactions with collections of Suppliers """
@@ -208,13 +460,27 @@ class SupplierCollection(Resource):
     #------------------------------------------------------------------
     @api.doc('list_suppliers')
     @api.expect(supplier_args, validate=True)
-    @api.marshal_list_with(supplier_model)
+    @api.response(503, 'The database is unavailable and the list was never read before')
+    @stale.serve
+    @_serve_ids
+    @catalog.serve_list(supplier_args)
+    @tracing.traced_marshal(api.marshal_list_with(supplier_model))
     def get(self):
         """ Returns all of the Suppliers """
         app.logger.info('Request to list Suppliers...')
+        # writers stamp updated_at when they flush, before they commit: a row
+        # stamped before this read may only show up after it, so the cursor
+        # steps back by SYNC_OVERLAP_SECONDS and the next sync sends it again
+        server_time = datetime.utcnow() - timedelta(seconds=app.config['SYNC_OVERLAP_SECONDS'])
         suppliers = []
+        tombstones = []
         args = supplier_args.parse_args()
-        if args['category']:
+        if args['modified_since']:
+            since = _naive_utc(args['modified_since'])
+            app.logger.info('Filtering by modified since: %s', since)
+            suppliers = Supplier.find_modified_since(since)
+            tombstones = Tombstone.find_since(Supplier.__tablename__, since)
+        elif args['category']:
             app.logger.info('Filtering by category: %s', args['category'])
             suppliers = Supplier.find_by_category(args['category'])
         elif args['name']:
@@ -224,18 +490,38 @@ class SupplierCollection(Resource):
             app.logger.info('Filtering by preferred: %s', args['preferred'])
             suppliers = Supplier.find_by_preferred(args['preferred'])
         else:
-            suppliers = Supplier.all()
+            suppliers = Supplier.active()
+
+        # keyset pages in sort order, read off the matching index of every shard
+        sort = args['sort']
+        descending = args['order'] == 'desc'
+        after = _decode_cursor(args['after'], sort) if args['after'] is not None else None
+        suppliers = Supplier.page(suppliers.options(selectinload(Supplier.products)),
+                                  sort, descending, after, args['limit'])
+        suppliers = sharding.gather(suppliers, args['limit'],
+                                    key=lambda supplier: supplier.sort_key(sort), reverse=descending)
 
-        app.logger.info('[%s] Suppliers returned', len(suppliers))
-        results = [supplier.serialize() for supplier in suppliers]
-        return results, status.HTTP_200_OK
+        headers = {'X-Server-Time': server_time.isoformat()}
+        if args['limit'] and len(suppliers) == args['limit']:
+            headers['X-Next-Cursor'] = _encode_cursor(suppliers[-1], sort)
+            # deletes have no place in the sort order, they all come once on the last page
+            tombstones = []
+        elif tombstones:
+            tombstones = sharding.gather(tombstones.order_by(Tombstone.id))
+        with tracing.span('serialize'):
+            results = [supplier.serialize() for supplier in suppliers]
+            results.extend(tombstone.serialize() for tombstone in tombstones)
+        app.logger.info('[%s] Suppliers returned', len(results))
+        # clients pass X-Server-Time back as modified_since on their next sync,
+        # and must expect the rows changed within the overlap a second time
+        return results, status.HTTP_200_OK, headers
 
 
     #------------------------------------------------------------------
     # ADD A NEW SUPPLIER
     #------------------------------------------------------------------
     @api.doc('create_suppliers')#, security='apikey')
-    @api.expect(create_model)
+    @api.expect(supplier_model)
     @api.response(400, 'The posted data was not valid')
     @api.response(201, 'Supplier created successfully')
     @api.marshal_with(supplier_model, code=201)
@@ -250,21 +536,47 @@ class SupplierCollection(Resource):
         app.logger.debug('Payload = %s', api.payload)
         supplier.deserialize(api.payload)
         supplier.create()
+        catalog.put(supplier)
         app.logger.info('Supplier with new id [%s] saved!', supplier.id)
         location_url = api.url_for(SupplierResource, supplier_id=supplier.id, _external=True)
         return supplier.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
 
+######################################################################
+#  PATH: /suppliers:lookup
+######################################################################
+@api.route('/suppliers:lookup')
+class SupplierLookup(Resource):
+    """ Finds many Suppliers at once """
+    @api.doc('lookup_suppliers')
+    @api.expect(supplier_lookup_model)
+    @api.response(400, 'The posted data was not valid')
+    @api.response(200, 'The Suppliers found', supplier_lookup_result_model)
+    def post(self):
+        """
+        Retrieve many Suppliers by id
+
+        Takes the ids in the body when there are too many for a query
+        string, and returns the Suppliers found in the order asked for
+        with the ids that were not found
+        """
+        _validate(schema.validate_supplier_lookup, api.payload, 'Invalid Supplier lookup')
+        documents, missing = _lookup(api.payload['ids'])
+        body = b'{"suppliers":[' + b','.join(documents) + b'],"missing":'
+        return catalog.respond(body + json.dumps(missing).encode('utf8') + b'}')
+
+
 ######################################################################
 #  PATH: /suppliers/{id}/preferred
 ######################################################################
-@api.route('/suppliers/<supplier_id>/preferred')
+@api.route('/suppliers/<int:supplier_id>/preferred')
 @api.param('supplier_id', 'The Supplier identifier')
 class PreferredResource(Resource):
     """ Preferred actions on a Supplier """
     @api.doc('preferred_suppliers')
+    @api.expect(preferred_args, validate=True)
     @api.response(404, 'Supplier not found')
-    @api.response(409, 'The Supplier is not preferred')
+    @api.response(409, 'The preferred flag did not have the expected value')
     def put(self, supplier_id):
         """
         Preferred a Supplier
@@ -272,15 +584,456 @@ class PreferredResource(Resource):
         This endpoint will make the Supplier a preferred supplier
         """
         app.logger.info('Request to Preferred a Supplier')
-        supplier = Supplier.find(supplier_id)
-        if not supplier:
-            api.abort(status.HTTP_404_NOT_FOUND, 'Supplier with id [{}] was not found.'.format(supplier_id))
-        if not supplier.preferred:
-            api.abort(status.HTTP_409_CONFLICT, 'Supplier with id [{}] is not preferred.'.format(supplier_id))
-        supplier.preferred = False
-        supplier.save()
-        app.logger.info('Supplier with id [%s] has been preferredd!', supplier.id)
-        return supplier.serialize(), status.HTTP_200_OK
+        return _mark_preferred(supplier_id, True)
+
+    @api.doc('unpreferred_suppliers')
+    @api.expect(preferred_args, validate=True)
+    @api.response(404, 'Supplier not found')
+    @api.response(409, 'The preferred flag did not have the expected value')
+    def delete(self, supplier_id):
+        """
+        Unpreferred a Supplier
+
+        This endpoint will make the Supplier an ordinary supplier
+        """
+        app.logger.info('Request to Unpreferred a Supplier')
+        return _mark_preferred(supplier_id, False)
+
+
+######################################################################
+#  PATH: /suppliers/preferred
+######################################################################
+@api.route('/suppliers/preferred')
+class PreferredCollection(Resource):
+    """ Preferred actions on many Suppliers at once """
+    @api.doc('preferred_many_suppliers')
+    @api.expect(preferred_update_model)
+    @api.response(400, 'The posted data was not valid')
+    def put(self):
+        """
+        Set the preferred flag of many Suppliers
+
+        Returns the ids of the Suppliers whose flag changed
+        """
+        app.logger.info('Request to set the preferred flag of many Suppliers')
+        _validate(schema.validate_preferred_update, api.payload, 'Invalid preferred update')
+        changed = Supplier.mark_preferred_many(api.payload['ids'], api.payload['preferred'])
+        catalog.reload(changed)
+        app.logger.info('[%s] Suppliers changed', len(changed))
+        return {'updated': changed}, status.HTTP_200_OK
+
+
+######################################################################
+#  PATH: /suppliers/import
+######################################################################
+@api.route('/suppliers/import')
+class SupplierImport(Resource):
+    """ Bulk imports of Suppliers """
+    @api.doc('import_suppliers')
+    @api.expect(supplier_import_model)
+    @api.response(400, 'The posted data was not valid')
+    @api.response(202, 'Import queued')
+    @api.marshal_with(job_model, code=202)
+    def post(self):
+        """
+        Import many Suppliers
+
+        The Suppliers are validated at once and created by a background
+        job, follow the Location header to see its progress
+        """
+        app.logger.info('Request to import Suppliers')
+        _validate(schema.validate_supplier_import, api.payload, 'Invalid Supplier import')
+        job = jobs.enqueue('import_suppliers', {'suppliers': api.payload['suppliers']})
+        app.logger.info('Import of [%s] Suppliers queued as job [%s]',
+                        len(api.payload['suppliers']), job.id)
+        return _accepted(job)
+
+
+######################################################################
+#  PATH: /suppliers/{id}/products/{id}/quantity
+######################################################################
+@api.route('/suppliers/<int:supplier_id>/products/<int:product_id>/quantity')
+@api.param('supplier_id', 'The Supplier identifier')
+@api.param('product_id', 'The Product identifier')
+class QuantityResource(Resource):
+    """ Stock level of a Product """
+    @api.doc('adjust_quantity')
+    @api.expect(quantity_adjustment_model)
+    @api.response(400, 'The posted data was not valid')
+    @api.response(404, 'Product not found')
+    @api.response(409, 'Not enough stock')
+    def post(self, supplier_id, product_id):
+        """
+        Adjust the quantity of a Product
+
+        Adds delta to the quantity in the database, refusing to go below zero
+        """
+        app.logger.info('Request to adjust the quantity of product [%s]', product_id)
+        _validate(schema.validate_quantity_adjustment, api.payload, 'Invalid quantity adjustment')
+        product = Product.adjust_quantity(product_id, api.payload['delta'], supplier_id=supplier_id)
+        if product is None:
+            existing = Product.find(product_id)
+            if existing is None or existing.supplier_id != supplier_id:
+                api.abort(status.HTTP_404_NOT_FOUND,
+                          'Product with id [{}] was not found.'.format(product_id))
+            api.abort(status.HTTP_409_CONFLICT,
+                      'Product with id [{}] has only {} in stock.'.format(product_id, existing.quantity))
+        catalog.reload([supplier_id])
+        return product.serialize(), status.HTTP_200_OK
+
+######################################################################
+#  PATH: /products/quantity-deltas
+######################################################################
+@api.route('/products/quantity-deltas')
+class QuantityDeltaCollection(Resource):
+    """ Stock movements written behind in batches """
+    @api.doc('get_quantity_delta_metrics')
+    def get(self):
+        """
+        Retrieve the counters of the write-behind buffer of this worker
+
+        coalescing_ratio is the number of deltas written per Product updated
+        """
+        return writebehind.buffer.metrics(), status.HTTP_200_OK
+
+    @api.doc('add_quantity_deltas')
+    @api.expect(quantity_deltas_model)
+    @api.response(400, 'The posted data was not valid')
+    @api.response(202, 'The deltas were accepted')
+    def post(self):
+        """
+        Queue quantity deltas of many Products
+
+        The deltas are added up per Product and written in one batch every
+        WRITE_BEHIND_FLUSH_SECONDS, a quantity never goes below zero and
+        deltas for unknown Products are dropped
+        """
+        _validate(schema.validate_quantity_deltas, api.payload, 'Invalid quantity deltas')
+        deltas = [(item['product_id'], item['delta']) for item in api.payload['deltas']]
+        writebehind.buffer.add(deltas)
+        app.logger.debug('[%s] quantity deltas queued', len(deltas))
+        return {'accepted': len(deltas)}, status.HTTP_202_ACCEPTED
+
+######################################################################
+#  PATH: /products/compare
+######################################################################
+@api.route('/products/compare')
+class ProductComparison(Resource):
+    """ Prices of a Product across Suppliers """
+    @api.doc('compare_products')
+    @api.expect(compare_args, validate=True)
+    @api.response(400, 'Too many offers asked for')
+    @api.marshal_list_with(offer_model)
+    def get(self):
+        """
+        Compare the prices of a Product
+
+        Returns the cheapest Product in stock of each Supplier selling one
+        with the name, cheapest first
+        """
+        args = compare_args.parse_args()
+        if args['limit'] > app.config['COMPARE_MAX_OFFERS']:
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      'At most {} offers can be compared at once.'.format(app.config['COMPARE_MAX_OFFERS']))
+        app.logger.info('Request to compare the prices of [%s]', args['name'])
+        offers = BestOffer if app.config['BEST_OFFERS_ENABLED'] else Product
+        offers = sharding.gather(offers.find_offers(args['name'], args['limit']), args['limit'],
+                                 key=lambda offer: (offer.wholesale_price, offer.supplier_id))
+        app.logger.info('[%s] offers returned', len(offers))
+        return [{key: getattr(offer, key) for key in schema.OFFER_FIELDS} for offer in offers], \
+            status.HTTP_200_OK
+
+######################################################################
+#  PATH: /products/{id}/prices
+######################################################################
+def _price_range(args):
+    """ Returns the naive UTC since and until of a price history request """
+    until = _naive_utc(args['until']) if args['until'] else datetime.utcnow()
+    if args['since']:
+        since = _naive_utc(args['since'])
+    else:
+        since = until - timedelta(days=app.config['PRICE_DEFAULT_DAYS'])
+    if since >= until:
+        api.abort(status.HTTP_400_BAD_REQUEST, 'since must be before until.')
+    return since, until
+
+
+@api.route('/products/<int:product_id>/prices')
+@api.param('product_id', 'The Product identifier')
+class ProductPrices(Resource):
+    """ Wholesale price history of a Product """
+    @api.doc('get_product_prices')
+    @api.expect(price_args, validate=True)
+    @api.response(400, 'The range is empty')
+    @api.marshal_list_with(price_point_model)
+    def get(self, product_id):
+        """
+        Retrieve the price history of a Product
+
+        Returns every price recorded in the range, or with interval=day the
+        low, high, average and closing price of each day the range touches
+        """
+        args = price_args.parse_args()
+        since, until = _price_range(args)
+        app.logger.info('Request for the prices of product [%s] from %s to %s', product_id, since, until)
+        if args['interval'] == 'day':
+            last_day = (until - timedelta(microseconds=1)).date()
+            points = PriceRollup.series(product_id, since.date(), last_day + timedelta(days=1))
+        else:
+            points = PriceHistory.series(product_id, since, until)
+        return [point.serialize() for point in points], status.HTTP_200_OK
+
+
+@api.route('/products/<int:product_id>/prices/stats')
+@api.param('product_id', 'The Product identifier')
+class ProductPriceStats(Resource):
+    """ Wholesale price statistics of a Product """
+    @api.doc('get_product_price_stats')
+    @api.expect(price_args, validate=True)
+    @api.response(400, 'The range is empty')
+    @api.marshal_with(price_stats_model)
+    def get(self, product_id):
+        """
+        Retrieve the lowest, highest and average price of a Product
+
+        Counts the prices recorded in the range
+        """
+        since, until = _price_range(price_args.parse_args())
+        app.logger.info('Request for the price stats of product [%s]', product_id)
+        return PriceHistory.stats(since, until, product_id=product_id), status.HTTP_200_OK
+
+
+@api.route('/suppliers/<int:supplier_id>/prices/stats')
+@api.param('supplier_id', 'The Supplier identifier')
+class SupplierPriceStats(Resource):
+    """ Wholesale price statistics of the Products of a Supplier """
+    @api.doc('get_supplier_price_stats')
+    @api.expect(price_args, validate=True)
+    @api.response(400, 'The range is empty')
+    @api.marshal_with(price_stats_model)
+    def get(self, supplier_id):
+        """
+        Retrieve the lowest, highest and average price of a Supplier
+
+        Counts the prices of all its Products recorded in the range
+        """
+        since, until = _price_range(price_args.parse_args())
+        app.logger.info('Request for the price stats of supplier [%s]', supplier_id)
+        return PriceHistory.stats(since, until, supplier_id=supplier_id), status.HTTP_200_OK
+
+######################################################################
+#  PATH: /reservations
+######################################################################
+@api.route('/reservations', strict_slashes=False)
+class ReservationCollection(Resource):
+    """ Reserves stock for orders """
+    @api.doc('create_reservations')
+    @api.expect(reservation_request_model)
+    @api.response(400, 'The posted data was not valid')
+    @api.response(404, 'Product not found')
+    @api.response(409, 'Not enough stock or the Products are busy, retry')
+    @api.marshal_list_with(reservation_model, code=201)
+    def post(self):
+        """
+        Reserve stock
+
+        Takes the stock of every item off its Product, all or nothing
+        """
+        app.logger.info('Request to reserve stock')
+        _validate(schema.validate_reservation_request, api.payload, 'Invalid reservation')
+        try:
+            sharding.route_rows('Product', [item['product_id'] for item in api.payload['items']])
+        except sharding.ShardingError as error:
+            api.abort(status.HTTP_409_CONFLICT, str(error))
+        try:
+            reservations = Reservation.reserve(api.payload['items'], api.payload.get('reference'))
+        except ReservationError as error:
+            _abort_reservation(error)
+        app.logger.info('[%s] Reservations made', len(reservations))
+        return [reservation.serialize() for reservation in reservations], status.HTTP_201_CREATED
+
+
+@api.route('/reservations/<int:reservation_id>')
+@api.param('reservation_id', 'The Reservation identifier')
+class ReservationResource(Resource):
+    """ A single Reservation """
+    @api.doc('get_reservations')
+    @api.response(404, 'Reservation not found')
+    @api.marshal_with(reservation_model)
+    def get(self, reservation_id):
+        """
+        Retrieve a single Reservation
+        """
+        app.logger.info('Request to Retrieve a reservation with id [%s]', reservation_id)
+        reservation = Reservation.find(reservation_id)
+        if not reservation:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Reservation with id '{}' was not found.".format(reservation_id))
+        return reservation.serialize(), status.HTTP_200_OK
+
+    @api.doc('release_reservations')
+    @api.response(404, 'Reservation not found')
+    @api.response(409, 'The Reservation was already released')
+    @api.marshal_with(reservation_model)
+    def delete(self, reservation_id):
+        """
+        Release a Reservation
+
+        Puts the reserved stock back on the Product
+        """
+        app.logger.info('Request to Release a reservation with id [%s]', reservation_id)
+        try:
+            reservation = Reservation.release(reservation_id)
+        except ReservationError as error:
+            _abort_reservation(error)
+        return reservation.serialize(), status.HTTP_200_OK
+
+######################################################################
+#  PATH: /snapshots
+######################################################################
+@api.route('/snapshots', strict_slashes=False)
+class SnapshotCollection(Resource):
+    """ Analytics snapshots of the catalog """
+    @api.doc('create_snapshots')
+    @api.response(202, 'Snapshot queued')
+    @api.response(503, 'Snapshots are not available')
+    @api.marshal_with(job_model, code=202)
+    def post(self):
+        """
+        Write a new snapshot
+
+        The snapshot is written by a background job, follow the Location
+        header to see when it is published
+        """
+        app.logger.info('Request to write a snapshot')
+        if snapshot.pyarrow is None:
+            api.abort(status.HTTP_503_SERVICE_UNAVAILABLE, 'Snapshots need pyarrow to be installed.')
+        return _accepted(jobs.enqueue('snapshot'))
+
+
+######################################################################
+#  PATH: /snapshots/latest
+######################################################################
+@api.route('/snapshots/latest')
+class SnapshotResource(Resource):
+    """ The latest analytics snapshot of the catalog """
+    @api.doc('get_snapshot')
+    @api.response(404, 'No snapshot has been written')
+    def get(self):
+        """
+        Retrieve the manifest of the tenant's latest snapshot
+
+        This endpoint reads files only and never touches the database
+        """
+        app.logger.info('Request for the latest snapshot')
+        manifest = snapshot.latest_manifest()
+        if manifest is None:
+            api.abort(status.HTTP_404_NOT_FOUND, 'No snapshot has been written yet.')
+        return manifest, status.HTTP_200_OK
+
+
+@api.route('/snapshots/latest/<table>')
+@api.param('table', 'The snapshot table, Supplier or Product')
+class SnapshotTableResource(Resource):
+    """ A table of the latest analytics snapshot """
+    @api.doc('get_snapshot_table')
+    @api.expect(snapshot_args, validate=True)
+    @api.produces([snapshot.ARROW_MEDIATYPE])
+    @api.response(400, 'Unknown columns requested')
+    @api.response(404, 'No snapshot or no such table')
+    @api.response(503, 'Snapshots are not available')
+    def get(self, table):
+        """
+        Retrieve a table of the tenant's latest snapshot as an Arrow IPC stream
+
+        The Parquet files are memory mapped and never touch the database
+        """
+        app.logger.info('Request for snapshot table %s', table)
+        if snapshot.pyarrow is None:
+            api.abort(status.HTTP_503_SERVICE_UNAVAILABLE, 'Snapshots need pyarrow to be installed.')
+        if table not in snapshot.TABLES:
+            api.abort(status.HTTP_404_NOT_FOUND, "Snapshot table '{}' does not exist.".format(table))
+        args = snapshot_args.parse_args()
+        columns = args['columns'].split(',') if args['columns'] else None
+        try:
+            data = snapshot.read_table(table, columns)
+        except snapshot.SnapshotError as error:
+            api.abort(status.HTTP_400_BAD_REQUEST, str(error))
+        if data is None:
+            api.abort(status.HTTP_404_NOT_FOUND, 'No snapshot has been written yet.')
+        response = make_response(snapshot.to_ipc_stream(data), status.HTTP_200_OK)
+        response.headers['Content-Type'] = snapshot.ARROW_MEDIATYPE
+        return response
+
+######################################################################
+#  PATH: /jobs/{id}
+######################################################################
+@api.route('/jobs/<int:job_id>')
+@api.param('job_id', 'The Job identifier')
+class JobResource(Resource):
+    """ A background job """
+    @api.doc('get_jobs')
+    @api.response(404, 'Job not found')
+    @api.marshal_with(job_model)
+    def get(self, job_id):
+        """
+        Retrieve the status of a Job
+
+        Poll it until the status is done or failed
+        """
+        app.logger.info('Request to Retrieve a job with id [%s]', job_id)
+        job = Job.find(job_id)
+        if not job:
+            api.abort(status.HTTP_404_NOT_FOUND, "Job with id '{}' was not found.".format(job_id))
+        return job.serialize(), status.HTTP_200_OK
+
+######################################################################
+#  PATH: /admin/profile
+######################################################################
+@api.route('/admin/profile')
+class ProfileResource(Resource):
+    """ Samples the stacks of this worker """
+    @api.doc('profile_worker')
+    @api.expect(profile_args, validate=True)
+    @api.response(202, 'Sampling started')
+    @api.response(403, 'A valid X-Admin-Token is required')
+    @api.response(404, 'Profiling is not enabled')
+    def get(self):
+        """
+        Sample the running worker
+
+        Samples the stacks of every thread of the worker in the background,
+        the requests it serves meanwhile included. The stacks can be fetched
+        in collapsed format, ready for a flame graph, from the Location once
+        the seconds are over
+        """
+        _require_profiling()
+        args = profile_args.parse_args()
+        app.logger.info('Request to sample the worker for %s seconds', args['seconds'])
+        profile_id, seconds = profiling.sample_worker(args['seconds'])
+        location_url = api.url_for(ProfileOutputResource, profile_id=profile_id, _external=True)
+        return {'id': profile_id, 'seconds': seconds}, status.HTTP_202_ACCEPTED, {'Location': location_url}
+
+
+@api.route('/admin/profiles/<profile_id>')
+@api.param('profile_id', 'The X-Profile-Id of a profiled request or the id of a worker sample')
+class ProfileOutputResource(Resource):
+    """ The saved profile of a single request or of a worker """
+    @api.doc('get_profile')
+    @api.expect(profile_output_args, validate=True)
+    @api.produces(['text/plain'])
+    @api.response(403, 'A valid X-Admin-Token is required')
+    @api.response(404, 'Profile not found')
+    def get(self, profile_id):
+        """
+        Retrieve the profile of a request sent with an X-Profile header or of a worker
+        """
+        _require_profiling()
+        args = profile_output_args.parse_args()
+        output = profiling.read_profile(profile_id, args['format'])
+        if output is None:
+            api.abort(status.HTTP_404_NOT_FOUND, "Profile '{}' was not found.".format(profile_id))
+        return _text_response(output)
 
 ######################################################################
 # DELETE ALL SUPPLIER DATA (for testing only)
@@ -289,6 +1042,8 @@ class PreferredResource(Resource):
 def suppliers_reset():
     """ Removes all suppliers from the database """
     Supplier.remove_all()
+    if catalog.enabled:
+        catalog.reset()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
 ######################################################################
@@ -300,6 +1055,55 @@ def init_db():
     global app
     Supplier.init_db(app)
 
+def _mark_preferred(supplier_id, preferred):
+    """ Sets the preferred flag of a Supplier and returns the response """
+    expected = preferred_args.parse_args()['expected']
+    supplier = Supplier.mark_preferred(supplier_id, preferred, expected)
+    if supplier is None:
+        if Supplier.find(supplier_id) is None:
+            api.abort(status.HTTP_404_NOT_FOUND, 'Supplier with id [{}] was not found.'.format(supplier_id))
+        api.abort(status.HTTP_409_CONFLICT,
+                  'Supplier with id [{}] preferred flag is not {}.'.format(supplier_id, expected))
+    catalog.put(supplier)
+    app.logger.info('Supplier with id [%s] preferred flag set to %s', supplier_id, preferred)
+    return supplier.serialize(), status.HTTP_200_OK
+
+def _accepted(job):
+    """ Answers 202 Accepted with a queued Job and its URL """
+    location_url = api.url_for(JobResource, job_id=job.id, _external=True)
+    return job.serialize(), status.HTTP_202_ACCEPTED, {'Location': location_url}
+
+def _abort_reservation(error):
+    """ Turns a ReservationError into a 404 or a 409 """
+    if error.not_found:
+        api.abort(status.HTTP_404_NOT_FOUND, str(error))
+    api.abort(status.HTTP_409_CONFLICT, str(error))
+
+def _validate(validator, data, message):
+    """ Raises a DataValidationError with every error found in data """
+    errors = validator(data)
+    if errors:
+        raise DataValidationError(message + ": " + "; ".join(errors), errors=errors)
+
+def _require_profiling():
+    """ Aborts unless profiling is on and the caller is an admin """
+    if not app.config['PROFILING_ENABLED']:
+        api.abort(status.HTTP_404_NOT_FOUND, 'Profiling is not enabled.')
+    if not profiling.authorized():
+        api.abort(status.HTTP_403_FORBIDDEN, 'A valid X-Admin-Token is required.')
+
+def _text_response(text):
+    """ Returns plain text from a Resource """
+    response = make_response(text, status.HTTP_200_OK)
+    response.headers['Content-Type'] = 'text/plain; charset=utf-8'
+    return response
+
+def _naive_utc(timestamp):
+    """ Converts an aware timestamp to the naive UTC used by the database """
+    if timestamp.tzinfo is None:
+        return timestamp
+    return timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers["Content-Type"] == content_type:
@@ -0,0 +1,457 @@
+"""
+Horizontal Sharding
+
+Spreads the catalog over several databases once it outgrows one. Sharding
+is off unless SHARD_URIS names the shards, e.g.
+
+    SHARD_URIS='{"a": "postgres://.../catalog_a", "b": "postgres://.../catalog_b"}'
+
+Each Supplier lives, with its Products and their Reservations, on the shard
+that owns its id on a consistent hash ring with SHARD_VNODES points per
+shard, so adding a shard only moves about 1/N of the Suppliers.
+
+Routing happens under the models: the session sends every statement to
+the current shard of the thread, and falls back to the main database
+(SQLALCHEMY_DATABASE_URI) when there is none. Tables marked with
+info={'global': True}, like the Job queue, only live in the main database.
+Requests naming a supplier_id or reservation_id are routed before they
+run, and creating a Supplier routes the rest of the request to its new
+shard. Lists run on every shard and are merged in id order
+(scatter-gather), using the last id as a keyset cursor.
+
+Ids must be unique across shards, so Supplier, Product and Reservation ids
+come from the ShardSequence table of the main database, SHARD_ID_BLOCK at
+a time. Shards must be listed before any data is loaded, or existing rows
+moved with:
+
+  flask shards rebalance
+"""
+import heapq
+import hashlib
+import logging
+import threading
+from bisect import bisect
+from contextlib import contextmanager
+from itertools import islice
+import click
+from flask import request
+from flask_sqlalchemy import SQLAlchemy, SignallingSession, get_state
+from sqlalchemy import (create_engine, orm, MetaData, Table, Column, String, BigInteger,
+                        select, text, bindparam)
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.sql.util import find_tables
+from . import app
+
+logger = logging.getLogger(__name__)
+
+_shard = threading.local()
+
+
+class ShardingError(Exception):
+    """ Used when a request spans shards it cannot span """
+    pass
+
+
+######################################################################
+#  H A S H   R I N G
+######################################################################
+def _hash(key):
+    """ Returns a stable 64 bit hash of a key """
+    return int.from_bytes(hashlib.md5(str(key).encode('utf8')).digest()[:8], 'big')
+
+
+class HashRing():
+    """
+    Consistent hash ring mapping keys to shard names
+
+    Args:
+        names (list): the shard names
+        vnodes (int): points on the ring per shard
+    """
+
+    def __init__(self, names, vnodes=64):
+        self.names = sorted(names)
+        self.vnodes = vnodes
+        points = sorted(
+            (_hash('{}#{}'.format(name, i)), name) for name in self.names for i in range(vnodes)
+        )
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def node(self, key):
+        """ Returns the name of the shard that owns a key """
+        index = bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._names[index]
+
+
+_ring = None
+
+
+def enabled():
+    """ Are shards configured """
+    return bool(app.config['SHARD_URIS'])
+
+
+def ring():
+    """ Returns the ring of the configured shards """
+    global _ring
+    names = sorted(app.config['SHARD_URIS'])
+    if _ring is None or _ring.names != names or _ring.vnodes != app.config['SHARD_VNODES']:
+        _ring = HashRing(names, app.config['SHARD_VNODES'])
+    return _ring
+
+
+def shard_for(supplier_id):
+    """ Returns the name of the shard that owns a Supplier """
+    return ring().node(int(supplier_id))
+
+
+######################################################################
+#  C U R R E N T   S H A R D
+######################################################################
+def current_shard():
+    """ Returns the shard this thread works on, or None for the main database """
+    return getattr(_shard, 'name', None)
+
+
+def set_shard(name):
+    """ Sends the statements of this thread to a shard, None for the main database """
+    _shard.name = name
+
+
+@contextmanager
+def shard_scope(name):
+    """ Sends the statements of this thread to a shard for a block """
+    previous = current_shard()
+    _shard.name = name
+    try:
+        yield name
+    finally:
+        _shard.name = previous
+
+
+def each_shard():
+    """ Yields every shard name under its scope, or None once when not sharded """
+    if not enabled():
+        yield None
+        return
+    for name in sorted(app.config['SHARD_URIS']):
+        with shard_scope(name):
+            yield name
+
+
+def by_shard(supplier_ids):
+    """ Yields the Supplier ids owned by each shard under that shard's scope """
+    if not enabled():
+        yield list(supplier_ids)
+        return
+    groups = {}
+    for supplier_id in supplier_ids:
+        groups.setdefault(shard_for(supplier_id), []).append(supplier_id)
+    for name, group in sorted(groups.items()):
+        with shard_scope(name):
+            yield group
+
+
+######################################################################
+#  E N G I N E S   A N D   S E S S I O N S
+######################################################################
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def engine_for(name):
+    """ Returns the engine of a shard, creating it on first use """
+    uri = app.config['SHARD_URIS'][name]
+    engine = _engines.get(uri)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(uri)
+            if engine is None:
+                engine = _engines[uri] = create_engine(uri)
+    return engine
+
+
+def engines():
+    """ Returns the engine of every shard, or of the main database when not sharded """
+    if not enabled():
+        return [get_state(app).db.engine]
+    return [engine_for(name) for name in sorted(app.config['SHARD_URIS'])]
+
+
+def dispose():
+    """ Closes the connections of every shard """
+    with _engines_lock:
+        for engine in _engines.values():
+            engine.dispose()
+        _engines.clear()
+
+
+def _is_global(mapper, clause):
+    """ Does a statement touch a table that only lives in the main database """
+    if mapper is not None:
+        return mapper.persist_selectable.info.get('global', False)
+    if clause is not None:
+        return any(table.info.get('global', False)
+                   for table in find_tables(clause, include_crud=True))
+    return False
+
+
+class ShardedSession(SignallingSession):
+    """ A session sending statements to the current shard of the thread """
+
+    def get_bind(self, mapper=None, clause=None):
+        name = current_shard()
+        if name is not None and not _is_global(mapper, clause):
+            return engine_for(name)
+        return super().get_bind(mapper, clause)
+
+
+class ShardedSQLAlchemy(SQLAlchemy):
+    """ Flask-SQLAlchemy with sessions that route to shards """
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=ShardedSession, db=self, **options)
+
+
+def _sharded_tables():
+    """ Returns the tables that live on the shards """
+    metadata = get_state(app).db.metadata
+    return [table for table in metadata.sorted_tables if not table.info.get('global', False)]
+
+
+def create_all():
+    """ Creates the tables on every shard """
+    metadata = get_state(app).db.metadata
+    for name in sorted(app.config['SHARD_URIS']):
+        metadata.create_all(bind=engine_for(name), tables=_sharded_tables())
+
+
+def drop_all():
+    """ Drops the tables on every shard """
+    metadata = get_state(app).db.metadata
+    for name in sorted(app.config['SHARD_URIS']):
+        metadata.drop_all(bind=engine_for(name), tables=_sharded_tables())
+
+
+######################################################################
+#  I D S
+######################################################################
+sequences = Table(
+    'ShardSequence', MetaData(),
+    Column('name', String(63), primary_key=True),
+    Column('next_id', BigInteger, nullable=False),
+)
+
+_blocks = {}
+_blocks_lock = threading.Lock()
+
+
+def _reserve_block(name, size):
+    """ Reserves the next size ids of a sequence in the main database """
+    engine = get_state(app).db.engine
+    sequences.create(bind=engine, checkfirst=True)
+    for _ in range(2):
+        try:
+            with engine.begin() as connection:
+                updated = connection.execute(
+                    sequences.update().where(sequences.c.name == name)
+                    .values(next_id=sequences.c.next_id + size)
+                )
+                if not updated.rowcount:
+                    connection.execute(sequences.insert().values(name=name, next_id=1 + size))
+                end = connection.execute(
+                    select([sequences.c.next_id]).where(sequences.c.name == name)
+                ).scalar()
+            return end - size, end
+        except IntegrityError:
+            continue  # another worker created the sequence first
+    raise ShardingError("Could not reserve ids of {}".format(name))
+
+
+def next_id(name):
+    """ Returns a new id of a table that is unique across every shard """
+    with _blocks_lock:
+        start, end = _blocks.get(name, (0, 0))
+        if start >= end:
+            start, end = _reserve_block(name, app.config['SHARD_ID_BLOCK'])
+        _blocks[name] = (start + 1, end)
+        return start
+
+
+def assign_id(mapper, connection, target):
+    """ Gives a new row a global id before it is inserted (a before_insert event) """
+    if enabled() and target.id is None:
+        target.id = next_id(mapper.persist_selectable.name)
+
+
+######################################################################
+#  S C A T T E R   G A T H E R
+######################################################################
+def gather(query, limit=None, key=None, reverse=False):
+    """
+    Runs a query on every shard and merges the results in its order
+
+    Args:
+        query (Query): a query already ordered, and limited if paging
+        limit (int): the most results to return
+        key (function): returns what the query is ordered by, the id by default
+        reverse (boolean): the query is in descending order
+    Returns:
+        list: the merged results in order
+    """
+    if not enabled():
+        return query.all()
+    results = [query.all() for _ in each_shard()]
+    merged = heapq.merge(*results, key=key or (lambda row: row.id), reverse=reverse)
+    return list(islice(merged, limit)) if limit else list(merged)
+
+
+def locate(table_name, ids):
+    """ Returns the names of the shards holding any of the given rows """
+    statement = text(
+        'SELECT 1 FROM "{}" WHERE id IN :ids LIMIT 1'.format(table_name)
+    ).bindparams(bindparam('ids', expanding=True))
+    found = set()
+    for name in sorted(app.config['SHARD_URIS']):
+        with engine_for(name).connect() as connection:
+            if connection.execute(statement, ids=list(ids)).first():
+                found.add(name)
+    return found
+
+
+def route_rows(table_name, ids):
+    """
+    Routes this thread to the shard holding some rows
+
+    Raises:
+        ShardingError: when the rows are spread over several shards
+    """
+    if not enabled() or not ids:
+        return
+    found = locate(table_name, ids)
+    if len(found) > 1:
+        raise ShardingError("{} rows {} are on different shards.".format(table_name, sorted(ids)))
+    # rows that exist nowhere are looked for, and not found, on the first shard
+    set_shard(found.pop() if found else sorted(app.config['SHARD_URIS'])[0])
+
+
+######################################################################
+#  R E B A L A N C I N G
+######################################################################
+def _move_supplier(metadata, supplier_id, source, target):
+    """ Copies a Supplier with its Products, Reservations and price history to
+    a shard, then deletes it from the one it was on """
+    supplier = metadata.tables['Supplier']
+    product = metadata.tables['Product']
+    reservation = metadata.tables['Reservation']
+    history = metadata.tables['PriceHistory']
+    rollup = metadata.tables['PriceRollup']
+    with engine_for(source).connect() as reader:
+        suppliers = reader.execute(supplier.select().where(supplier.c.id == supplier_id)).fetchall()
+        products = reader.execute(
+            product.select().where(product.c.supplier_id == supplier_id)
+        ).fetchall()
+        product_ids = [row.id for row in products]
+        reservations = reader.execute(
+            reservation.select().where(reservation.c.product_id.in_(product_ids))
+        ).fetchall() if product_ids else []
+        # the ids of the history are taken from the sequence of the new shard
+        prices = reader.execute(
+            select([column for column in history.c if column.name != 'id'])
+            .where(history.c.supplier_id == supplier_id)
+        ).fetchall()
+        rollups = reader.execute(rollup.select().where(rollup.c.supplier_id == supplier_id)).fetchall()
+    # the copy is committed before the original goes, so the Supplier is never missing,
+    # the history goes first so the Products are not recorded again as new ones
+    with engine_for(target).begin() as writer:
+        for table, rows in ((history, prices), (rollup, rollups), (supplier, suppliers),
+                            (product, products), (reservation, reservations)):
+            if rows:
+                writer.execute(table.insert(), [dict(row) for row in rows])
+    with engine_for(source).begin() as writer:
+        if product_ids:
+            writer.execute(reservation.delete().where(reservation.c.product_id.in_(product_ids)))
+        writer.execute(product.delete().where(product.c.supplier_id == supplier_id))
+        writer.execute(supplier.delete().where(supplier.c.id == supplier_id))
+        writer.execute(history.delete().where(history.c.supplier_id == supplier_id))
+        writer.execute(rollup.delete().where(rollup.c.supplier_id == supplier_id))
+
+
+def rebalance(batch_size=1000, dry_run=False):
+    """
+    Moves every Supplier that is not on the shard owning it
+
+    Run it after adding or removing a shard. Suppliers are moved one at a
+    time, each copied to its new shard before it is deleted from the old one.
+
+    Args:
+        batch_size (int): the Supplier ids read per query
+        dry_run (boolean): only count the Suppliers that would move
+    Returns:
+        dict: the number of Suppliers moved to each shard
+    """
+    metadata = get_state(app).db.metadata
+    supplier = metadata.tables['Supplier']
+    moved = {}
+    for source in sorted(app.config['SHARD_URIS']):
+        last_id = 0
+        while True:
+            with engine_for(source).connect() as reader:
+                ids = [row.id for row in reader.execute(
+                    select([supplier.c.id]).where(supplier.c.id > last_id)
+                    .order_by(supplier.c.id).limit(batch_size)
+                )]
+            if not ids:
+                break
+            last_id = ids[-1]
+            for supplier_id in ids:
+                target = shard_for(supplier_id)
+                if target == source:
+                    continue
+                if not dry_run:
+                    _move_supplier(metadata, supplier_id, source, target)
+                moved[target] = moved.get(target, 0) + 1
+    logger.info("Rebalanced shards: %s", moved)
+    return moved
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def init_sharding(app):
+    """ Routes requests for one Supplier, Product or Reservation to its shard """
+
+    @app.before_request
+    def route_request():
+        set_shard(None)
+        if not enabled() or not request.view_args:
+            return
+        supplier_id = request.view_args.get('supplier_id')
+        if supplier_id is not None:
+            try:
+                set_shard(shard_for(supplier_id))
+            except ValueError:
+                pass  # not an id, nothing to find
+        elif request.view_args.get('product_id') is not None:
+            route_rows('Product', [request.view_args['product_id']])
+        elif request.view_args.get('reservation_id') is not None:
+            route_rows('Reservation', [request.view_args['reservation_id']])
+
+    @app.teardown_request
+    def forget_shard(exception=None):
+        set_shard(None)
+
+    @app.cli.group('shards')
+    def shards_command():
+        """ Manages the shards of the catalog """
+
+    @shards_command.command('rebalance')
+    @click.option('--batch-size', type=int, default=1000, help='Supplier ids read per query')
+    @click.option('--dry-run', is_flag=True, help='Only count the Suppliers that would move')
+    def rebalance_command(batch_size, dry_run):
+        """ Moves Suppliers to the shard that owns them """
+        if not enabled():
+            raise click.ClickException("SHARD_URIS is not set")
+        for name, count in sorted(rebalance(batch_size, dry_run).items()):
+            click.echo("{}: {} suppliers {}".format(name, count, 'to move' if dry_run else 'moved'))
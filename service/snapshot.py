@@ -0,0 +1,278 @@
+"""
+Catalog Snapshots
+
+Dumps the Supplier and Product tables into Parquet files for analytics so
+that reports read the files instead of the live database.
+
+Rows are read through a server side cursor in batches and written as they
+arrive, so memory stays bounded by the batch size. Each table is split into
+part files of at most SNAPSHOT_ROWS_PER_FILE rows. Each tenant has
+snapshots of its own rows only, in a directory of its own:
+
+    <SNAPSHOT_DIR>/<tenant>/<snapshot id>/manifest.json
+    <SNAPSHOT_DIR>/<tenant>/<snapshot id>/Supplier/part-00000.parquet
+    <SNAPSHOT_DIR>/<tenant>/<snapshot id>/Product/part-00000.parquet
+    <SNAPSHOT_DIR>/<tenant>/LATEST
+
+A snapshot is built in a temporary directory and only published by
+renaming it and rewriting LATEST, so readers never see a partial snapshot.
+
+Create one with:
+  flask snapshot [--tenant <name>]
+
+or queue one for the workers with POST /api/snapshots.
+"""
+import os
+import json
+import shutil
+import logging
+from datetime import datetime
+import click
+from sqlalchemy import Integer, String, DateTime, Boolean
+from service.models import Supplier, Product, current_tenant, tenant_scope
+from service import sharding, jobs
+from . import app
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # pragma: no cover
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+TABLES = {model.__tablename__: model for model in (Supplier, Product)}
+LATEST = 'LATEST'
+ARROW_MEDIATYPE = 'application/vnd.apache.arrow.stream'
+MANIFEST = 'manifest.json'
+
+
+class SnapshotError(Exception):
+    """ Used when a snapshot cannot be written or read """
+    pass
+
+
+######################################################################
+#  W R I T I N G
+######################################################################
+def _arrow_type(column):
+    """ Maps a SQLAlchemy column to an Arrow type """
+    if isinstance(column.type, Boolean):
+        return pyarrow.bool_()
+    if isinstance(column.type, Integer):
+        return pyarrow.int64()
+    if isinstance(column.type, DateTime):
+        return pyarrow.timestamp('us')
+    if isinstance(column.type, String):
+        return pyarrow.string()
+    raise SnapshotError("No Arrow type for column {}".format(column.name))
+
+
+def _arrow_schema(model):
+    """ Builds the Arrow schema of a model's table """
+    return pyarrow.schema(
+        [pyarrow.field(column.name, _arrow_type(column)) for column in model.__table__.columns]
+    )
+
+
+def _stream_batches(model, schema, batch_size):
+    """ Yields the rows of a table as Arrow record batches
+
+    Uses a server side cursor so the whole table is never held in memory.
+    Only the rows of the current tenant are read, soft deleted rows are
+    left out. Shards are read one after the other.
+    """
+    table = model.__table__
+    for engine in sharding.engines():
+        connection = engine.connect().execution_options(stream_results=True)
+        try:
+            result = connection.execute(
+                table.select()
+                .where(table.c.tenant == current_tenant())
+                .where(table.c.deleted_at.is_(None))
+                .order_by(table.c.id)
+            )
+            while True:
+                rows = result.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield pyarrow.RecordBatch.from_arrays(
+                    [
+                        pyarrow.array([row[i] for row in rows], type=field.type)
+                        for i, field in enumerate(schema)
+                    ],
+                    schema=schema,
+                )
+        finally:
+            connection.close()
+
+
+def _write_table(model, path, batch_size, rows_per_file):
+    """ Writes one table into Parquet part files and returns its manifest entry """
+    schema = _arrow_schema(model)
+    os.makedirs(path)
+    files = []
+    rows = 0
+    writer = None
+    written = 0
+    for batch in _stream_batches(model, schema, batch_size):
+        offset = 0
+        while offset < batch.num_rows:
+            if writer is None or written >= rows_per_file:
+                if writer:
+                    writer.close()
+                name = "part-{:05d}.parquet".format(len(files))
+                writer = pyarrow.parquet.ParquetWriter(os.path.join(path, name), schema)
+                files.append(name)
+                written = 0
+            chunk = batch.slice(offset, rows_per_file - written)
+            writer.write_batch(chunk)
+            written += chunk.num_rows
+            offset += chunk.num_rows
+        rows += batch.num_rows
+    if writer:
+        writer.close()
+    return {"rows": rows, "files": files}
+
+
+def tenant_dir(snapshot_dir=None):
+    """ Returns the directory that holds the snapshots of the current tenant """
+    return os.path.join(snapshot_dir or app.config['SNAPSHOT_DIR'], current_tenant())
+
+
+def write_snapshot(snapshot_dir=None, batch_size=None, rows_per_file=None):
+    """
+    Writes a snapshot of the current tenant's catalog and publishes it as its latest
+
+    Args:
+        snapshot_dir (string): the directory that holds the snapshots of all tenants
+        batch_size (int): the number of rows fetched per round trip
+        rows_per_file (int): the maximum number of rows in a part file
+
+    Returns:
+        dict: the manifest of the new snapshot
+    """
+    if pyarrow is None:
+        raise SnapshotError("Snapshots need pyarrow to be installed")
+    snapshot_dir = tenant_dir(snapshot_dir)
+    os.makedirs(snapshot_dir, exist_ok=True)
+    batch_size = batch_size or app.config['SNAPSHOT_BATCH_SIZE']
+    rows_per_file = rows_per_file or app.config['SNAPSHOT_ROWS_PER_FILE']
+
+    created_at = datetime.utcnow()
+    snapshot_id = created_at.strftime("%Y%m%dT%H%M%S%fZ")
+    logger.info("Writing snapshot %s", snapshot_id)
+    staging = os.path.join(snapshot_dir, "." + snapshot_id)
+    manifest = {"id": snapshot_id, "tenant": current_tenant(),
+                "created_at": created_at.isoformat(), "tables": {}}
+    try:
+        for name, model in TABLES.items():
+            manifest["tables"][name] = _write_table(
+                model, os.path.join(staging, name), batch_size, rows_per_file
+            )
+        with open(os.path.join(staging, MANIFEST), 'w') as manifest_file:
+            json.dump(manifest, manifest_file)
+        os.rename(staging, os.path.join(snapshot_dir, snapshot_id))
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    # publish atomically so readers switch from one snapshot to the next
+    latest = os.path.join(snapshot_dir, LATEST)
+    with open(latest + ".tmp", 'w') as latest_file:
+        latest_file.write(snapshot_id)
+    os.replace(latest + ".tmp", latest)
+    prune_snapshots(snapshot_dir, app.config['SNAPSHOT_KEEP'])
+    logger.info("Snapshot %s published", snapshot_id)
+    return manifest
+
+
+def prune_snapshots(snapshot_dir, keep):
+    """ Removes all but the newest keep snapshots """
+    snapshot_ids = sorted(
+        entry for entry in os.listdir(snapshot_dir)
+        if not entry.startswith('.') and os.path.isdir(os.path.join(snapshot_dir, entry))
+    )
+    for snapshot_id in snapshot_ids[:-keep]:
+        logger.info("Pruning snapshot %s", snapshot_id)
+        shutil.rmtree(os.path.join(snapshot_dir, snapshot_id), ignore_errors=True)
+
+
+@jobs.handler('snapshot')
+def snapshot_job(job):
+    """ Writes a snapshot for a queued job and returns its manifest """
+    return write_snapshot()
+
+
+######################################################################
+#  R E A D I N G
+######################################################################
+def latest_manifest(snapshot_dir=None):
+    """ Returns the manifest of the current tenant's latest snapshot or None if there is none """
+    snapshot_dir = tenant_dir(snapshot_dir)
+    try:
+        with open(os.path.join(snapshot_dir, LATEST)) as latest_file:
+            snapshot_id = latest_file.read().strip()
+        with open(os.path.join(snapshot_dir, snapshot_id, MANIFEST)) as manifest_file:
+            return json.load(manifest_file)
+    except FileNotFoundError:
+        return None
+
+
+def read_table(name, columns=None, snapshot_dir=None):
+    """
+    Reads a table of the current tenant's latest snapshot through memory mapped files
+
+    Args:
+        name (string): the table name, Supplier or Product
+        columns (list): the columns to read, all when None
+
+    Returns:
+        pyarrow.Table: the table or None if there is no snapshot
+    """
+    if pyarrow is None:
+        raise SnapshotError("Snapshots need pyarrow to be installed")
+    if name not in TABLES:
+        raise SnapshotError("Unknown snapshot table {}".format(name))
+    manifest = latest_manifest(snapshot_dir)
+    if manifest is None:
+        return None
+    snapshot_dir = tenant_dir(snapshot_dir)
+    schema = _arrow_schema(TABLES[name])
+    if columns:
+        unknown = set(columns) - set(schema.names)
+        if unknown:
+            raise SnapshotError("Unknown columns {}".format(", ".join(sorted(unknown))))
+        schema = pyarrow.schema([schema.field(column) for column in columns])
+    path = os.path.join(snapshot_dir, manifest["id"], name)
+    tables = [
+        pyarrow.parquet.read_table(os.path.join(path, part), columns=columns, memory_map=True)
+        for part in manifest["tables"][name]["files"]
+    ]
+    if not tables:
+        return schema.empty_table()
+    return pyarrow.concat_tables(tables)
+
+
+def to_ipc_stream(table):
+    """ Encodes an Arrow table as the bytes of an IPC stream """
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+######################################################################
+#  C O M M A N D   L I N E
+######################################################################
+@app.cli.command('snapshot')
+@click.option('--snapshot-dir', default=None, help='Directory that holds the snapshots')
+@click.option('--batch-size', type=int, default=None, help='Rows fetched per round trip')
+@click.option('--rows-per-file', type=int, default=None, help='Maximum rows per Parquet file')
+@click.option('--tenant', default=None, help='The tenant whose catalog is written')
+def snapshot_command(snapshot_dir, batch_size, rows_per_file, tenant):
+    """ Writes a Parquet snapshot of the catalog """
+    with tenant_scope(tenant):
+        manifest = write_snapshot(snapshot_dir, batch_size, rows_per_file)
+    for name, table in manifest["tables"].items():
+        click.echo("{}: {} rows in {} files".format(name, table["rows"], len(table["files"])))
+    click.echo("Snapshot {} published".format(manifest["id"]))
@@ -0,0 +1,100 @@
+"""
+Swagger Document
+
+Suppliers_SwaggerIO.yaml is generated from the Swagger spec the service
+serves at /swagger.json, which flask_restplus builds from the routes and
+the models of service/schema.py, so the two cannot drift apart. Write it
+again after changing either with:
+  flask swagger
+
+The spec only holds mappings, lists, strings, numbers and booleans, which
+are written as block YAML with every string quoted, the way the file was
+kept by hand.
+"""
+import re
+import json
+import click
+from service.service import api
+from . import app
+
+SWAGGER_FILE = 'Suppliers_SwaggerIO.yaml'
+
+# keys that YAML reads as themselves without quotes
+PLAIN_KEY = re.compile(r'^[A-Za-z_/$][\w/{}$.-]*$')
+RESERVED = {'true', 'false', 'yes', 'no', 'on', 'off', 'null', 'y', 'n'}
+
+
+def swagger_spec():
+    """ Returns the Swagger spec of the API, its operations in the same order every time """
+    # a context of its own, the teardown hooks must not see the g of a request being served
+    with app.app_context(), app.test_request_context('/'):
+        spec = dict(api.__schema__)
+    # the methods of a route come from a set, so their order changes from one run to the next
+    spec['paths'] = {path: dict(sorted(item.items())) for path, item in spec['paths'].items()}
+    return spec
+
+
+def _key(key):
+    """ Returns a mapping key, quoted unless it is plain """
+    key = str(key)
+    if PLAIN_KEY.match(key) and key.lower() not in RESERVED:
+        return key
+    return json.dumps(key)
+
+
+def _scalar(value):
+    """ Returns a scalar in YAML """
+    if value is None:
+        return 'null'
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    return json.dumps(str(value))
+
+
+def _lines(value, indent):
+    """ Yields the lines of a mapping or list nested at indent """
+    pad = ' ' * indent
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, (dict, list, tuple)) and item:
+                yield '{}{}:'.format(pad, _key(key))
+                # list items line up with their key, mappings go one level in
+                yield from _lines(item, indent + 2 if isinstance(item, dict) else indent)
+            else:
+                yield '{}{}: {}'.format(pad, _key(key), _inline(item))
+        return
+    for item in value:
+        if isinstance(item, (dict, list, tuple)) and item:
+            nested = list(_lines(item, indent + 2))
+            yield '{}- {}'.format(pad, nested[0][indent + 2:])
+            yield from nested[1:]
+        else:
+            yield '{}- {}'.format(pad, _inline(item))
+
+
+def _inline(value):
+    """ Returns an empty collection or a scalar on one line """
+    if isinstance(value, dict):
+        return '{}'
+    if isinstance(value, (list, tuple)):
+        return '[]'
+    return _scalar(value)
+
+
+def to_yaml(spec):
+    """ Returns the Swagger spec as a YAML document """
+    return '\n'.join(_lines(spec, 0)) + '\n'
+
+
+######################################################################
+#  C O M M A N D   L I N E
+######################################################################
+@app.cli.command('swagger')
+@click.option('--output', default=SWAGGER_FILE, help='File the YAML is written to')
+def swagger_command(output):
+    """ Writes the Swagger spec of the API as YAML """
+    with open(output, 'w') as document:
+        document.write(to_yaml(swagger_spec()))
+    click.echo("Wrote {}".format(output))
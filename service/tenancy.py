@@ -0,0 +1,102 @@
+"""
+Tenants
+
+Several business units share one deployment, each with its own catalog.
+The tenant of a request is named by the TENANT_HEADER header (X-Tenant),
+and requests without one work on the default tenant. Every query of the
+models is scoped to the current tenant.
+
+The Supplier and Product tables are partitioned by tenant on PostgreSQL.
+Tenants start out in the shared default partition; a large tenant should
+be given its own partition before its catalog is loaded, so its scans,
+indexes and vacuum stay the size of its own catalog:
+
+  flask partition <tenant>
+
+Each tenant also has its own budgets, see service.ratelimit: at most
+TENANT_MAX_IN_FLIGHT requests per worker, which bounds the database
+connections it can hold, and a token bucket of TENANT_RATE_LIMIT_RATE.
+"""
+import re
+import logging
+import click
+from flask import request, abort
+from flask_api import status
+from service.models import db, Supplier, Product, set_tenant, DEFAULT_TENANT
+from service import sharding
+
+logger = logging.getLogger(__name__)
+
+TENANT_NAME = re.compile(r'^[a-z][a-z0-9_]{0,39}$')
+
+
+class TenantError(Exception):
+    """ Used when a tenant cannot be given its own partition """
+    pass
+
+
+def partition_name(table, tenant):
+    """ Returns the name of the partition of a table holding one tenant """
+    return '{}_{}'.format(table.name, tenant)
+
+
+def create_partition(tenant):
+    """
+    Gives a tenant its own partition of the Supplier and Product tables on every shard
+
+    Args:
+        tenant (string): the name of the tenant
+    Raises:
+        TenantError: when the name is not valid or the tenant already has
+            rows in the default partition
+    """
+    if not TENANT_NAME.match(tenant) or tenant == DEFAULT_TENANT:
+        raise TenantError("Tenant name '{}' is not valid.".format(tenant))
+    for _ in sharding.each_shard():
+        for model in (Supplier, Product):
+            table = model.__table__
+            default = partition_name(table, DEFAULT_TENANT)
+            if db.session.execute(
+                    'SELECT 1 FROM "{}" WHERE tenant = :tenant LIMIT 1'.format(default),
+                    {'tenant': tenant}).first():
+                db.session.rollback()
+                raise TenantError(
+                    "Tenant '{}' already has rows in {}, partition it before loading.".format(
+                        tenant, default
+                    )
+                )
+            db.session.execute(
+                'CREATE TABLE IF NOT EXISTS "{}" PARTITION OF "{}" FOR VALUES IN (\'{}\')'.format(
+                    partition_name(table, tenant), table.name, tenant
+                )
+            )
+    db.session.commit()
+    logger.info("Created the partitions of tenant %s", tenant)
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def init_tenants(app):
+    """ Makes the tenant named by each request current while it runs """
+
+    @app.before_request
+    def choose_tenant():
+        tenant = request.headers.get(app.config['TENANT_HEADER'])
+        if tenant is not None and not TENANT_NAME.match(tenant):
+            abort(status.HTTP_400_BAD_REQUEST, "Tenant name '{}' is not valid.".format(tenant))
+        set_tenant(tenant)
+
+    @app.teardown_request
+    def forget_tenant(exception=None):
+        set_tenant(None)
+
+    @app.cli.command('partition')
+    @click.argument('tenant')
+    def partition_command(tenant):
+        """ Gives a tenant its own partition of the catalog tables """
+        try:
+            create_partition(tenant)
+        except TenantError as error:
+            raise click.ClickException(str(error))
+        click.echo("Tenant {} partitioned".format(tenant))
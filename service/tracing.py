@@ -0,0 +1,327 @@
+"""
+Request Tracing
+
+Records where the time of a request goes as a tree of spans:
+
+- one server span per request, continuing the W3C trace context of the
+  caller when a traceparent header is sent
+- one span per Resource method
+- one client span per SQL statement, so lazy loads of products show up as
+  separate statements
+- spans around serialization and marshalling of the results
+
+Spans are written as one JSON object per line using the OTLP JSON field
+names (traceId, spanId, parentSpanId, startTimeUnixNano, ...), so they can
+be replayed into any OpenTelemetry collector. TRACE_EXPORTER selects where
+they go: console (stdout) or file (TRACE_FILE). The spans of a request are
+written together when it ends.
+
+TRACE_SAMPLE_RATE is the fraction of new traces that are recorded; a request
+that carries a traceparent follows the sampled flag of its caller. When
+TRACING_ENABLED is off, or the request is not sampled, no spans are created.
+"""
+import re
+import sys
+import json
+import time
+import random
+import logging
+import threading
+from functools import wraps
+from contextlib import contextmanager
+from flask import request, g, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from . import app
+
+logger = logging.getLogger(__name__)
+
+TRACEPARENT = re.compile(r'^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+KIND_SERVER = 'SPAN_KIND_SERVER'
+KIND_INTERNAL = 'SPAN_KIND_INTERNAL'
+KIND_CLIENT = 'SPAN_KIND_CLIENT'
+
+
+######################################################################
+#  S P A N S
+######################################################################
+class Span():
+    """ A timed operation within a trace """
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'kind',
+                 'start', 'end', 'attributes', 'error')
+
+    def __init__(self, trace_id, parent_id, name, kind=KIND_INTERNAL, attributes=None):
+        self.trace_id = trace_id
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.kind = kind
+        self.start = time.time_ns()
+        self.end = None
+        self.attributes = attributes or {}
+        self.error = None
+
+    def to_dict(self):
+        """ Returns the span with OTLP JSON field names """
+        document = {
+            "traceId": self.trace_id,
+            "spanId": self.span_id,
+            "parentSpanId": self.parent_id or "",
+            "name": self.name,
+            "kind": self.kind,
+            "startTimeUnixNano": self.start,
+            "endTimeUnixNano": self.end,
+            "attributes": self.attributes,
+            "status": {"code": "STATUS_CODE_UNSET"},
+        }
+        if self.error is not None:
+            document["status"] = {"code": "STATUS_CODE_ERROR", "message": self.error}
+        return document
+
+
+class Trace():
+    """ The spans recorded for one request """
+
+    def __init__(self, trace_id, parent_id):
+        self.trace_id = trace_id
+        self.stack = []
+        self.spans = []
+        self.remote_parent = parent_id
+
+    def start(self, name, kind=KIND_INTERNAL, **attributes):
+        """ Opens a child of the innermost open span """
+        parent = self.stack[-1].span_id if self.stack else self.remote_parent
+        span = Span(self.trace_id, parent, name, kind, attributes)
+        self.stack.append(span)
+        self.spans.append(span)
+        return span
+
+    def finish(self, span, error=None):
+        """ Closes a span and everything opened inside it """
+        while self.stack:
+            top = self.stack.pop()
+            top.end = time.time_ns()
+            if top is span:
+                break
+        # client errors like a 404 are answers, not failures of the span
+        if error is not None and getattr(error, 'code', 500) >= 500:
+            span.error = str(error)
+
+
+def current_trace():
+    """ Returns the Trace of the current request or None if not sampled """
+    if has_request_context():
+        return g.get('trace')
+    return None
+
+
+@contextmanager
+def span(name, kind=KIND_INTERNAL, **attributes):
+    """
+    Records a span around a block when the request is traced
+
+    Args:
+        name (string): what the span measures
+        attributes: extra attributes recorded on the span
+    """
+    trace = current_trace()
+    if trace is None:
+        yield None
+        return
+    opened = trace.start(name, kind, **attributes)
+    try:
+        yield opened
+    except Exception as error:
+        trace.finish(opened, error)
+        raise
+    trace.finish(opened)
+
+
+def traceparent():
+    """ Returns the traceparent header to send on outgoing calls, or None """
+    trace = current_trace()
+    if trace is None or not trace.stack:
+        return None
+    return '00-{}-{}-01'.format(trace.trace_id, trace.stack[-1].span_id)
+
+
+######################################################################
+#  E X P O R T E R S
+######################################################################
+class ConsoleExporter():
+    """ Writes spans to stdout """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(s.to_dict()) + '\n' for s in spans)
+        with self._lock:
+            sys.stdout.write(lines)
+            sys.stdout.flush()
+
+
+class FileExporter():
+    """ Appends spans to a file, one JSON object per line """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, spans):
+        lines = ''.join(json.dumps(s.to_dict()) + '\n' for s in spans)
+        with self._lock:
+            with open(self.path, 'a') as trace_file:
+                trace_file.write(lines)
+
+
+_exporter = None
+
+
+def get_exporter():
+    """ Returns the configured exporter, creating it on first use """
+    global _exporter
+    if app.config['TRACE_EXPORTER'] == 'file':
+        if not isinstance(_exporter, FileExporter) or _exporter.path != app.config['TRACE_FILE']:
+            _exporter = FileExporter(app.config['TRACE_FILE'])
+    elif not isinstance(_exporter, ConsoleExporter):
+        _exporter = ConsoleExporter()
+    return _exporter
+
+
+######################################################################
+#  D E C O R A T O R S
+######################################################################
+def trace_resource(view):
+    """ Records a span around every Resource method (an Api decorator) """
+    resource = getattr(view, 'view_class', None)
+    resource = resource.__name__ if resource else view.__name__
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if current_trace() is None:
+            return view(*args, **kwargs)
+        with span('{}.{}'.format(resource, request.method.lower())):
+            return view(*args, **kwargs)
+    return wrapper
+
+
+def traced_marshal(marshaller):
+    """
+    Wraps a restplus marshal_with decorator so marshalling gets its own span
+
+    Args:
+        marshaller: the decorator returned by api.marshal_with
+    """
+    def decorator(func):
+        @wraps(func)
+        def produce(*args, **kwargs):
+            result = func(*args, **kwargs)
+            trace = current_trace()
+            if trace is not None:
+                g.marshal_span = trace.start('marshal')
+            return result
+
+        marshalled = marshaller(produce)
+
+        @wraps(marshalled)
+        def wrapper(*args, **kwargs):
+            try:
+                return marshalled(*args, **kwargs)
+            finally:
+                marshal_span = g.pop('marshal_span', None)
+                if marshal_span is not None:
+                    current_trace().finish(marshal_span)
+        return wrapper
+    return decorator
+
+
+######################################################################
+#  R E Q U E S T   H O O K S
+######################################################################
+def _sampled_parent():
+    """ Returns (trace id, parent span id, sampled) for the request """
+    header = request.headers.get('traceparent', '').strip().lower()
+    match = TRACEPARENT.match(header)
+    if match and match.group(1) != '0' * 32 and match.group(2) != '0' * 16:
+        return match.group(1), match.group(2), bool(int(match.group(3), 16) & 1)
+    sampled = random.random() < app.config['TRACE_SAMPLE_RATE']
+    return '%032x' % random.getrandbits(128), None, sampled
+
+
+@app.before_request
+def start_trace():
+    """ Opens the server span of a sampled request """
+    if not app.config['TRACING_ENABLED']:
+        return
+    trace_id, parent_id, sampled = _sampled_parent()
+    if not sampled:
+        return
+    g.trace = Trace(trace_id, parent_id)
+    g.trace.start(
+        '{} {}'.format(request.method, request.url_rule.rule if request.url_rule else request.path),
+        KIND_SERVER,
+        **{'http.method': request.method, 'http.target': request.full_path.rstrip('?')}
+    )
+
+
+@app.after_request
+def tag_response(response):
+    """ Records the status code and tells the caller which trace it joined """
+    trace = current_trace()
+    if trace is not None and trace.spans:
+        root = trace.spans[0]
+        root.attributes['http.status_code'] = response.status_code
+        if response.status_code >= 500:
+            root.error = response.status
+        response.headers['traceresponse'] = '00-{}-{}-01'.format(trace.trace_id, root.span_id)
+    return response
+
+
+@app.teardown_request
+def end_trace(exception=None):
+    """ Closes the request's spans and exports them """
+    trace = g.pop('trace', None)
+    if trace is None or not trace.spans:
+        return
+    trace.finish(trace.spans[0], exception)
+    try:
+        get_exporter().export(trace.spans)
+    except (IOError, OSError) as error:
+        logger.warning("Could not export trace %s: %s", trace.trace_id, error)
+
+
+######################################################################
+#  S Q L   S T A T E M E N T S
+######################################################################
+@event.listens_for(Engine, 'before_cursor_execute')
+def _start_statement(conn, cursor, statement, parameters, context, executemany):
+    trace = current_trace()
+    if trace is not None:
+        conn.info.setdefault('trace_spans', []).append(trace.start(
+            statement.split(None, 1)[0].upper() if statement else 'SQL', KIND_CLIENT,
+            **{'db.system': conn.engine.name, 'db.statement': statement[:1000]}
+        ))
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _end_statement(conn, cursor, statement, parameters, context, executemany):
+    spans = conn.info.get('trace_spans')
+    if spans:
+        statement_span = spans.pop()
+        trace = current_trace()
+        if trace is not None:
+            statement_span.attributes['db.rows'] = cursor.rowcount
+            trace.finish(statement_span)
+
+
+@event.listens_for(Engine, 'handle_error')
+def _fail_statement(context):
+    spans = context.connection.info.get('trace_spans') if context.connection else None
+    if spans:
+        statement_span = spans.pop()
+        trace = current_trace()
+        if trace is not None:
+            trace.finish(statement_span, context.original_exception)
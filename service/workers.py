@@ -0,0 +1,61 @@
+"""
+Worker Threads
+
+Several parts of the service run a background thread in every worker:
+the revalidation of stale responses, the write-behind of quantities, the
+group committer and the deadline watchdog. A WorkerThread starts its
+thread the first time a process needs it. gunicorn forks its workers from
+a master that may have started the thread already, and a forked process
+only keeps the thread that forked it, so the pid the thread was started in
+is checked and a worker starts a thread of its own, after resetting the
+state it inherited with the parent's thread.
+"""
+import os
+import threading
+
+
+class WorkerThread():
+    """ A daemon thread that each process starts for itself, once
+
+    Args:
+        target (function): what the thread runs
+        name (string): the name of the thread
+        lock (Lock): held while the thread starts, the lock of the state
+            its owner resets, by default one of its own
+    """
+
+    def __init__(self, target, name, lock=None):
+        self.target = target
+        self.name = name
+        self.lock = lock or threading.Lock()
+        self.pid = None
+        self.thread = None
+
+    def start(self, reset=None):
+        """ Starts the thread unless this process has it, returns whether it did
+
+        Args:
+            reset (function): called under the lock before the thread starts,
+                to drop the state the process inherited from its parent
+        """
+        if self.pid == os.getpid():
+            return False
+        with self.lock:
+            if self.pid == os.getpid():
+                return False
+            if reset is not None:
+                reset()
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.target, name=self.name, daemon=True)
+            self.thread.start()
+            return True
+
+    def running(self):
+        """ Returns whether this process started the thread """
+        return self.thread is not None and self.pid == os.getpid()
+
+    def join(self):
+        """ Waits for the thread to end, the next start() begins a new one """
+        self.thread.join()
+        self.thread = None
+        self.pid = None
@@ -0,0 +1,325 @@
+"""
+Write-Behind Stock Updates
+
+Warehouse systems report stock movements thousands of times a second, many
+for the same few Products. POST /api/products/quantity-deltas takes a batch
+of them and answers 202 right away: the deltas are added up per Product in
+memory and written by a background thread every WRITE_BEHIND_FLUSH_SECONDS,
+or as soon as WRITE_BEHIND_MAX_PENDING Products are waiting, with a single
+UPDATE however many deltas came in. A quantity never drops below zero and
+deltas for Products that do not exist are dropped. The sum of the deltas
+of a Product stops at what an integer column holds, as does its quantity,
+and when the database rejects a batch anyway it is split until the
+deltas it rejects are found, which are dropped. With shards the
+UPDATE runs on one shard after the other, each committing on its own and
+only sent the Products no shard before it had; when a shard fails, the
+deltas it and the shards after it did not write are kept for the next
+flush.
+
+Pending deltas are written when the worker exits. With WRITE_BEHIND_WAL_DIR
+set every delta is also appended to a log file of the worker before it is
+accepted, and the log of a worker that died is taken over by the next one
+that receives deltas. The log survives the worker crashing, and with
+WRITE_BEHIND_WAL_FSYNC the machine crashing too, at the cost of a disk
+sync per request. A worker dying between an UPDATE and removing its log
+applies those deltas twice, the log delivers them at least once.
+
+GET /api/products/quantity-deltas returns the counters of the worker, its
+coalescing_ratio is the number of deltas written per row updated.
+"""
+import os
+import glob
+import json
+import fcntl
+import atexit
+import logging
+import threading
+from datetime import datetime
+from sqlalchemy import text, exc
+from service.models import db, Product, current_tenant
+from service.schema import INTEGER_MAX
+from service import sharding
+from service.workers import WorkerThread
+from . import app
+
+logger = logging.getLogger(__name__)
+
+# adds every pending delta in one statement, the arrays line up by position,
+# in bigint so the sum cannot overflow before it is clamped to an integer
+_APPLY = text(
+    'UPDATE "{0}" SET quantity = least(greatest('
+    'CAST(coalesce("{0}".quantity, 0) AS bigint) + pending.delta, 0), {1}), '
+    'updated_at = :now '
+    'FROM unnest(CAST(:tenants AS varchar[]), CAST(:ids AS integer[]), CAST(:deltas AS integer[])) '
+    'AS pending(tenant, id, delta) '
+    'WHERE "{0}".tenant = pending.tenant AND "{0}".id = pending.id '
+    'AND "{0}".deleted_at IS NULL '
+    'RETURNING "{0}".tenant, "{0}".id'.format(Product.__tablename__, INTEGER_MAX)
+)
+
+
+class _Log():
+    """ A log file of this worker, locked as long as it is open
+
+    Args:
+        path (string): where to create the file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # locked under a temporary name so no other worker takes it for a dead one's
+        self.file = open(path + '.new', 'a')
+        fcntl.flock(self.file, fcntl.LOCK_EX)
+        os.rename(path + '.new', path)
+
+    def append(self, entries):
+        """ Appends (tenant, product_id, delta) entries """
+        self.file.write(''.join(json.dumps(entry) + '\n' for entry in entries))
+        self.file.flush()
+        if app.config['WRITE_BEHIND_WAL_FSYNC']:
+            os.fsync(self.file.fileno())
+
+    def remove(self):
+        """ Deletes the file once its deltas are written """
+        os.unlink(self.path)
+        self.file.close()
+
+
+class QuantityBuffer():
+    """
+    Adds up quantity deltas per Product and writes them in batches
+
+    The settings are read from the app config when the buffer starts, on
+    the first deltas it receives in a process
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending = {}  # (tenant, product_id) -> [sum of the deltas, number of deltas]
+        self._wal = None
+        self._retired = []  # logs of deltas not written yet
+        self._segment = 0
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._writer = WorkerThread(self._loop, 'write-behind', self._lock)
+        self.received = 0
+        self.written = 0
+        self.rows = 0
+        self.dropped = 0
+        self.rejected = 0
+        self.flushes = 0
+
+    def add(self, deltas, tenant=None):
+        """
+        Accepts quantity deltas to write later
+
+        Args:
+            deltas (list): (product_id, delta) pairs
+            tenant (string): the tenant of the Products, the current one by default
+        """
+        tenant = tenant or current_tenant()
+        self.start()
+        with self._lock:
+            if self._wal is not None:
+                self._wal.append([(tenant, product_id, delta) for product_id, delta in deltas])
+            self._buffer(tenant, deltas)
+            full = len(self._pending) >= app.config['WRITE_BEHIND_MAX_PENDING']
+        if full:
+            self._wake.set()
+
+    def _buffer(self, tenant, deltas):
+        """ Adds deltas to the pending ones, the lock must be held """
+        for product_id, delta in deltas:
+            entry = self._pending.setdefault((tenant, product_id), [0, 0])
+            entry[0] = max(-INTEGER_MAX, min(entry[0] + delta, INTEGER_MAX))
+            entry[1] += 1
+        self.received += len(deltas)
+
+    def flush(self):
+        """
+        Writes the pending deltas in one UPDATE per database
+
+        Deltas that could not be written are kept for the next flush
+
+        Returns:
+            int: the number of Products updated
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._wal is not None:
+                self._retired.append(self._wal)
+                self._wal = self._open_segment()
+            retired, self._retired = self._retired, []
+        if pending:
+            done, rejected = set(), set()
+            try:
+                self._apply(pending, done, rejected)
+            except Exception:
+                with self._lock:
+                    # the shards that committed must not get their deltas twice
+                    for key, (delta, count) in pending.items():
+                        if key in done or key in rejected:
+                            continue
+                        entry = self._pending.setdefault(key, [0, 0])
+                        entry[0] = max(-INTEGER_MAX, min(entry[0] + delta, INTEGER_MAX))
+                        entry[1] += count
+                    self.written += sum(pending[key][1] for key in done)
+                    self.rows += len(done)
+                    self.rejected += len(rejected)
+                    self._retired = retired + self._retired
+                raise
+            rows = len(done)
+            with self._lock:
+                self.flushes += 1
+                self.written += sum(count for _, count in pending.values())
+                self.rows += rows
+                self.rejected += len(rejected)
+                self.dropped += len(pending) - rows - len(rejected)
+            logger.debug("Wrote %s quantity deltas to %s Products", sum(c for _, c in pending.values()), rows)
+        else:
+            rows = 0
+        for wal in retired:
+            wal.remove()
+        return rows
+
+    def _apply(self, pending, done, rejected):
+        """ Runs the UPDATE on every database, adding the keys it updated to done
+
+        A Product lives on one shard only, so a shard is only sent the
+        deltas of Products the shards before it did not have. The keys
+        whose deltas the database rejects are added to rejected
+        """
+        now = datetime.utcnow()
+        for _ in sharding.each_shard():
+            keys = [key for key in pending if key not in done and key not in rejected]
+            if not keys:
+                break
+            self._update(pending, keys, now, done, rejected)
+
+    def _update(self, pending, keys, now, done, rejected):
+        """ Runs the UPDATE of some keys on the current database, halving them on bad data """
+        params = {
+            'tenants': [tenant for tenant, _ in keys],
+            'ids': [product_id for _, product_id in keys],
+            'deltas': [pending[key][0] for key in keys],
+            'now': now,
+        }
+        try:
+            updated = db.session.execute(_APPLY, params).fetchall()
+            db.session.commit()
+        except exc.DataError:
+            db.session.rollback()
+            if len(keys) == 1:
+                logger.error("Dropping the quantity deltas of %s, the database rejects them", keys[0])
+                rejected.add(keys[0])
+                return
+            # one bad delta must not hold back the others
+            half = len(keys) // 2
+            self._update(pending, keys[:half], now, done, rejected)
+            self._update(pending, keys[half:], now, done, rejected)
+            return
+        except Exception:
+            db.session.rollback()
+            raise
+        done.update((tenant, product_id) for tenant, product_id in updated)
+
+    def metrics(self):
+        """ Returns the counters of this worker """
+        with self._lock:
+            return {
+                'received': self.received,
+                'pending_products': len(self._pending),
+                'pending_deltas': sum(count for _, count in self._pending.values()),
+                'written': self.written,
+                'rows_updated': self.rows,
+                'dropped': self.dropped,
+                'rejected': self.rejected,
+                'flushes': self.flushes,
+                'coalescing_ratio': float(self.written) / (self.rows + self.dropped + self.rejected)
+                                    if self.rows + self.dropped + self.rejected else None,
+            }
+
+    ######################################################################
+    #  L O G   F I L E S
+    ######################################################################
+    def _open_segment(self):
+        """ Starts a new log file of this worker """
+        self._segment += 1
+        return _Log(os.path.join(app.config['WRITE_BEHIND_WAL_DIR'],
+                                 'quantity-{}-{}.wal'.format(os.getpid(), self._segment)))
+
+    def _take_over_orphans(self):
+        """ Moves the deltas in the logs of dead workers into this one """
+        for path in sorted(glob.glob(os.path.join(app.config['WRITE_BEHIND_WAL_DIR'], 'quantity-*.wal'))):
+            with open(path) as orphan:
+                try:
+                    fcntl.flock(orphan, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    continue  # a running worker owns it
+                entries = []
+                for line in orphan:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        break  # the last line was cut short when the worker died
+                with self._lock:
+                    self._wal.append(entries)
+                    for tenant, product_id, delta in entries:
+                        self._buffer(tenant, [(product_id, delta)])
+                os.unlink(path)
+            logger.warning("Took over %s quantity deltas from %s", len(entries), path)
+
+    ######################################################################
+    #  B A C K G R O U N D   T H R E A D
+    ######################################################################
+    def start(self):
+        """ Starts the thread writing the deltas of this process, once """
+        if not self._writer.start(self._reset):
+            return
+        if self._wal is not None:
+            self._take_over_orphans()
+        atexit.register(self.stop)
+
+    def _reset(self):
+        """ Forgets the deltas of the parent of this process and opens its own log """
+        self._pending, self._retired, self._wal = {}, [], None
+        self._stopping.clear()
+        if app.config['WRITE_BEHIND_WAL_DIR']:
+            os.makedirs(app.config['WRITE_BEHIND_WAL_DIR'], exist_ok=True)
+            self._wal = self._open_segment()
+
+    def stop(self):
+        """ Stops the thread and writes what is still pending """
+        if not self._writer.running():
+            return
+        self._stopping.set()
+        self._wake.set()
+        self._writer.join()
+        with app.app_context():
+            try:
+                self.flush()
+            finally:
+                db.session.remove()
+        if self._wal is not None:
+            self._wal.remove()
+            self._wal = None
+
+    def _loop(self):
+        """ Writes the pending deltas every WRITE_BEHIND_FLUSH_SECONDS or when woken """
+        with app.app_context():
+            try:
+                while not self._stopping.is_set():
+                    self._wake.wait(app.config['WRITE_BEHIND_FLUSH_SECONDS'])
+                    self._wake.clear()
+                    if self._stopping.is_set():
+                        break
+                    try:
+                        self.flush()
+                    except Exception:
+                        logger.exception("Could not write quantity deltas, retrying")
+            finally:
+                db.session.remove()
+
+
+# the buffer of this worker
+buffer = QuantityBuffer()
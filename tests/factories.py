@@ -47,5 +47,5 @@ class SupplierFactory(factory.Factory):
     address = factory.Faker("address")
     email = factory.Faker("email")
     phone_number = factory.Faker("phone_number")
-    preferred = FuzzyChoice(choices=["true", "false"])
+    preferred = FuzzyChoice(choices=[True, False])
     
\ No newline at end of file
@@ -6,8 +6,10 @@ import os
 import logging
 import unittest
 import json
+from datetime import datetime, timedelta
 from werkzeug.exceptions import NotFound
-from service.models import Supplier, Product, DataValidationError, db
+from service.models import Supplier, Product, Tombstone, DataValidationError, db
+from service.models import Reservation, ReservationError
 from service import app
 from tests.factories import SupplierFactory, ProductFactory
 
@@ -280,19 +282,19 @@ class TestSupplier(unittest.TestCase):
     def test_find_by_preferred(self):
         """ Find a Supplier by Preferred """
         suppliers = SupplierFactory.create_batch(3)
-        suppliers[0].preferred="false"
+        suppliers[0].preferred=False
         suppliers[0].create()
         suppliers[1].name="Mark Jacob"
-        suppliers[1].preferred="true"
+        suppliers[1].preferred=True
         suppliers[1].create()
-        suppliers[2].preferred="false"
+        suppliers[2].preferred=False
         suppliers[2].create()
         
-        results = Supplier.find_by_preferred("true")
+        results = Supplier.find_by_preferred(True)
         logging.debug(results)
         self.assertNotEqual(results, [])
         self.assertEqual(results[0].name, "Mark Jacob")
-        self.assertEqual(results[0].preferred, "true")
+        self.assertEqual(results[0].preferred, True)
 
     def test_find_or_404_found(self):
         """ Find or return 404 found """
@@ -308,5 +310,178 @@ class TestSupplier(unittest.TestCase):
     def test_find_or_404_not_found(self):
         """ Find or return 404 NOT found """
         self.assertRaises(NotFound, Supplier.find_or_404, 0)
-    
 
+    def test_updated_at_is_tracked(self):
+        """ Updated timestamp is set on create and bumped on save """
+        supplier = self._create_supplier(products=[self._create_product()])
+        supplier.create()
+        self.assertIsNotNone(supplier.updated_at)
+        self.assertIsNotNone(supplier.products[0].updated_at)
+        created_at = supplier.updated_at
+        supplier.category = "suppliers"
+        supplier.save()
+        self.assertGreater(supplier.updated_at, created_at)
+        self.assertEqual(supplier.serialize()["updated_at"], supplier.updated_at.isoformat())
+
+    def test_find_modified_since(self):
+        """ Find Suppliers whose row or products changed after a timestamp """
+        suppliers = SupplierFactory.create_batch(3)
+        for supplier in suppliers:
+            supplier.create()
+        since = datetime.utcnow()
+        self.assertEqual(Supplier.find_modified_since(since).count(), 0)
+        suppliers[0].name = "Changed"
+        suppliers[0].save()
+        suppliers[1].products.append(self._create_product())
+        suppliers[1].save()
+        results = Supplier.find_modified_since(since).all()
+        self.assertEqual(sorted(s.id for s in results), [suppliers[0].id, suppliers[1].id])
+
+    def test_delete_leaves_tombstone(self):
+        """ Deleting a Supplier records a Tombstone """
+        since = datetime.utcnow() - timedelta(seconds=1)
+        supplier = SupplierFactory()
+        supplier.create()
+        supplier_id = supplier.id
+        supplier.delete()
+        tombstones = Tombstone.find_since(Supplier.__tablename__, since).all()
+        self.assertEqual(len(tombstones), 1)
+        self.assertEqual(tombstones[0].serialize()["id"], supplier_id)
+        self.assertTrue(tombstones[0].serialize()["deleted"])
+        self.assertEqual(Tombstone.find_since(Supplier.__tablename__, datetime.utcnow()).count(), 0)
+
+    def test_delete_is_soft(self):
+        """ Deleting a Supplier hides it and its Products but keeps the rows """
+        supplier = SupplierFactory()
+        supplier.products.append(self._create_product())
+        supplier.create()
+        supplier_id, product_id = supplier.id, supplier.products[0].id
+        supplier.delete()
+        self.assertIsNone(Supplier.find(supplier_id))
+        self.assertIsNone(Product.find(product_id))
+        self.assertEqual(Supplier.find_by_name(supplier.name).count(), 0)
+        self.assertIsNone(Supplier.mark_preferred(supplier_id))
+        self.assertRaises(NotFound, Supplier.find_or_404, supplier_id)
+        self.assertEqual(Supplier.query.count(), 1)
+        self.assertIsNotNone(Product.query.filter_by(id=product_id).one().deleted_at)
+
+    def test_purge_in_batches(self):
+        """ Purge removes old soft deleted rows for good """
+        suppliers = SupplierFactory.create_batch(5)
+        for supplier in suppliers:
+            supplier.products.append(self._create_product())
+            supplier.products[0].quantity = 5
+            supplier.create()
+        Reservation.reserve([{"product_id": suppliers[0].products[0].id, "quantity": 1}])
+        for supplier in suppliers[:3]:
+            supplier.delete()
+        # nothing is old enough yet
+        self.assertEqual(Supplier.purge(datetime.utcnow() - timedelta(days=1)), 0)
+        self.assertEqual(Supplier.purge(datetime.utcnow(), batch_size=2), 3)
+        self.assertEqual(Supplier.query.count(), 2)
+        self.assertEqual(Product.query.count(), 2)
+        self.assertEqual(Reservation.query.count(), 0)
+        self.assertEqual(len(Supplier.all()), 2)
+
+    def test_remove_all(self):
+        """ Remove every Supplier at once """
+        for supplier in SupplierFactory.create_batch(3):
+            supplier.products.append(self._create_product())
+            supplier.create()
+        Supplier.remove_all()
+        self.assertEqual(Supplier.query.count(), 0)
+        self.assertEqual(Product.query.count(), 0)
+        supplier = self._create_supplier()
+        supplier.create()
+        self.assertEqual(supplier.id, 1)
+
+    def test_deserialize_reports_every_error(self):
+        """ Deserializing a bad Supplier lists all of its errors """
+        data = {
+            "name": 42,
+            "address": "1 Main St",
+            "email": "a@b.com",
+            "products": [{"name": "widget", "desc": "", "wholesale_price": 5, "quantity": "1"}],
+        }
+        supplier = Supplier()
+        with self.assertRaises(DataValidationError) as context:
+            supplier.deserialize(data)
+        self.assertEqual(context.exception.errors, [
+            "name must be a string",
+            "category is required",
+            "products[0].quantity must be an integer",
+        ])
+        self.assertIn("category is required", str(context.exception))
+
+    def test_deserialize_a_product(self):
+        """ Deserialize a Product and reject a bad one """
+        product = Product().deserialize(
+            {"name": "widget", "desc": "blue", "wholesale_price": 5, "quantity": 2}
+        )
+        self.assertEqual(product.name, "widget")
+        self.assertEqual(product.quantity, 2)
+        self.assertRaises(DataValidationError, Product().deserialize, "not a product")
+
+    def test_mark_preferred(self):
+        """ Set the preferred flag with one conditional update """
+        supplier = SupplierFactory(preferred=False)
+        supplier.create()
+        updated = Supplier.mark_preferred(supplier.id, True, expected=False)
+        self.assertEqual(updated.preferred, True)
+        self.assertEqual(len(updated.serialize()["products"]), 0)
+        self.assertIsNone(Supplier.mark_preferred(supplier.id, True, expected=False))
+        self.assertIsNone(Supplier.mark_preferred(0, True))
+        self.assertEqual(Supplier.find(supplier.id).preferred, True)
+
+    def test_adjust_quantity(self):
+        """ Adjust stock in the database without going below the minimum """
+        supplier = SupplierFactory()
+        supplier.products.append(Product(name="widget", desc="", wholesale_price=5, quantity=2))
+        supplier.create()
+        product_id = supplier.products[0].id
+        self.assertEqual(Product.adjust_quantity(product_id, 3).quantity, 5)
+        self.assertIsNone(Product.adjust_quantity(product_id, -6))
+        self.assertEqual(Product.adjust_quantity(product_id, -6, minimum=None).quantity, -1)
+        self.assertIsNone(Product.adjust_quantity(product_id, 1, supplier_id=0))
+
+    def _stock(self, *quantities):
+        """ Creates a Supplier with Products of the given quantities """
+        supplier = SupplierFactory()
+        for quantity in quantities:
+            supplier.products.append(
+                Product(name="widget", desc="", wholesale_price=5, quantity=quantity)
+            )
+        supplier.create()
+        return [product.id for product in supplier.products]
+
+    def test_reserve_and_release(self):
+        """ Take stock off Products and put it back """
+        first, second = self._stock(5, 5)
+        reservations = Reservation.reserve([
+            {"product_id": first, "quantity": 2},
+            {"product_id": second, "quantity": 5},
+            {"product_id": first, "quantity": 1},
+        ], reference="order-1")
+        self.assertEqual(sorted((r.product_id, r.quantity) for r in reservations),
+                         [(first, 3), (second, 5)])
+        self.assertEqual(Product.find(first).quantity, 2)
+        self.assertEqual(Product.find(second).quantity, 0)
+        released = Reservation.release(reservations[0].id)
+        self.assertEqual(released.status, Reservation.RELEASED)
+        self.assertEqual(Product.find(first).quantity, 5)
+        with self.assertRaises(ReservationError) as context:
+            Reservation.release(reservations[0].id)
+        self.assertFalse(context.exception.not_found)
+
+    def test_reserve_all_or_nothing(self):
+        """ Reserve nothing when any Product is short """
+        first, second = self._stock(5, 1)
+        with self.assertRaises(ReservationError) as context:
+            Reservation.reserve([{"product_id": first, "quantity": 1},
+                                 {"product_id": second, "quantity": 2}])
+        self.assertIn("only 1 in stock", str(context.exception))
+        self.assertEqual(Product.find(first).quantity, 5)
+        self.assertEqual(Reservation.query.count(), 0)
+        with self.assertRaises(ReservationError) as context:
+            Reservation.reserve([{"product_id": 0, "quantity": 1}])
+        self.assertTrue(context.exception.not_found)
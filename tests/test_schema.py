@@ -0,0 +1,93 @@
+"""
+Supplier and Product Schema Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color tests/test_schema.py
+"""
+from unittest import TestCase
+from flask_restplus import Api
+from service.schema import (
+    validate_supplier, validate_product, validate_many, api_models, VALIDATORS
+)
+
+
+def _supplier(**changes):
+    """ Returns a valid Supplier document with some fields changed """
+    data = {
+        "name": "Acme",
+        "category": "other",
+        "address": "1 Main St",
+        "email": "sales@acme.com",
+        "phone_number": "555-1234",
+        "preferred": True,
+        "products": [{"name": "widget", "desc": "blue", "wholesale_price": 5, "quantity": 2}],
+    }
+    data.update(changes)
+    return data
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSchema(TestCase):
+    """ Schema Validator and Model Tests """
+
+    def test_valid_supplier(self):
+        """ Accept a valid Supplier """
+        self.assertEqual(validate_supplier(_supplier()), [])
+        self.assertEqual(validate_supplier(_supplier(phone_number=None, preferred=None)), [])
+
+    def test_read_only_fields_ignored(self):
+        """ Ignore fields the service sets itself """
+        self.assertEqual(validate_supplier(_supplier(id="x", updated_at=5, deleted="no")), [])
+
+    def test_every_error_reported(self):
+        """ Report all errors in one pass """
+        data = _supplier(name=7, email="x" * 64, preferred="yes")
+        del data["category"]
+        self.assertEqual(validate_supplier(data), [
+            "name must be a string",
+            "category is required",
+            "email must be at most 63 characters",
+            "preferred must be a boolean",
+        ])
+
+    def test_nested_products(self):
+        """ Report errors of nested Products with their path """
+        data = _supplier(products=[{"name": "widget"}, "nope"])
+        self.assertEqual(validate_supplier(data), [
+            "products[0].desc is required",
+            "products[0].wholesale_price is required",
+            "products[0].quantity is required",
+            "products[1].body must be an object",
+        ])
+
+    def test_strict_types(self):
+        """ Do not coerce booleans into integers """
+        product = {"name": "widget", "desc": "", "wholesale_price": True, "quantity": 1}
+        self.assertEqual(validate_product(product), ["wholesale_price must be an integer"])
+
+    def test_validate_many(self):
+        """ Validate a list of documents """
+        self.assertEqual(validate_many(validate_supplier, [_supplier(), _supplier(name=None)]),
+                         ["[1].name is required"])
+        self.assertEqual(validate_many(validate_supplier, {}), ["body must be an array"])
+
+    def test_generated_source(self):
+        """ Keep the generated source for debugging """
+        self.assertIn("def validate_supplier(data, path=''):", VALIDATORS["Supplier"].source)
+
+    def test_api_models(self):
+        """ Build the restplus models from the schema """
+        models = api_models(Api())
+        self.assertTrue({"Product", "Supplier"} <= set(models))
+        supplier = models["Supplier"]
+        self.assertTrue(supplier["name"].required)
+        self.assertTrue(supplier["id"].readonly)
+        self.assertEqual(supplier.__schema__["properties"]["name"]["maxLength"], 63)
+        self.assertIn("Product", str(supplier["products"].container.model.name))
+
+    def test_array_of_integers(self):
+        """ Check the type of every item of a primitive array """
+        errors = VALIDATORS["PreferredUpdate"]({"ids": [1, "2", None], "preferred": True})
+        self.assertEqual(errors, ["ids[1] must be an integer", "ids[2] must be an integer"])
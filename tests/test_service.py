@@ -8,10 +8,11 @@ Test cases can be run with the following:
 import os
 import logging
 import json
+from datetime import datetime
 from unittest import TestCase
 from unittest.mock import MagicMock, patch
 from flask_api import status  # HTTP Status Codes
-from service.models import db, DataValidationError
+from service.models import db, DataValidationError, Product
 from service.service import app, init_db
 from tests.factories import SupplierFactory, ProductFactory
 from urllib.parse import quote_plus
@@ -223,7 +224,7 @@ class TestYourResourceServer(TestCase):
         """ Mark a Preferred Supplier (action test) """
         supplier = SupplierFactory.create_batch(1)
         supplier[0].name="Erlich Bachman"
-        supplier[0].preferred="false"
+        supplier[0].preferred=False
         supplier[0].create()
         
         resp = self.app.get('/suppliers/{}'.format(supplier[0].id), content_type='application/json')
@@ -231,7 +232,7 @@ class TestYourResourceServer(TestCase):
         data = resp.get_json()
         logging.debug('data = %s', data)
         #Ensure that preferred flag is false prior to action
-        self.assertEqual(data["preferred"], "false")
+        self.assertEqual(data["preferred"], False)
 
         resp = self.app.put('/suppliers/{}/preferred'.format(supplier[0].id), content_type='application/json')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
@@ -241,7 +242,7 @@ class TestYourResourceServer(TestCase):
         data = resp.get_json()
         logging.debug('data = %s', data)
         #Ensure that preferred flag is set to True after action
-        self.assertEqual(data["preferred"], "true")
+        self.assertEqual(data["preferred"], True)
 
     def test_reset_supplier_database(self):
         """ RESET Suppliers Database """
@@ -371,3 +372,236 @@ class TestYourResourceServer(TestCase):
         resp = self.app.get('/suppliers', query_string='name=fido')
         self.assertEqual(resp.status_code, status.HTTP_200_OK)
 
+######################################################################
+#  D E L T A   S Y N C   T E S T   C A S E S
+######################################################################
+    def test_list_modified_since(self):
+        """ List only Suppliers changed or deleted since a timestamp """
+        suppliers = SupplierFactory.create_batch(3)
+        for supplier in suppliers:
+            supplier.create()
+        since = datetime.utcnow().isoformat()
+        suppliers[0].name = "Changed"
+        suppliers[0].save()
+        deleted_id = suppliers[1].id
+        suppliers[1].delete()
+
+        resp = self.app.get('/api/suppliers', query_string={'modified_since': since})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIsNotNone(resp.headers.get('X-Server-Time'))
+        data = resp.get_json()
+        self.assertEqual(len(data), 2)
+        changed = [row for row in data if not row['deleted']]
+        deleted = [row for row in data if row['deleted']]
+        self.assertEqual(changed[0]['name'], "Changed")
+        self.assertEqual(deleted[0]['id'], deleted_id)
+
+        # the cursor overlaps the last sync, so its rows come again
+        resp = self.app.get('/api/suppliers', query_string={'modified_since': resp.headers['X-Server-Time']})
+        self.assertLessEqual({row['id'] for row in data}, {row['id'] for row in resp.get_json()})
+        app.config['SYNC_OVERLAP_SECONDS'], overlap = 0, app.config['SYNC_OVERLAP_SECONDS']
+        try:
+            resp = self.app.get('/api/suppliers', query_string={'modified_since': since})
+            resp = self.app.get('/api/suppliers', query_string={'modified_since': resp.headers['X-Server-Time']})
+        finally:
+            app.config['SYNC_OVERLAP_SECONDS'] = overlap
+        self.assertEqual(resp.get_json(), [])
+
+    def test_list_modified_since_pages(self):
+        """ Send the deleted Suppliers once, on the last page of a sync """
+        suppliers = SupplierFactory.create_batch(4)
+        for supplier in suppliers:
+            supplier.create()
+        since = datetime.utcnow().isoformat()
+        for supplier in suppliers[:3]:
+            supplier.name = "Changed"
+            supplier.save()
+        deleted_id = suppliers[3].id
+        suppliers[3].delete()
+
+        pages = []
+        query = {'modified_since': since, 'limit': 2}
+        while True:
+            resp = self.app.get('/api/suppliers', query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            pages.append(resp.get_json())
+            if 'X-Next-Cursor' not in resp.headers:
+                break
+            query['after'] = resp.headers['X-Next-Cursor']
+        self.assertEqual(len(pages), 2)
+        self.assertEqual([row['deleted'] for row in pages[0]], [False, False])
+        self.assertEqual([(row['id'], row['deleted']) for row in pages[1]],
+                         [(suppliers[2].id, False), (deleted_id, True)])
+
+    def test_list_modified_since_bad_timestamp(self):
+        """ Reject a modified_since that is not ISO 8601 """
+        resp = self.app.get('/api/suppliers', query_string={'modified_since': 'yesterday'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_mark_and_unmark_preferred(self):
+        """ Set and clear the preferred flag without a read first """
+        supplier = SupplierFactory(preferred=False)
+        supplier.create()
+        resp = self.app.put('/api/suppliers/{}/preferred'.format(supplier.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["preferred"], True)
+        # the flag is already set
+        resp = self.app.put('/api/suppliers/{}/preferred'.format(supplier.id),
+                            query_string={'expected': 'false'})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.delete('/api/suppliers/{}/preferred'.format(supplier.id),
+                               query_string={'expected': 'true'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()["preferred"], False)
+        resp = self.app.put('/api/suppliers/0/preferred')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_mark_many_preferred(self):
+        """ Set the preferred flag of many Suppliers at once """
+        suppliers = SupplierFactory.create_batch(3, preferred=False)
+        for supplier in suppliers:
+            supplier.create()
+        ids = [supplier.id for supplier in suppliers]
+        resp = self.app.put('/api/suppliers/preferred', json={'ids': ids[:2], 'preferred': True})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['updated'], ids[:2])
+        resp = self.app.put('/api/suppliers/preferred', json={'ids': ids, 'preferred': True})
+        self.assertEqual(resp.get_json()['updated'], ids[2:])
+        resp = self.app.put('/api/suppliers/preferred', json={'ids': ['x'], 'preferred': True})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(resp.get_json()['errors'], ['ids[0] must be an integer'])
+
+    def test_adjust_quantity(self):
+        """ Add to and take from the stock of a Product """
+        supplier = SupplierFactory()
+        supplier.products.append(Product(name="widget", desc="", wholesale_price=5, quantity=3))
+        supplier.create()
+        product_id = supplier.products[0].id
+        url = '/api/suppliers/{}/products/{}/quantity'.format(supplier.id, product_id)
+        resp = self.app.post(url, json={'delta': -2})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['quantity'], 1)
+        resp = self.app.post(url, json={'delta': -2})
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.post(url, json={'delta': 'lots'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/api/suppliers/0/products/{}/quantity'.format(product_id),
+                             json={'delta': 1})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_deleted_products_are_gone(self):
+        """ Stop selling the Products of a deleted Supplier """
+        supplier = SupplierFactory()
+        supplier.products.append(Product(name="widget", desc="", wholesale_price=5, quantity=3))
+        supplier.create()
+        product_id = supplier.products[0].id
+        resp = self.app.delete('/api/suppliers/{}'.format(supplier.id))
+        self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+        url = '/api/suppliers/{}/products/{}/quantity'.format(supplier.id, product_id)
+        resp = self.app.post(url, json={'delta': 1})
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post('/api/reservations', json={
+            'items': [{'product_id': product_id, 'quantity': 1}]
+        })
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/api/suppliers')
+        self.assertEqual(resp.get_json(), [])
+
+    def test_reservations(self):
+        """ Reserve, read and release stock """
+        supplier = SupplierFactory()
+        supplier.products.append(Product(name="widget", desc="", wholesale_price=5, quantity=3))
+        supplier.create()
+        product_id = supplier.products[0].id
+        resp = self.app.post('/api/reservations', json={
+            'items': [{'product_id': product_id, 'quantity': 2}], 'reference': 'order-1'
+        })
+        self.assertEqual(resp.status_code, status.HTTP_201_CREATED)
+        reservation = resp.get_json()[0]
+        self.assertEqual(reservation['status'], 'held')
+        resp = self.app.post('/api/reservations', json={
+            'items': [{'product_id': product_id, 'quantity': 2}]
+        })
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.get('/api/reservations/{}'.format(reservation['id']))
+        self.assertEqual(resp.get_json()['reference'], 'order-1')
+        resp = self.app.delete('/api/reservations/{}'.format(reservation['id']))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['status'], 'released')
+        resp = self.app.delete('/api/reservations/{}'.format(reservation['id']))
+        self.assertEqual(resp.status_code, status.HTTP_409_CONFLICT)
+        resp = self.app.delete('/api/reservations/0')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post('/api/reservations', json={
+            'items': [{'product_id': 0, 'quantity': 1}]
+        })
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        resp = self.app.post('/api/reservations', json={'items': [{'product_id': 1, 'quantity': 0}]})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_many_suppliers(self):
+        """ Find many Suppliers by id in the order asked for """
+        suppliers = []
+        for _ in range(3):
+            supplier = SupplierFactory()
+            supplier.products.append(Product(name="widget", desc="", wholesale_price=5, quantity=3))
+            supplier.create()
+            suppliers.append(supplier.id)
+        wanted = [suppliers[2], 0, suppliers[0], suppliers[2]]
+        resp = self.app.get('/api/suppliers', query_string={'ids': ','.join(map(str, wanted))})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual([s['id'] for s in resp.get_json()], [suppliers[2], suppliers[0]])
+        self.assertEqual(len(resp.get_json()[0]['products']), 1)
+        self.assertEqual(resp.headers['X-Missing-Ids'], '0')
+        resp = self.app.post('/api/suppliers:lookup', json={'ids': wanted})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([s['id'] for s in data['suppliers']], [suppliers[2], suppliers[0]])
+        self.assertEqual(data['missing'], [0])
+        resp = self.app.get('/api/suppliers', query_string={'ids': '1,x'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/api/suppliers:lookup', json={'ids': ['1']})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_lookup_too_many_ids(self):
+        """ Refuse lookups of more ids than LOOKUP_MAX_IDS """
+        limit = app.config['LOOKUP_MAX_IDS']
+        resp = self.app.post('/api/suppliers:lookup', json={'ids': list(range(limit + 1))})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def _list_pages(self, **query):
+        """ Follows X-Next-Cursor through every page of a list """
+        seen = []
+        while True:
+            resp = self.app.get('/api/suppliers', query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(supplier['id'] for supplier in resp.get_json())
+            if 'X-Next-Cursor' not in resp.headers:
+                return seen
+            query['after'] = resp.headers['X-Next-Cursor']
+
+    def test_sort_suppliers(self):
+        """ List and page Suppliers in each sort order """
+        suppliers = []
+        for name, category in [('b', 'y'), ('a', 'z'), ('b', 'x'), ('c', 'x'), ('a', 'y')]:
+            supplier = SupplierFactory(name=name, category=category)
+            supplier.create()
+            suppliers.append(supplier)
+        for sort in ('id', 'name', 'category', 'updated_at'):
+            for order in ('asc', 'desc'):
+                expected = [s.id for s in sorted(suppliers, key=lambda s: s.sort_key(sort),
+                                                 reverse=order == 'desc')]
+                resp = self.app.get('/api/suppliers', query_string={'sort': sort, 'order': order})
+                self.assertEqual([s['id'] for s in resp.get_json()], expected, (sort, order))
+                self.assertEqual(self._list_pages(sort=sort, order=order, limit=2), expected)
+        resp = self.app.get('/api/suppliers', query_string={'sort': 'name', 'name': 'b', 'order': 'desc'})
+        self.assertEqual([s['id'] for s in resp.get_json()], [suppliers[2].id, suppliers[0].id])
+
+    def test_sort_bad_arguments(self):
+        """ Refuse unknown sort fields and cursors of another sort """
+        resp = self.app.get('/api/suppliers', query_string={'sort': 'address'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/api/suppliers', query_string={'sort': 'name', 'after': '12'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/api/suppliers', query_string={'after': 'abc'})
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
@@ -0,0 +1,52 @@
+"""
+Swagger Document Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color tests/test_swagger.py
+"""
+import os
+from unittest import TestCase
+from service.swagger import swagger_spec, to_yaml, SWAGGER_FILE
+
+ROOT = os.path.join(os.path.dirname(__file__), '..')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSwagger(TestCase):
+    """ Swagger Document Tests """
+
+    def test_yaml(self):
+        """ Write the spec as block YAML with quoted strings """
+        spec = {
+            'swagger': '2.0',
+            'paths': {'/suppliers/{id}': {'get': {'responses': {'200': {'description': 'Success'}}}}},
+            'tags': [{'name': 'Suppliers'}],
+            'enum': ('asc', 'desc'),
+            'required': [],
+            'readOnly': True,
+            'default': 5,
+        }
+        self.assertEqual(to_yaml(spec), '\n'.join([
+            'swagger: "2.0"',
+            'paths:',
+            '  /suppliers/{id}:',
+            '    get:',
+            '      responses:',
+            '        "200":',
+            '          description: "Success"',
+            'tags:',
+            '- name: "Suppliers"',
+            'enum:',
+            '- "asc"',
+            '- "desc"',
+            'required: []',
+            'readOnly: true',
+            'default: 5',
+        ]) + '\n')
+
+    def test_document_is_generated(self):
+        """ Keep the YAML document in the repository the same as the spec served """
+        with open(os.path.join(ROOT, SWAGGER_FILE)) as document:
+            self.assertEqual(document.read(), to_yaml(swagger_spec()),
+                             "run flask swagger to write {} again".format(SWAGGER_FILE))
@@ -0,0 +1,62 @@
+"""
+Worker Thread Test Suite
+
+Test cases can be run with the following:
+  nosetests -v --with-spec --spec-color tests/test_workers.py
+"""
+import os
+import threading
+from unittest import TestCase
+from service.workers import WorkerThread
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestWorkerThread(TestCase):
+    """ Worker Thread Tests """
+
+    def setUp(self):
+        """ Runs before each test """
+        self.stopping = threading.Event()
+        self.resets = []
+        self.worker = WorkerThread(self.stopping.wait, 'test-worker')
+
+    def tearDown(self):
+        """ Runs once after each test case """
+        self.stopping.set()
+        if self.worker.running():
+            self.worker.join()
+
+    def test_start_once(self):
+        """ Start the thread of a process only once """
+        self.assertTrue(self.worker.start(lambda: self.resets.append(1)))
+        self.assertFalse(self.worker.start(lambda: self.resets.append(2)))
+        self.assertTrue(self.worker.running())
+        self.assertEqual(self.worker.thread.name, 'test-worker')
+        self.assertTrue(self.worker.thread.daemon)
+        self.assertEqual(self.resets, [1])
+
+    def test_start_again_after_join(self):
+        """ Start a new thread once the last one was joined """
+        self.worker.start()
+        self.stopping.set()
+        self.worker.join()
+        self.assertFalse(self.worker.running())
+        self.stopping.clear()
+        self.assertTrue(self.worker.start())
+
+    def test_forked_worker_starts_its_own(self):
+        """ Reset and start a thread of its own in a forked worker """
+        self.worker.start()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                started = not self.worker.running() and self.worker.start(lambda: self.resets.append(1))
+                os._exit(0 if started and self.resets == [1] else 1)  # pylint: disable=protected-access
+            finally:
+                os._exit(2)  # pylint: disable=protected-access
+        _, code = os.waitpid(pid, 0)
+        self.assertEqual(os.WEXITSTATUS(code), 0)
+        self.assertTrue(self.worker.running())
+        self.assertEqual(self.resets, [])